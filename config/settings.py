@@ -55,11 +55,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'omcen.staticfiles.StaticFilesMiddleware',
+    'omcen.middleware.MetricsMiddleware',
+    'omcen.middleware.QueryInspectorMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'omcen.middleware.CachedAuthenticationMiddleware',
+    'omcen.middleware.EntitlementMiddleware',
+    'omcen.middleware.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'social_django.middleware.SocialAuthExceptionMiddleware',
@@ -96,6 +101,48 @@ DATABASES = {
     'default': env.db(),
 }
 
+# 閲覧画面の読み取り専用レプリカ (REPLICA_DATABASE_URL を設定した場合のみ)
+if env('REPLICA_DATABASE_URL', default=None):
+    DATABASES['replica'] = env.db('REPLICA_DATABASE_URL')
+OMCEN_REPLICA_DATABASES = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['omcen.routers.ReplicaRouter']
+# 書き込んだユーザーの読み取りをプライマリに固定する時間[秒] (レプリカの遅延より長くする)
+OMCEN_REPLICA_PIN_SECONDS = env('OMCEN_REPLICA_PIN_SECONDS', int, 10)
+
+# PostgreSQL の接続をプロセス内でプールする。リクエストの終わりに接続をプールへ戻すため
+# CONN_MAX_AGE は 0 にする
+if env('OMCEN_DB_POOL', bool, False):
+    for database in DATABASES.values():
+        database.update({
+            'ENGINE': 'omcen.backends.postgresql_pool',
+            'CONN_MAX_AGE': 0,
+            'POOL': {
+                'MIN_SIZE': env('OMCEN_DB_POOL_MIN_SIZE', int, 2),
+                'MAX_SIZE': env('OMCEN_DB_POOL_MAX_SIZE', int, 20),
+                # 空きを待つ最大時間[秒]
+                'TIMEOUT': env('OMCEN_DB_POOL_TIMEOUT', float, 5.0),
+                # 接続を作り直すまでの時間[秒]
+                'MAX_LIFETIME': env('OMCEN_DB_POOL_MAX_LIFETIME', float, 1800.0),
+                # 再利用前に疎通確認するまでの無通信時間[秒]
+                'CHECK_INTERVAL': env('OMCEN_DB_POOL_CHECK_INTERVAL', float, 30.0),
+            },
+        })
+
+# キャッシュ。カタログ・加入中サービス・ログインユーザーの無効化を gunicorn の全ワーカーに届けるため、
+# 本番では Memcached などの共有キャッシュを CACHE_URL で指定する (例: pymemcache://127.0.0.1:11211)。
+# 未設定の場合はプロセス内の LocMemCache になるため、1プロセスの開発サーバー以外では使わない
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# django-environ は pymemcache:// を PyLibMCCache に割り当てるため、pymemcache を使うバックエンドに直す
+if CACHES['default']['BACKEND'] == 'django.core.cache.backends.memcached.PyLibMCCache' \
+        and env('CACHE_URL').startswith('pymemcache://'):
+    CACHES['default']['BACKEND'] = 'django.core.cache.backends.memcached.PyMemcacheCache'
+OMCEN_SHARED_CACHE = CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
 AUTH_USER_MODEL = 'omcen.OmcenUser'
 
 # Password validation
@@ -136,9 +183,12 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [
-    os.path.join(BASE_DIR, 'static', 'css'),
+    os.path.join(BASE_DIR, 'static'),
 ]
-STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+# collectstatic の出力先 (STATICFILES_DIRS と重ねない)
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# STATIC_ROOT のファイルを omcen.staticfiles.StaticFilesMiddleware で配信するか
+OMCEN_SERVE_STATIC = env('OMCEN_SERVE_STATIC', bool, False)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -166,8 +216,15 @@ EMAIL_PORT = env('EMAIL_PORT', int)
 EMAIL_HOST_USER = DEFAULT_FROM_EMAIL = env('EMAIL_HOST_USER')
 # パスワード
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
-# メールを実際に送る
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# メールは DB のキューに入れ、omcen_send_mail コマンドが SMTP で送る
+EMAIL_BACKEND = env('EMAIL_BACKEND', default='omcen.mail.QueuedEmailBackend')
+# 一時的な送信エラーの再送間隔[秒] (試行ごとに倍にし、上限で打ち止め)
+OMCEN_EMAIL_RETRY_BASE = 30
+OMCEN_EMAIL_RETRY_MAX = 3600
+# 送信失敗とみなすまでの試行回数
+OMCEN_EMAIL_MAX_ATTEMPTS = 8
+# 送信中として確保したメールを、ワーカーが落ちた場合に再び送信待ちに戻すまでの時間[秒]
+OMCEN_EMAIL_CLAIM_TIMEOUT = 300
 # メールアドレスの検証方法
 ACCOUNT_EMAIL_VERIFICATION = 'mandatory'
 # メールをユニークにする
@@ -221,3 +278,66 @@ SOCIALACCOUNT_PROVIDERS = {
 }
 
 SITE_ID = 1
+
+# 加入中サービスのキャッシュ保持時間[秒]
+OMCEN_ENTITLEMENT_CACHE_TTL = env('OMCEN_ENTITLEMENT_CACHE_TTL', int, 300)
+
+# メトリクスを gunicorn の全ワーカーで集計する場合の共有ディレクトリ
+OMCEN_METRICS_DIR = env('OMCEN_METRICS_DIR', default=None)
+# 終了したワーカーのほか、この時間[秒]書き換えられていないファイルは集計せずに削除する
+OMCEN_METRICS_MAX_AGE = env('OMCEN_METRICS_MAX_AGE', int, 3600)
+# /omcen/metrics を取得するための Bearer トークン (未設定の場合はスタッフのみ)
+OMCEN_METRICS_TOKEN = env('OMCEN_METRICS_TOKEN', default=None)
+# /omcen/api/ をサブサービスから呼び出すための Bearer トークン (未設定の場合はスタッフのみ)
+OMCEN_API_TOKEN = env('OMCEN_API_TOKEN', default=None)
+# /omcen/api/entitlements で1回に確認できる (ユーザー, サービス) の組の数
+OMCEN_API_MAX_CHECKS = env('OMCEN_API_MAX_CHECKS', int, 5000)
+
+# プラン廃止 (omcen_retire_plans) で1トランザクションに処理する加入数の上限と、
+# 1バッチがロックを待機・保持する時間の上限[秒] (超えるとバッチを小さくする)
+OMCEN_RETIREMENT_BATCH_SIZE = env('OMCEN_RETIREMENT_BATCH_SIZE', int, 1000)
+OMCEN_RETIREMENT_MAX_LOCK_SECONDS = env('OMCEN_RETIREMENT_MAX_LOCK_SECONDS', float, 1.0)
+
+# 請求処理 (omcen_billing_run) の並列プロセス数 (未設定なら CPU 数) と、1チャンクの加入数の目安
+OMCEN_BILLING_WORKERS = env('OMCEN_BILLING_WORKERS', int, None)
+OMCEN_BILLING_CHUNK_SIZE = env('OMCEN_BILLING_CHUNK_SIZE', int, 10000)
+
+# サービス詳細画面に表示する加入者数・月間売上のキャッシュ期間[秒]
+OMCEN_COUNTER_CACHE_TTL = env('OMCEN_COUNTER_CACHE_TTL', int, 30)
+
+# N+1・重複クエリ・クエリ予算超過を 'omcen.queries' ロガーに出力する (既定では DEBUG 時のみ)
+OMCEN_QUERY_INSPECTOR = env('OMCEN_QUERY_INSPECTOR', bool, DEBUG)
+
+# セッションの保存先。cached_db (キャッシュ + DB) または signed_cookies (Cookie のみ) で
+# 認証済みリクエストのセッション読み込みに DB を使わない。
+# cached_db はログアウトを他のワーカーに届けるため共有キャッシュが必要 (なければ db にする)
+SESSION_ENGINE = env(
+    'OMCEN_SESSION_ENGINE',
+    default='django.contrib.sessions.backends.cached_db' if OMCEN_SHARED_CACHE else 'django.contrib.sessions.backends.db',
+)
+
+# ログインユーザーをプロセス内にキャッシュするか (無効化の通知に共有キャッシュが必要)、
+# その保持時間[秒]と最大件数
+OMCEN_USER_CACHE = env('OMCEN_USER_CACHE', bool, OMCEN_SHARED_CACHE)
+OMCEN_USER_CACHE_TTL = env('OMCEN_USER_CACHE_TTL', int, 300)
+OMCEN_USER_CACHE_SIZE = env('OMCEN_USER_CACHE_SIZE', int, 10000)
+
+# social_django (python-social-auth) を読み込むか。allauth とログイン機能が重複し、
+# social_core のバックエンドの import だけで起動が遅くなるため本番設定では無効にする
+OMCEN_SOCIAL_DJANGO = env('OMCEN_SOCIAL_DJANGO', bool, True)
+if not OMCEN_SOCIAL_DJANGO:
+    INSTALLED_APPS.remove('social_django')
+    MIDDLEWARE.remove('social_django.middleware.SocialAuthExceptionMiddleware')
+    TEMPLATES[0]['OPTIONS']['context_processors'] = [
+        processor for processor in TEMPLATES[0]['OPTIONS']['context_processors']
+        if not processor.startswith('social_django.')
+    ]
+    AUTHENTICATION_BACKENDS = tuple(
+        backend for backend in AUTHENTICATION_BACKENDS if not backend.startswith('social_core.')
+    )
+
+# 永続接続 (CONN_MAX_AGE) を再利用する前に疎通確認するまでの無通信時間[秒] (未設定の場合は確認しない)
+OMCEN_CONN_HEALTH_CHECK_INTERVAL = env('OMCEN_CONN_HEALTH_CHECK_INTERVAL', float, None)
+
+# ASGI で非同期版のビューを使うルート名 (service_list, plan_selection, service_in_use_list, my_page)
+OMCEN_ASYNC_VIEWS = env.list('OMCEN_ASYNC_VIEWS', default=[])
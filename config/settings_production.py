@@ -0,0 +1,47 @@
+"""
+Production settings for omcen.
+
+Select with DJANGO_SETTINGS_MODULE=config.settings_production. Everything
+not overridden here comes from config.settings.
+"""
+import os
+
+# 本番では social_django を読み込まない (config.settings の読み込み前に決める)
+os.environ.setdefault('OMCEN_SOCIAL_DJANGO', 'False')
+
+from config.settings import *  # noqa: E402,F401,F403
+
+DEBUG = False
+
+# カタログ・セッションなどの無効化を全ワーカーに届けるため、共有キャッシュ (CACHE_URL) を必須にする
+# (CACHES は config.settings で CACHE_URL から作られる)
+env('CACHE_URL')
+
+ALLOWED_HOSTS = env.list('ALLOWED_HOSTS')
+
+# DB 接続をリクエストをまたいで再利用する[秒] (OMCEN_DB_POOL でプールする場合はプールに任せる)
+if 'POOL' not in DATABASES['default']:
+    DATABASES['default']['CONN_MAX_AGE'] = env('CONN_MAX_AGE', int, 60)
+# 60 秒以上使われていなかった接続は再利用前に疎通を確認する
+OMCEN_CONN_HEALTH_CHECK_INTERVAL = env('OMCEN_CONN_HEALTH_CHECK_INTERVAL', float, 60)
+
+# テンプレートの読み込み・解析結果をプロセス内に保持する
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+# 同じコンテキストプロセッサの重複を除く
+TEMPLATES[0]['OPTIONS']['context_processors'] = list(dict.fromkeys(TEMPLATES[0]['OPTIONS']['context_processors']))
+
+# N+1 検出は本番では既定で無効 (config.settings では DEBUG に従う)
+OMCEN_QUERY_INSPECTOR = env('OMCEN_QUERY_INSPECTOR', bool, False)
+
+# ハッシュ付きファイル名と gzip/brotli 版を collectstatic 時に作り、アプリから長期キャッシュ付きで配信する
+STATICFILES_STORAGE = 'omcen.staticfiles.CompressedManifestStaticFilesStorage'
+OMCEN_SERVE_STATIC = env('OMCEN_SERVE_STATIC', bool, True)
+
+SESSION_COOKIE_SECURE = env('SESSION_COOKIE_SECURE', bool, True)
+CSRF_COOKIE_SECURE = env('CSRF_COOKIE_SECURE', bool, True)
@@ -24,6 +24,6 @@ urlpatterns = [
     path('omcen/', include('omcen.urls')),
 ]
 
-if settings.DEBUG:
+if settings.DEBUG and 'debug_toolbar' in settings.INSTALLED_APPS:
     import debug_toolbar
     urlpatterns.append(path('__debug__/', include(debug_toolbar.urls)))
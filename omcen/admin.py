@@ -1,18 +1,56 @@
-from omcen.models import OmcenUser, Service, ServiceGroup, Plan
-from django.contrib import admin
+import uuid as uuid_lib
+from functools import reduce
+from operator import or_
+
+from omcen.counters import rebuild_counters
+from omcen.entitlements import invalidate_entitlements
+from omcen.lifecycle import set_services_active
+from omcen.models import OmcenUser, Service, ServiceGroup, Plan, ServiceInUse, PlanRetirement, Invoice, InvoiceLine
+from omcen.pagination import EstimatedCountPaginator
+from omcen.retirement import enqueue_retirement
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import Q
 from django.utils.translation import gettext_lazy as _
 
 
+class ScalableAdminMixin:
+    """
+    Changelist settings that keep admin pages flat on large tables: counts
+    come from EstimatedCountPaginator, the unfiltered total is not counted
+    again, and search only uses lookups an index can serve (an exact UUID
+    on ``uuid_search_fields``, or else a case-sensitive prefix of each
+    ``search_fields`` entry, i.e. LIKE 'term%' on PostgreSQL's
+    varchar_pattern_ops indexes).
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    uuid_search_fields = ('pk',)
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        try:
+            value = uuid_lib.UUID(term)
+        except ValueError:
+            pass
+        else:
+            return queryset.filter(reduce(or_, (Q(**{field: value}) for field in self.uuid_search_fields))), False
+
+        query = reduce(or_, (Q(**{f'{field}__startswith': term}) for field in self.search_fields))
+        return queryset.filter(query), False
+
+
 @admin.register(OmcenUser)
-class OmcenUserAdmin(UserAdmin):
+class OmcenUserAdmin(ScalableAdminMixin, UserAdmin):
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
         (_('Personal info'), {'fields': ('first_name', 'last_name', 'email')}),
         (_('Permissions'), {
             'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions'),
         }),
-        (_('Important dates'), {'fields': ('last_login', 'date_joined')}),
+        (_('Important dates'), {'fields': ('last_login', 'creation_date')}),
     )
     add_fieldsets = (
         (None, {
@@ -22,11 +60,166 @@ class OmcenUserAdmin(UserAdmin):
     )
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff')
     list_filter = ('is_staff', 'is_superuser', 'is_active', 'groups')
-    search_fields = ('username', 'first_name', 'last_name', 'email')
+    # username・email は一意制約のインデックスで前方一致検索できる
+    search_fields = ('username', 'email')
     ordering = ('username',)
     filter_horizontal = ('groups', 'user_permissions',)
 
 
-admin.site.register(Service)
-admin.site.register(Plan)
-admin.site.register(ServiceGroup)
+@admin.register(Service)
+class ServiceAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('service_name', 'is_active', 'subscribers', 'mrr', 'updated_at')
+    list_filter = ('is_active',)
+    list_select_related = ('counter',)
+    search_fields = ('service_name',)
+    ordering = ('service_name',)
+    actions = ('enable_services', 'disable_services', 'disable_services_and_subscriptions')
+
+    def set_active(self, request, queryset, active, cascade=False):
+        result = set_services_active(queryset.values_list('pk', flat=True), active, cascade=cascade)
+        self.message_user(
+            request,
+            f'サービス {result.services} 件、プラン {result.plans} 件、サービスグループ {result.service_groups} 件を'
+            f'{"有効" if active else "無効"}にしました。(登録解除した加入 {result.subscriptions} 件)',
+            messages.SUCCESS,
+        )
+
+    @admin.display(description=_('加入者数'), ordering='counter__subscribers')
+    def subscribers(self, obj):
+        return obj.counter.subscribers if hasattr(obj, 'counter') else 0
+
+    @admin.display(description=_('月間売上'), ordering='counter__mrr')
+    def mrr(self, obj):
+        return obj.counter.mrr if hasattr(obj, 'counter') else 0
+
+    @admin.action(description=_('選択したサービスを全プランごと有効化'))
+    def enable_services(self, request, queryset):
+        self.set_active(request, queryset, True)
+
+    @admin.action(description=_('選択したサービスを全プランごと無効化'))
+    def disable_services(self, request, queryset):
+        self.set_active(request, queryset, False)
+
+    @admin.action(description=_('選択したサービスを全プランごと無効化し、加入も登録解除'))
+    def disable_services_and_subscriptions(self, request, queryset):
+        self.set_active(request, queryset, False, cascade=True)
+
+
+@admin.register(Plan)
+class PlanAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('plan_name', 'service', 'price', 'is_active')
+    list_filter = ('is_active',)
+    list_select_related = ('service',)
+    search_fields = ('service__service_name', 'plan_name')
+    autocomplete_fields = ('service',)
+    actions = ('retire_plans',)
+
+    def get_queryset(self, request):
+        # 自動補完の候補表示にもサービス名を使う
+        return super().get_queryset(request).select_related('service')
+
+    def get_actions(self, request):
+        # 一括削除はサービスグループと加入を連鎖削除してしまうため、廃止 (retire_plans) だけにする
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    @admin.action(description=_('選択したプランを無効化し、加入をバックグラウンドで登録解除'))
+    def retire_plans(self, request, queryset):
+        for plan in queryset:
+            enqueue_retirement(plan)
+        self.message_user(request, f'プラン {len(queryset)} 件の廃止を受け付けました。', messages.SUCCESS)
+
+
+@admin.register(ServiceGroup)
+class ServiceGroupAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('service', 'plan', 'is_active', 'updated_at')
+    list_filter = ('is_active',)
+    list_select_related = ('service', 'plan__service')
+    search_fields = ('service__service_name', 'plan__plan_name')
+    autocomplete_fields = ('service', 'plan')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('service', 'plan__service')
+
+
+@admin.register(ServiceInUse)
+class ServiceInUseAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('omcen_user', 'service', 'plan', 'is_active', 'created_at')
+    list_filter = ('is_active',)
+    list_select_related = ('omcen_user', 'service', 'omcen_service__plan')
+    search_fields = ('omcen_user__username', 'omcen_user__email', 'service__service_name')
+    uuid_search_fields = ('pk', 'omcen_user')
+    # ユーザーは件数が多いため ID 入力にし、候補の検索もしない
+    raw_id_fields = ('omcen_user',)
+    autocomplete_fields = ('omcen_service',)
+
+    @admin.display(description=_('プラン'), ordering='omcen_service__plan__plan_name')
+    def plan(self, obj):
+        return obj.omcen_service.plan.plan_name
+
+    # 管理画面での直接の編集は増減を追わず、関係するサービスの集計を数え直す
+    def save_model(self, request, obj, form, change):
+        previous = ServiceInUse.objects.filter(pk=obj.pk).values_list('service_id', flat=True).first() if change else None
+        # プランの変更でサービスが変わる場合も複製したサービスを合わせる
+        obj.service_id = obj.omcen_service.service_id
+        super().save_model(request, obj, form, change)
+        invalidate_entitlements(obj.omcen_user_id)
+        rebuild_counters({obj.service_id, previous} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_entitlements(obj.omcen_user_id)
+        rebuild_counters([obj.service_id])
+
+    def delete_queryset(self, request, queryset):
+        rows = set(queryset.values_list('omcen_user_id', 'service_id'))
+        super().delete_queryset(request, queryset)
+        invalidate_entitlements(*{user_id for user_id, _ in rows})
+        rebuild_counters({service_id for _, service_id in rows})
+
+
+@admin.register(PlanRetirement)
+class PlanRetirementAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('plan_name', 'service', 'target_plan', 'delete_plan', 'status', 'progress', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    list_select_related = ('service', 'target_plan__service')
+    search_fields = ('service__service_name', 'plan_name')
+    readonly_fields = ('processed', 'total', 'last_error', 'finished_at')
+    raw_id_fields = ('plan', 'target_plan')
+
+    @admin.display(description=_('進捗'))
+    def progress(self, obj):
+        if not obj.total:
+            return f'{obj.processed}'
+        return f'{obj.processed}/{obj.total} ({obj.processed * 100 // obj.total}%)'
+
+    def has_add_permission(self, request):
+        # 登録はプランの削除画面・プランの管理アクションから行う
+        return False
+
+
+class InvoiceLineInline(admin.TabularInline):
+    model = InvoiceLine
+    fields = ('plan_name', 'price', 'started_at', 'ended_at', 'amount')
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Invoice)
+class InvoiceAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('omcen_user', 'period_start', 'period_end', 'total', 'created_at')
+    list_filter = ('period_start',)
+    list_select_related = ('omcen_user',)
+    search_fields = ('omcen_user__username', 'omcen_user__email')
+    uuid_search_fields = ('pk', 'omcen_user')
+    readonly_fields = ('omcen_user', 'period_start', 'period_end', 'total')
+    inlines = (InvoiceLineInline,)
+
+    def has_add_permission(self, request):
+        # 請求は omcen_billing_run だけが作成する
+        return False
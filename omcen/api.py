@@ -0,0 +1,122 @@
+import hashlib
+import hmac
+import json
+import uuid as uuid_lib
+
+import msgpack
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from omcen.catalog import get_catalog
+from omcen.entitlements import lookup_entitlements
+from omcen.queries import query_budget
+from omcen.routers import read_replica
+
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class BadRequest(Exception):
+    """The request body or query string could not be read as a list of checks."""
+
+
+def _authorize(request):
+    # メトリクスと同じく、スタッフのセッションかサブサービス用のトークンで認可する
+    token = getattr(settings, 'OMCEN_API_TOKEN', None)
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return
+    if not (request.user.is_authenticated and request.user.is_staff):
+        raise PermissionDenied
+
+
+def _read_checks(request):
+    """Return the requested ``(user uuid, service name)`` pairs, in request order."""
+    if request.method == 'POST':
+        content_type = request.content_type
+        try:
+            if content_type in MSGPACK_CONTENT_TYPES:
+                body = msgpack.unpackb(request.body, raw=False)
+            else:
+                body = json.loads(request.body)
+        except ValueError as e:
+            raise BadRequest(f'Malformed request body: {e}')
+        checks = body.get('checks') if isinstance(body, dict) else None
+        if not isinstance(checks, list):
+            raise BadRequest('The body must be an object with a "checks" list.')
+        raw = []
+        for check in checks:
+            if not isinstance(check, dict):
+                raise BadRequest('Each check must be an object with "user" and "service".')
+            raw.append((check.get('user'), check.get('service')))
+    else:
+        # GET は ?check=<ユーザーUUID>:<サービス名> を繰り返す
+        raw = [tuple(check.split(':', 1)) if ':' in check else (check, None) for check in request.GET.getlist('check')]
+
+    limit = getattr(settings, 'OMCEN_API_MAX_CHECKS', 5000)
+    if len(raw) > limit:
+        raise BadRequest(f'At most {limit} checks are allowed per request.')
+
+    pairs = []
+    for index, (user, service_name) in enumerate(raw):
+        if not isinstance(service_name, str) or not service_name:
+            raise BadRequest(f'Check {index} has no service name.')
+        try:
+            pairs.append((uuid_lib.UUID(str(user)), service_name))
+        except ValueError:
+            raise BadRequest(f'Check {index} has an invalid user UUID: {user!r}')
+    return pairs
+
+
+def _render(request, data, status=200):
+    if any(content_type in request.headers.get('Accept', '') for content_type in MSGPACK_CONTENT_TYPES):
+        response = HttpResponse(msgpack.packb(data, use_bin_type=True), content_type='application/msgpack', status=status)
+    else:
+        response = HttpResponse(
+            json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+            content_type='application/json', status=status,
+        )
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+# サブサービス向けの加入状況一括確認 API (読み取り専用)
+# 大量の確認は URL に収まらないため POST でも受け付ける。304 を返すのは GET / HEAD の If-None-Match だけ
+@csrf_exempt
+@require_http_methods(['GET', 'HEAD', 'POST'])
+@read_replica
+@query_budget(1)
+def api_entitlements(request):
+    _authorize(request)
+    try:
+        pairs = _read_checks(request)
+    except BadRequest as e:
+        return _render(request, {'error': str(e)}, status=400)
+
+    catalog = get_catalog()
+    found = lookup_entitlements(pairs)
+    results = []
+    for user_id, service_name in pairs:
+        service_group = found.get((user_id, service_name))
+        result = {'user': str(user_id), 'service': service_name, 'entitled': service_group is not None}
+        if service_group is not None:
+            result.update({
+                'service_group': str(service_group.pk),
+                'plan': str(service_group.plan.pk),
+                'plan_name': service_group.plan.plan_name,
+                'price': service_group.plan.price,
+            })
+        results.append(result)
+
+    response = _render(request, {'catalog_version': catalog.version, 'results': results})
+    etag = quote_etag(hashlib.md5(response.content).hexdigest())
+    if request.method in ('GET', 'HEAD') and etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+        patch_vary_headers(response, ['Accept'])
+    response['ETag'] = etag
+    # 呼び出し元ごとの結果のため共有キャッシュには置かせず、毎回再検証させる
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class OmcenConfig(AppConfig):
+    name = 'omcen'
+
+    def ready(self):
+        from omcen import checks, metrics, signals  # noqa: F401
+
+        # 前回の起動で終了したワーカーのメトリクスを起動時に片付ける
+        metrics.prune()
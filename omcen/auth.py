@@ -0,0 +1,114 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
+
+from omcen import metrics
+
+USER_VERSION_KEY = 'omcen:user:{}:version'
+
+_lock = threading.Lock()
+_users = OrderedDict()
+_stats = {'hits': 0, 'misses': 0}
+
+metrics.register_collector(lambda: {
+    'counters': {f'omcen_user_cache_{name}_total': value for name, value in user_cache_stats().items()},
+})
+
+
+def user_cache_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def _version(user_id):
+    key = USER_VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def _cached_user(request, user_id, version):
+    with _lock:
+        entry = _users.get(user_id)
+    if entry is None:
+        return None
+    cached_version, expires_at, user = entry
+    if cached_version != version or expires_at < time.monotonic():
+        return None
+    # ModelBackend.get_user と同じく、停止されたユーザーはキャッシュからも返さない
+    if not user.is_active:
+        return None
+
+    # パスワード変更などで無効になったセッションは通常の経路で破棄させる
+    session_hash = request.session.get(HASH_SESSION_KEY)
+    if not (session_hash and constant_time_compare(session_hash, user.get_session_auth_hash())):
+        return None
+
+    with _lock:
+        if user_id in _users:
+            _users.move_to_end(user_id)
+    # 各リクエストで変更されてもキャッシュに影響しないよう複製を返す
+    return copy.copy(user)
+
+
+def _remember(user, version):
+    entry = (version, time.monotonic() + getattr(settings, 'OMCEN_USER_CACHE_TTL', 300), copy.copy(user))
+    with _lock:
+        _users[str(user.pk)] = entry
+        _users.move_to_end(str(user.pk))
+        while len(_users) > getattr(settings, 'OMCEN_USER_CACHE_SIZE', 10000):
+            _users.popitem(last=False)
+
+
+def get_user(request):
+    """
+    Drop-in for django.contrib.auth.get_user() that keeps authenticated users
+    in a per-process cache keyed by uuid. A shared version key in the Django
+    cache lets every process see saves made elsewhere, so the cache is
+    only used with ``OMCEN_USER_CACHE`` (which requires a shared cache).
+    """
+    if not getattr(settings, 'OMCEN_USER_CACHE', False):
+        return auth.get_user(request)
+
+    try:
+        user_id = str(auth._get_user_session_key(request))
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+
+    # DB から読む前にバージョンを取得し、読み込み中の更新を取りこぼさない
+    version = _version(user_id)
+    if backend_path in settings.AUTHENTICATION_BACKENDS:
+        user = _cached_user(request, user_id, version)
+        if user is not None:
+            with _lock:
+                _stats['hits'] += 1
+            return user
+
+    with _lock:
+        _stats['misses'] += 1
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        _remember(user, version)
+
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop the cached user everywhere once the current transaction commits."""
+    def evict():
+        cache.set(USER_VERSION_KEY.format(user_id), time.time_ns(), None)
+        with _lock:
+            _users.pop(str(user_id), None)
+
+    transaction.on_commit(evict)
@@ -0,0 +1,70 @@
+"""
+PostgreSQL backend that checks connections out of an in-process pool.
+
+    DATABASES['default'] = {
+        'ENGINE': 'omcen.backends.postgresql_pool',
+        ...,
+        'CONN_MAX_AGE': 0,
+        'POOL': {'MIN_SIZE': 2, 'MAX_SIZE': 20, 'TIMEOUT': 5, 'MAX_LIFETIME': 1800, 'CHECK_INTERVAL': 30},
+    }
+
+With CONN_MAX_AGE = 0 Django "closes" the connection at the end of every
+request, which returns it to the pool, so all threads of a worker share
+MAX_SIZE connections instead of holding one each.
+"""
+import psycopg2.extensions
+from django.db.backends.postgresql import base
+
+from omcen.pool import ConnectionPool, get_pool
+
+POOL_DEFAULTS = {
+    'MIN_SIZE': 0,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 5.0,
+    'MAX_LIFETIME': 1800.0,
+    'CHECK_INTERVAL': 30.0,
+}
+
+
+def _check(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+def _reset(connection):
+    if connection.closed:
+        raise psycopg2.InterfaceError('connection already closed')
+    # 途中のトランザクションを残したまま次の利用者に渡さない
+    if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _pool(self, conn_params):
+        options = {**POOL_DEFAULTS, **self.settings_dict.get('POOL', {})}
+
+        return get_pool(self.alias, lambda: ConnectionPool(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            min_size=options['MIN_SIZE'],
+            max_size=options['MAX_SIZE'],
+            timeout=options['TIMEOUT'],
+            max_lifetime=options['MAX_LIFETIME'],
+            check_interval=options['CHECK_INTERVAL'],
+            check=_check,
+            reset=_reset,
+        ))
+
+    def get_new_connection(self, conn_params):
+        connection = self._pool(conn_params).getconn()
+        # 他のスレッドが作成した接続の場合もあるため、接続ごとの値をここで設定し直す
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = self._pool(self.get_connection_params())
+        # トランザクション中に閉じられた場合、Django は self.connection を保持し続けるため
+        # プールには戻さずに破棄する
+        with self.wrap_database_errors:
+            pool.putconn(self.connection, discard=self.in_atomic_block)
@@ -0,0 +1,376 @@
+import json
+import statistics
+import time
+import types
+import uuid as uuid_lib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, path, include
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from omcen.billing import Period, run_billing
+from omcen.bulk import batched
+from omcen.counters import rebuild_counters
+from omcen.factory import OmcenUserFactory, ServiceFactory, PlanFactory, ServiceGroupFactory, ServiceInUseFactory
+from omcen.models import OmcenUser, Service, Plan, ServiceGroup, ServiceInUse, Invoice, InvoiceLine
+from omcen.search import normalize_search_text
+
+BENCH_PREFIX = 'bench-'
+# 本番と同じくセッション・ログインユーザーをキャッシュする構成で計測する。
+# ベンチマークは1プロセスで動くため、LocMemCache でも無効化は届く
+SHARED_CACHE_SETTINGS = {
+    'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db',
+    'OMCEN_USER_CACHE': True,
+}
+_UUID_BASE = 0xBE7C << 112
+
+
+def bench_uuid(kind, n):
+    # 再現できるよう、種類と連番から UUID を決める
+    return uuid_lib.UUID(int=_UUID_BASE | (kind << 96) | n)
+
+
+def bench_user_id(n):
+    return bench_uuid(1, n)
+
+
+def seed(users, services, plans, subscriptions, batch_size=10000, stdout=None):
+    """
+    Insert a synthetic dataset with bulk_create. Objects are built with the
+    factories and generated lazily, so memory stays flat for millions of rows.
+    """
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    def insert(model, objs):
+        count = 0
+        for batch in batched(objs, batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(batch, batch_size=batch_size)
+            count += len(batch)
+        log(f'{model.__name__}: {count}')
+
+    service_objs = []
+    for i in range(services):
+        name = f'{BENCH_PREFIX}service-{i}'
+        service_objs.append(ServiceFactory.build(uuid=bench_uuid(2, i), service_name=name, search_name=normalize_search_text(name)))
+    insert(Service, service_objs)
+
+    plan_objs = [
+        PlanFactory.build(uuid=bench_uuid(3, i), service=service_objs[i % services], plan_name=f'{BENCH_PREFIX}plan-{i}')
+        for i in range(plans)
+    ]
+    insert(Plan, plan_objs)
+    group_objs = [
+        ServiceGroupFactory.build(uuid=bench_uuid(4, i), plan=plan, service=plan.service)
+        for i, plan in enumerate(plan_objs)
+    ]
+    insert(ServiceGroup, group_objs)
+
+    insert(OmcenUser, (
+        OmcenUserFactory.build(
+            uuid=bench_user_id(i),
+            username=f'{BENCH_PREFIX}user-{i}',
+            is_staff=i == 0,
+        )
+        for i in range(users)
+    ))
+
+    groups_by_service = [[] for _ in range(services)]
+    for i, group in enumerate(group_objs):
+        groups_by_service[i % services].append(group)
+
+    def subscription_objs():
+        # ユーザーごとに異なるサービスを割り当て、有効な登録の一意制約を満たす
+        for n in range(min(subscriptions, users * services)):
+            user_index, k = n % users, n // users
+            service_index = (user_index + k) % services
+            candidates = groups_by_service[service_index]
+            if not candidates:
+                continue
+            group = candidates[(user_index + k) % len(candidates)]
+            yield ServiceInUseFactory.build(
+                uuid=bench_uuid(5, n),
+                omcen_user=OmcenUser(uuid=bench_user_id(user_index)),
+                omcen_service=group,
+                service=group.service,
+            )
+
+    insert(ServiceInUse, subscription_objs())
+    # bulk_create は集計を増減させないため、投入したサービスの集計を数え直す
+    rebuild_counters(bench_uuid(2, i) for i in range(services))
+
+
+def clean():
+    ServiceInUse.objects.filter(omcen_user__username__startswith=BENCH_PREFIX).delete()
+    Service.objects.filter(service_name__startswith=BENCH_PREFIX).delete()
+    OmcenUser.objects.filter(username__startswith=BENCH_PREFIX).delete()
+
+
+@contextmanager
+def count_fetched_rows():
+    """Count the rows returned by fetchone/fetchmany/fetchall on every cursor."""
+    counter = {'rows': 0}
+    originals = {name: getattr(CursorWrapper, name, None) for name in ('fetchone', 'fetchmany', 'fetchall')}
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        counter['rows'] += row is not None
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        counter['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        counter['rows'] += len(rows)
+        return rows
+
+    CursorWrapper.fetchone, CursorWrapper.fetchmany, CursorWrapper.fetchall = fetchone, fetchmany, fetchall
+    try:
+        yield counter
+    finally:
+        for name, original in originals.items():
+            if original is None:
+                delattr(CursorWrapper, name)
+            else:
+                setattr(CursorWrapper, name, original)
+
+
+def bench_urlconf():
+    """
+    Return ROOT_URLCONF extended with a '<service name>:top' stub for every
+    seeded service; real services provide it from their own app.
+    """
+    urlconf = types.ModuleType('omcen_benchmark_urls')
+    urlconf.urlpatterns = list(import_string(f'{settings.ROOT_URLCONF}.urlpatterns'))
+    for service_name in Service.objects.filter(service_name__startswith=BENCH_PREFIX).values_list('service_name', flat=True):
+        top = path('', lambda request: HttpResponse(), name='top')
+        urlconf.urlpatterns.append(path(f'{service_name}/', include(([top], service_name))))
+    return urlconf
+
+
+def bench_requests():
+    """Return ``{label: url}`` covering every route of omcen/urls.py on the seeded data."""
+    user = OmcenUser.objects.get(pk=bench_user_id(0))
+    service_in_use = ServiceInUse.objects.active_for(user).select_related('omcen_service__service').first()
+    service_group = service_in_use.omcen_service if service_in_use else ServiceGroup.objects.filter(
+        service__service_name__startswith=BENCH_PREFIX).first()
+    service, plan_id = service_group.service, service_group.plan_id
+
+    urls = {
+        'omcen:service_control': reverse('omcen:service_control'),
+        'omcen:service_control (search)': reverse('omcen:service_control') + f'?service_name={BENCH_PREFIX}service-1',
+        'omcen:service_detail': reverse('omcen:service_detail', args=[service.pk]),
+        'omcen:create_service': reverse('omcen:create_service'),
+        'omcen:create_plan': reverse('omcen:create_plan', args=[service.pk]),
+        'omcen:update_plan': reverse('omcen:update_plan', args=[service.pk, plan_id]),
+        'omcen:delete_plan': reverse('omcen:delete_plan', args=[service.pk, plan_id]),
+        'omcen:switching_enabled': reverse('omcen:switching_enabled', args=[service.pk, plan_id, 'enabled']),
+        'omcen:service_list': reverse('omcen:service_list'),
+        'omcen:plan_selection': reverse('omcen:plan_selection', args=[service.service_name]),
+        'omcen:service_subscribe': reverse('omcen:service_subscribe', args=[service_group.pk]),
+        'omcen:service_in_use_list': reverse('omcen:service_in_use_list'),
+        'omcen:omcen_user_deactivate': reverse('omcen:omcen_user_deactivate', args=[user.pk]),
+        'omcen:my_page': reverse('omcen:my_page'),
+        'omcen:change_profile': reverse('omcen:change_profile', args=[user.pk]),
+        'omcen:metrics': reverse('omcen:metrics'),
+        'omcen:api_entitlements': reverse('omcen:api_entitlements') + f'?check={user.pk}:{service.service_name}',
+    }
+    if service_in_use is not None:
+        urls['omcen:service_unsubscribe'] = reverse('omcen:service_unsubscribe', args=[service_in_use.pk])
+
+    return user, urls
+
+
+def run(repeat=5, stdout=None, api_checks=1000):
+    # 計測値に QueryInspector のスタック走査を含めない
+    with override_settings(ROOT_URLCONF=bench_urlconf(), OMCEN_QUERY_INSPECTOR=False, **SHARED_CACHE_SETTINGS):
+        return _run(repeat, stdout, api_checks)
+
+
+def _run(repeat, stdout, api_checks=0):
+    user, urls = bench_requests()
+    client = Client(raise_request_exception=False)
+    client.force_login(user)
+
+    results = {}
+    for label, url in urls.items():
+        client.get(url)
+        timings = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries, count_fetched_rows() as rows:
+                started = time.perf_counter()
+                response = client.get(url)
+                elapsed = time.perf_counter() - started
+            timings.append(elapsed * 1000)
+
+        timings.sort()
+        results[label] = {
+            'url': url,
+            'status': response.status_code,
+            'median_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+            'queries': len(queries),
+            'rows': rows['rows'],
+            'bytes': len(response.content),
+        }
+        # 再検証のリクエストで queries_log が消えるため、クエリ数を記録してから計測する
+        revalidation = _revalidate(client, url, response, repeat)
+        if revalidation is not None:
+            results[label]['revalidate'] = revalidation
+        if stdout is not None:
+            result = results[label]
+            line = (
+                f'{label:<34} {result["status"]:>4} {result["median_ms"]:>10.2f}ms '
+                f'{result["queries"]:>5}q {result["rows"]:>8}rows {result["bytes"]:>8}B'
+            )
+            if revalidation is not None:
+                line += f'  (If-None-Match: {revalidation["status"]} {revalidation["median_ms"]:.2f}ms {revalidation["bytes"]}B)'
+            stdout.write(line)
+
+    if api_checks:
+        results.update(api_throughput(client, api_checks, repeat, stdout))
+
+    return results
+
+
+def _revalidate(client, url, response, repeat):
+    # ETag を返す画面は、ブラウザの再検証 (If-None-Match) のコストも計測する
+    etag = response.get('ETag')
+    if etag is None:
+        return None
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        revalidated = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return {
+        'status': revalidated.status_code,
+        'median_ms': round(statistics.median(timings), 3),
+        'bytes': len(revalidated.content),
+    }
+
+
+def api_checks(count):
+    """Return ``count`` (user uuid, service name) pairs over the seeded users, about one entitled per user."""
+    services = sorted(
+        Service.objects.filter(service_name__startswith=BENCH_PREFIX).values_list('service_name', flat=True),
+        key=lambda name: int(name.rsplit('-', 1)[1]),
+    )
+    users = OmcenUser.objects.filter(username__startswith=BENCH_PREFIX).count()
+    return [(str(bench_user_id(i % users)), services[i % len(services)]) for i in range(count)]
+
+
+def api_throughput(client, count, repeat=5, stdout=None):
+    """
+    Compare checking ``count`` entitlements with one batch call of the
+    entitlement API against one call per (user, service) pair.
+    """
+    checks = api_checks(count)
+    url = reverse('omcen:api_entitlements')
+    body = json.dumps({'checks': [{'user': user, 'service': service} for user, service in checks]})
+
+    def batch():
+        return [client.post(url, body, content_type='application/json')]
+
+    def single_calls():
+        return [client.get(url, {'check': f'{user}:{service}'}) for user, service in checks]
+
+    results = {}
+    for label, call in ((f'omcen:api_entitlements (batch of {count})', batch),
+                        (f'omcen:api_entitlements ({count} single calls)', single_calls)):
+        call()
+        timings = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries, count_fetched_rows() as rows:
+                started = time.perf_counter()
+                responses = call()
+                elapsed = time.perf_counter() - started
+            timings.append(elapsed * 1000)
+
+        timings.sort()
+        median_ms = statistics.median(timings)
+        results[label] = {
+            'url': url,
+            'status': responses[-1].status_code,
+            'median_ms': round(median_ms, 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+            'queries': len(queries),
+            'rows': rows['rows'],
+            'bytes': sum(len(response.content) for response in responses),
+            'checks_per_second': round(count / (median_ms / 1000)),
+        }
+        if stdout is not None:
+            result = results[label]
+            stdout.write(
+                f'{label:<34} {result["status"]:>4} {result["median_ms"]:>10.2f}ms '
+                f'{result["queries"]:>5}q {result["rows"]:>8}rows {result["bytes"]:>8}B  {result["checks_per_second"]} checks/s'
+            )
+
+    return results
+
+
+def billing_throughput(workers=(1,), chunk_size=None, stdout=None):
+    """
+    Run the billing of the current month once per entry of ``workers``,
+    removing the seeded users' invoices before each run.
+    """
+    # 合成データの加入は投入時に作られるため、当月を請求期間として日割りも計算させる
+    period = Period.month(f'{timezone.localdate():%Y-%m}')
+    results = {}
+    for count in workers:
+        bench_invoices = Invoice.objects.filter(period_start=period.start, omcen_user__username__startswith=BENCH_PREFIX)
+        InvoiceLine.objects.filter(invoice__in=bench_invoices).delete()
+        bench_invoices.delete()
+
+        result = run_billing(period, workers=count, chunk_size=chunk_size)
+        label = f'billing run ({count} workers)'
+        results[label] = {
+            'seconds': round(result.seconds, 3),
+            'chunks': result.chunks,
+            'subscriptions': result.subscriptions,
+            'invoices': result.invoices,
+            'subscriptions_per_second': round(result.subscriptions / max(result.seconds, 1e-9)),
+        }
+        if stdout is not None:
+            stdout.write(
+                f'{label:<34} {result.seconds:>10.2f}s {result.subscriptions:>9} subscriptions '
+                f'{result.invoices:>8} invoices  {results[label]["subscriptions_per_second"]} subscriptions/s'
+            )
+
+    return results
+
+
+def compare(results, baseline, threshold=1.2):
+    """Return the regressions of ``results`` against ``baseline``."""
+    regressions = []
+    for label, result in results.items():
+        before = baseline.get(label)
+        if before is None:
+            continue
+        if 'seconds' in result:
+            # 請求処理は1回の実行時間だけを比べる
+            if before['seconds'] and result['seconds'] / before['seconds'] > threshold:
+                regressions.append(f'{label}: {before["seconds"]}s -> {result["seconds"]}s')
+            continue
+        if result['queries'] > before['queries']:
+            regressions.append(f'{label}: queries {before["queries"]} -> {result["queries"]}')
+        if before['median_ms'] and result['median_ms'] / before['median_ms'] > threshold:
+            regressions.append(f'{label}: median {before["median_ms"]}ms -> {result["median_ms"]}ms')
+        if result['rows'] > before['rows'] * threshold:
+            regressions.append(f'{label}: rows {before["rows"]} -> {result["rows"]}')
+
+    return regressions
@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from omcen.bulk import copy_insert, supports_copy
+from omcen.models import Invoice, InvoiceLine, ServiceGroup, ServiceInUse
+
+CHUNK_SIZE = 10000
+INSERT_BATCH_SIZE = 5000
+
+ChunkResult = namedtuple('ChunkResult', ['subscriptions', 'invoices', 'lines', 'total'])
+BillingResult = namedtuple('BillingResult', ['chunks', 'subscriptions', 'invoices', 'lines', 'total', 'seconds'])
+
+
+class Period(namedtuple('Period', ['start', 'end'])):
+    """A billing period of dates, ``[start, end)``."""
+
+    @classmethod
+    def month(cls, value):
+        """Parse ``'YYYY-MM'`` into the period of that calendar month."""
+        year, month = (int(part) for part in value.split('-'))
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+        return cls(start, end)
+
+    def bounds(self):
+        # 請求期間の日付は現在のタイムゾーン (Asia/Tokyo) の 0 時を境界とする
+        return tuple(timezone.make_aware(datetime.combine(day, datetime.min.time())) for day in self)
+
+
+def plan_table(service_group_ids=None):
+    """
+    Return ``{service group pk: (plan pk, plan name, price)}``, including
+    inactive groups, since deactivated subscriptions are still billed for
+    the part of the period they were active.
+    """
+    query_set = ServiceGroup.objects.order_by()
+    if service_group_ids is not None:
+        query_set = query_set.filter(pk__in=service_group_ids)
+    return {
+        pk: (plan_id, plan_name or '', price or 0)
+        for pk, plan_id, plan_name, price in query_set.values_list('pk', 'plan_id', 'plan__plan_name', 'plan__price')
+    }
+
+
+def billable(period):
+    """The subscriptions that were active at some point of ``period``."""
+    start, end = period.bounds()
+    # updated_at は解除後の保存 (管理画面での編集など) でも変わるため、解除日時で判定する
+    return ServiceInUse.objects.filter(Q(is_active=True) | Q(deactivated_at__gt=start), created_at__lt=end)
+
+
+def prorate(price, active, length):
+    """``price`` for the ``active`` part of a period of ``length``, rounded half up to an integer."""
+    if active <= timedelta(0):
+        return 0
+    active, length = active // timedelta(microseconds=1), length // timedelta(microseconds=1)
+    return (2 * price * active + length) // (2 * length)
+
+
+def chunk_bounds(period, chunk_size=CHUNK_SIZE):
+    """
+    Yield ``(after, upto)`` user pk ranges that split the billable
+    subscriptions into chunks of about ``chunk_size`` rows, walking the
+    ServiceInUse (omcen_user, ...) index in key order. A user's rows are
+    never split across chunks, and the last chunk has ``upto=None``.
+    """
+    query_set = billable(period).order_by('omcen_user_id').values_list('omcen_user_id', flat=True)
+    after = None
+    while True:
+        rest = query_set if after is None else query_set.filter(omcen_user_id__gt=after)
+        upto = rest[chunk_size - 1:chunk_size].first()
+        yield after, upto
+        if upto is None:
+            return
+        after = upto
+
+
+def bill_chunk(period, after, upto, plans):
+    """
+    Write the invoices of the users in ``(after, upto]`` for ``period`` in
+    one transaction. Users that already have an invoice for the period are
+    skipped, so a chunk (or a whole run) can safely be run again.
+    """
+    start, end = period.bounds()
+    rows = billable(period)
+    invoices_for_period = Invoice.objects.filter(period_start=period.start)
+    if after is not None:
+        rows = rows.filter(omcen_user_id__gt=after)
+        invoices_for_period = invoices_for_period.filter(omcen_user_id__gt=after)
+    if upto is not None:
+        rows = rows.filter(omcen_user_id__lte=upto)
+        invoices_for_period = invoices_for_period.filter(omcen_user_id__lte=upto)
+    rows = list(
+        rows.order_by('omcen_user_id', 'created_at')
+        .values_list('uuid', 'omcen_user_id', 'omcen_service_id', 'created_at', 'deactivated_at', 'is_active')
+    )
+
+    # プラン表の作成後に追加されたサービスグループだけ取得し直す
+    missing = {row[2] for row in rows} - plans.keys()
+    if missing:
+        plans = {**plans, **plan_table(missing)}
+
+    with transaction.atomic():
+        billed = set(invoices_for_period.values_list('omcen_user_id', flat=True))
+        invoices, lines = [], []
+        invoice = None
+        for pk, user_id, service_group_id, created_at, deactivated_at, is_active in rows:
+            if user_id in billed:
+                continue
+            if invoice is None or invoice.omcen_user_id != user_id:
+                invoice = Invoice(omcen_user_id=user_id, period_start=period.start, period_end=period.end, total=0)
+                invoices.append(invoice)
+
+            plan_id, plan_name, price = plans[service_group_id]
+            # プランの変更は旧加入の解除と新加入の登録になるため、それぞれを日割りで請求する
+            started_at = max(created_at, start)
+            ended_at = end if is_active else min(deactivated_at, end)
+            amount = prorate(price, ended_at - started_at, end - start)
+            lines.append(InvoiceLine(
+                invoice=invoice, service_in_use_id=pk, plan_id=plan_id, plan_name=plan_name, price=price,
+                started_at=started_at, ended_at=ended_at, amount=amount,
+            ))
+            invoice.total += amount
+
+        if supports_copy():
+            # 大量の INSERT 文を組み立てる代わりに、取り込みと同じ COPY で書き込む
+            copy_insert(Invoice, invoices)
+            copy_insert(InvoiceLine, lines)
+        else:
+            Invoice.objects.bulk_create(invoices, batch_size=INSERT_BATCH_SIZE)
+            InvoiceLine.objects.bulk_create(lines, batch_size=INSERT_BATCH_SIZE)
+
+    return ChunkResult(len(rows), len(invoices), len(lines), sum(invoice.total for invoice in invoices))
+
+
+_worker_plans = None
+
+
+def _init_worker(plans):
+    global _worker_plans
+    _worker_plans = plans
+
+
+def _bill_chunk_in_worker(period, after, upto):
+    return bill_chunk(period, after, upto, _worker_plans)
+
+
+def run_billing(period, workers=None, chunk_size=None, stdout=None):
+    """
+    Bill every user with a subscription active during ``period``. The
+    chunks are billed in a pool of ``workers`` processes (in this process
+    when ``workers`` is 1 or less), each with its own connection. Returns
+    a BillingResult. Invoices are written with COPY on PostgreSQL and with
+    bulk_create elsewhere.
+    """
+    workers = workers if workers is not None else getattr(settings, 'OMCEN_BILLING_WORKERS', None) or os.cpu_count()
+    if connections['default'].vendor == 'sqlite':
+        # SQLite は同時に1つの接続しか書き込めないため、このプロセスだけで処理する
+        workers = 1
+    chunk_size = chunk_size or getattr(settings, 'OMCEN_BILLING_CHUNK_SIZE', CHUNK_SIZE)
+    started = time.monotonic()
+    plans = plan_table()
+    bounds = list(chunk_bounds(period, chunk_size))
+    results = []
+
+    def log(result):
+        results.append(result)
+        if stdout is not None:
+            stdout.write(
+                f'chunk {len(results)}/{len(bounds)}: {result.subscriptions} subscriptions, '
+                f'{result.invoices} invoices, total {result.total}'
+            )
+
+    if workers <= 1:
+        for after, upto in bounds:
+            log(bill_chunk(period, after, upto, plans))
+    else:
+        # fork した子プロセスが親の接続を共有しないよう、先に閉じておく
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker, initargs=(plans,),
+        ) as pool:
+            futures = [pool.submit(_bill_chunk_in_worker, period, after, upto) for after, upto in bounds]
+            for future in as_completed(futures):
+                log(future.result())
+
+    return BillingResult(
+        len(bounds),
+        sum(result.subscriptions for result in results),
+        sum(result.invoices for result in results),
+        sum(result.lines for result in results),
+        sum(result.total for result in results),
+        time.monotonic() - started,
+    )
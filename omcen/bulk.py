@@ -0,0 +1,141 @@
+import csv
+import io
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from django.db import connections
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_rows(path, fmt):
+    """Yield one dict per CSV row / JSON line without loading the file."""
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+    try:
+        if fmt == 'csv':
+            yield from csv.DictReader(stream)
+        else:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+class RowWriter:
+    def __init__(self, stream, fmt, fieldnames):
+        self.stream = stream
+        self.fmt = fmt
+        self.fieldnames = fieldnames
+        if fmt == 'csv':
+            self.writer = csv.writer(stream)
+            self.writer.writerow(fieldnames)
+
+    def write(self, values):
+        if self.fmt == 'csv':
+            self.writer.writerow(values)
+        else:
+            self.stream.write(json.dumps(dict(zip(self.fieldnames, values)), ensure_ascii=False, default=str))
+            self.stream.write('\n')
+
+
+class Checkpoint:
+    """
+    Number of input rows already committed, stored next to the import so an
+    interrupted run can resume. Written atomically after each batch commit.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.rows = 0
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('source') == source:
+                self.rows = state['rows']
+
+    def save(self, rows):
+        self.rows = rows
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': self.source, 'rows': rows}, f)
+        os.replace(tmp_path, self.path)
+
+
+class RateReporter:
+    def __init__(self, stdout, label, every=10):
+        self.stdout = stdout
+        self.label = label
+        self.every = every
+        self.started = time.monotonic()
+        self.rows = 0
+        self.batches = 0
+
+    @property
+    def rate(self):
+        return self.rows / max(time.monotonic() - self.started, 1e-9)
+
+    def add(self, rows):
+        self.rows += rows
+        self.batches += 1
+        if self.batches % self.every == 0:
+            self.report()
+
+    def report(self):
+        self.stdout.write(f'{self.label}: {self.rows} rows ({self.rate:.0f} rows/s)')
+
+
+def supports_copy(using='default'):
+    return connections[using].vendor == 'postgresql'
+
+
+def copy_field(value):
+    """
+    One COPY (FORMAT csv) field. Every value is quoted so that an empty string
+    stays an empty string; only ``None`` is left as an unquoted empty field,
+    which COPY reads as NULL.
+    """
+    if value is None:
+        return ''
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def copy_insert(model, objs, using='default'):
+    """
+    Insert ``objs`` with PostgreSQL COPY through a temporary table so that
+    rows conflicting with a unique constraint are skipped like
+    ``bulk_create(ignore_conflicts=True)``. Returns the number of rows inserted.
+    """
+    connection = connections[using]
+    fields = [field for field in model._meta.concrete_fields]
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+
+    buffer = io.StringIO()
+    for obj in objs:
+        values = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+        buffer.write(','.join(copy_field(value) for value in values) + '\n')
+    buffer.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE omcen_copy_buffer (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+        cursor.cursor.copy_expert(f'COPY omcen_copy_buffer ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        cursor.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM omcen_copy_buffer ON CONFLICT DO NOTHING')
+        inserted = cursor.rowcount
+        cursor.execute('DROP TABLE omcen_copy_buffer')
+
+    return inserted
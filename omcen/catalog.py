@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+from django.utils.functional import cached_property
+
+from omcen.models import Service, Plan, ServiceGroup
+from omcen.routers import use_primary
+
+CATALOG_VERSION_KEY = 'omcen:catalog:version'
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+class CatalogSnapshot:
+    """
+    Immutable, in-process view of every Service, Plan and ServiceGroup.
+    The catalog is only changed from the admin screens, so the read views
+    share one snapshot instead of querying on every request.
+    """
+
+    def __init__(self, version, services, plans, service_groups):
+        self.version = version
+        self.services = {service.pk: service for service in services}
+        self.plans = {}
+        self.service_groups = {}
+        self._plans_by_service = defaultdict(list)
+        self._groups_by_service_name = defaultdict(list)
+
+        # 3 つの表は別々のクエリで読むため、途中でコミットされた行は親が読めていないことがある。
+        # その行は捨てておき、コミット後の版番号の更新で作り直されたスナップショットに載せる
+        for plan in plans:
+            if plan.service_id not in self.services:
+                continue
+            plan.service = self.services[plan.service_id]
+            self.plans[plan.pk] = plan
+            self._plans_by_service[plan.service_id].append(plan)
+
+        for service_group in service_groups:
+            if service_group.service_id not in self.services or service_group.plan_id not in self.plans:
+                continue
+            service_group.service = self.services[service_group.service_id]
+            service_group.plan = self.plans[service_group.plan_id]
+            self.service_groups[service_group.pk] = service_group
+            self._groups_by_service_name[service_group.service.service_name].append(service_group)
+
+        for groups in self._groups_by_service_name.values():
+            groups.sort(key=lambda group: (group.plan.plan_name or '', group.pk))
+
+        self.service_uuid_by_name = {service.service_name: service.pk for service in services}
+        self._active_services = sorted(
+            (service for service in services if service.is_active),
+            key=lambda service: (service.service_name, service.pk)
+        )
+        # サブサービスのトップ画面 ('<サービス名>:top') への逆引き先
+        self.top_urls = {service.service_name: f'{service.service_name}:top' for service in self._active_services}
+
+    @cached_property
+    def last_modified(self):
+        # 削除は updated_at に残らないため、版番号 (無効化した時刻) とも比べる
+        updated = [
+            obj.updated_at
+            for objects in (self.services, self.plans, self.service_groups)
+            for obj in objects.values()
+        ]
+        return max(updated + [datetime.fromtimestamp(self.version / 1e9, timezone.utc)])
+
+    @cached_property
+    def search_index(self):
+        from omcen.search import NgramIndex
+
+        return NgramIndex(self.services.values())
+
+    def active_services(self):
+        return list(self._active_services)
+
+    def plans_for(self, service_id):
+        return list(self._plans_by_service.get(service_id, ()))
+
+    def service_groups_for(self, service_name, active_only=True):
+        groups = self._groups_by_service_name.get(service_name, ())
+        if active_only:
+            return [group for group in groups if group.is_active]
+        return list(groups)
+
+
+def _current_version():
+    # キャッシュから消えていた場合も別の値になるよう時刻を版番号にする
+    cache.add(CATALOG_VERSION_KEY, time.time_ns(), None)
+    return cache.get(CATALOG_VERSION_KEY)
+
+
+def _build(version):
+    # 全員で共有するスナップショットのため、遅延のあるレプリカからは読まない
+    with use_primary():
+        services = list(Service.objects.order_by('service_name'))
+        plans = list(Plan.objects.order_by('created_at'))
+        service_groups = list(ServiceGroup.objects.all())
+
+    return CatalogSnapshot(version, services, plans, service_groups)
+
+
+def get_catalog():
+    """Return the current catalog snapshot, rebuilding it if its version is stale."""
+    global _snapshot
+
+    version = _current_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = _build(version)
+
+        return _snapshot
+
+
+def invalidate_catalog():
+    """
+    Bump the catalog version so every process rebuilds its snapshot. Only
+    processes sharing the default cache see the new version, so production
+    needs a shared CACHE_URL (see the omcen.E003 deploy check).
+    """
+    global _snapshot
+
+    cache.set(CATALOG_VERSION_KEY, time.time_ns(), None)
+    _snapshot = None
@@ -0,0 +1,144 @@
+import os
+import re
+import sys
+
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+from django.template.utils import get_app_template_dirs
+from django.urls import get_resolver
+from django.utils.module_loading import import_string
+
+# プロセスごとに別の内容を持つキャッシュ。ここに置いた無効化は他のワーカーに届かない
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+CACHE_SESSION_ENGINES = (
+    'django.contrib.sessions.backends.cache',
+    'django.contrib.sessions.backends.cached_db',
+)
+SOCIAL_DJANGO_PACKAGES = ('social_django', 'social_core')
+# テンプレートから social_django を使う箇所 (モジュール名、または URL 名前空間 'social')
+SOCIAL_DJANGO_TEMPLATE_REFERENCE = re.compile(r'social_django|\{%\s*url\s+[\'"]social:')
+
+
+def is_shared_cache(alias='default'):
+    return settings.CACHES[alias]['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+@register(Tags.caches)
+def check_shared_cache_for_sessions(app_configs, **kwargs):
+    """Refuse cache-backed sessions and the user cache on a cache that other worker processes cannot see."""
+    if is_shared_cache():
+        return []
+
+    errors = []
+    if settings.SESSION_ENGINE in CACHE_SESSION_ENGINES:
+        errors.append(Error(
+            f'SESSION_ENGINE {settings.SESSION_ENGINE!r} needs a cache shared by every worker process.',
+            hint='Set CACHE_URL (e.g. pymemcache://127.0.0.1:11211) or OMCEN_SESSION_ENGINE=django.contrib.sessions.backends.db.',
+            id='omcen.E001',
+        ))
+    if getattr(settings, 'OMCEN_USER_CACHE', False):
+        errors.append(Error(
+            'OMCEN_USER_CACHE needs a cache shared by every worker process to invalidate cached users.',
+            hint='Set CACHE_URL (e.g. pymemcache://127.0.0.1:11211) or OMCEN_USER_CACHE=False.',
+            id='omcen.E002',
+        ))
+    return errors
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache_for_catalog(app_configs, **kwargs):
+    """The catalog version lives in the cache, so admin edits only reach the processes sharing it."""
+    if is_shared_cache():
+        return []
+
+    return [Error(
+        'The catalog snapshot is invalidated through the default cache, which is local to each worker process.',
+        hint='Set CACHE_URL (e.g. pymemcache://127.0.0.1:11211) to a cache shared by every worker process.',
+        id='omcen.E003',
+    )]
+
+
+@register(Tags.caches)
+def check_shared_cache_for_replicas(app_configs, **kwargs):
+    """The primary pin after a write must be visible to whichever worker serves the next request."""
+    if is_shared_cache() or not getattr(settings, 'OMCEN_REPLICA_DATABASES', ()):
+        return []
+
+    return [Error(
+        'Read replicas need a cache shared by every worker process to pin writers to the primary.',
+        hint='Set CACHE_URL (e.g. pymemcache://127.0.0.1:11211) or unset REPLICA_DATABASE_URL.',
+        id='omcen.E004',
+    )]
+
+
+@register(Tags.staticfiles)
+def check_brotli_for_static_files(app_configs, **kwargs):
+    """collectstatic only writes the .br variants when the brotli package is importable."""
+    from omcen.staticfiles import CompressedManifestStaticFilesStorage, brotli
+
+    storage = import_string(settings.STATICFILES_STORAGE)
+    if brotli is not None or not issubclass(storage, CompressedManifestStaticFilesStorage):
+        return []
+
+    return [Warning(
+        'brotli is not installed, so collectstatic writes only gzip variants of the static files.',
+        hint='Install the brotli package (it is listed in pyproject.toml and requirements.txt).',
+        id='omcen.W001',
+    )]
+
+
+def _is_social_django(name):
+    return name.split('.')[0] in SOCIAL_DJANGO_PACKAGES
+
+
+def _project_template_files():
+    # サードパーティのアプリのテンプレートは対象外にし、BASE_DIR 配下だけを調べる
+    base_dir = str(settings.BASE_DIR)
+    directories = [str(directory) for template in settings.TEMPLATES for directory in template.get('DIRS', ())]
+    directories += [str(directory) for directory in get_app_template_dirs('templates')]
+    for directory in directories:
+        if not os.path.abspath(directory).startswith(base_dir) or 'site-packages' in directory:
+            continue
+        for root, _dirs, files in os.walk(directory):
+            for name in files:
+                if name.endswith(('.html', '.txt')):
+                    yield os.path.join(root, name)
+
+
+@register(Tags.templates, Tags.urls)
+def check_social_django_disabled(app_configs, **kwargs):
+    """With OMCEN_SOCIAL_DJANGO off, no setting, imported module, URL or template may still use social_django."""
+    if getattr(settings, 'OMCEN_SOCIAL_DJANGO', True):
+        return []
+
+    references = [
+        f'settings.{name}: {value}'
+        for name, values in (
+            ('INSTALLED_APPS', settings.INSTALLED_APPS),
+            ('MIDDLEWARE', settings.MIDDLEWARE),
+            ('AUTHENTICATION_BACKENDS', settings.AUTHENTICATION_BACKENDS),
+            ('TEMPLATES', [processor for template in settings.TEMPLATES
+                           for processor in template.get('OPTIONS', {}).get('context_processors', ())]),
+        )
+        for value in values if _is_social_django(value)
+    ]
+
+    # URLconf を読み込み、ビューから import されたモジュールも数える
+    resolver = get_resolver()
+    if 'social' in resolver.namespace_dict:
+        references.append(f"{settings.ROOT_URLCONF}: namespace 'social'")
+    references += [f'import: {name}' for name in sorted(sys.modules) if name in SOCIAL_DJANGO_PACKAGES]
+
+    for path in _project_template_files():
+        with open(path, encoding='utf-8') as f:
+            if SOCIAL_DJANGO_TEMPLATE_REFERENCE.search(f.read()):
+                references.append(f'template: {os.path.relpath(path, settings.BASE_DIR)}')
+
+    return [Error(
+        f'OMCEN_SOCIAL_DJANGO is off, but {reference} still uses social_django.',
+        hint='Remove the reference or set OMCEN_SOCIAL_DJANGO=True.',
+        id='omcen.E005',
+    ) for reference in references]
@@ -0,0 +1,73 @@
+import hashlib
+from datetime import datetime, timezone
+
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language
+
+from omcen.catalog import get_catalog
+
+
+def catalog_validators(request, catalog, entitlements=None):
+    """
+    Return ``(etag, last_modified)`` of a catalog page as seen by request.user,
+    or ``(None, None)`` when the page carries one-off content (flash messages)
+    and must always be rendered.
+    """
+    if len(messages.get_messages(request)):
+        return None, None
+
+    last_modified = catalog.last_modified
+    parts = [str(request.user.pk), get_language() or '', str(catalog.version)]
+    if entitlements is not None:
+        parts.append(str(entitlements.version))
+        if entitlements.version:
+            last_modified = max(last_modified, datetime.fromtimestamp(entitlements.version / 1e9, timezone.utc))
+
+    etag = quote_etag(hashlib.md5(':'.join(parts).encode()).hexdigest())
+    return etag, last_modified.timestamp()
+
+
+def conditional_response(request, etag, last_modified):
+    """Return a 304 (or 412) response if the client's copy is still current, else None."""
+    if etag is None or request.method not in ('GET', 'HEAD'):
+        return None
+
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+
+
+def set_validators(response, etag, last_modified):
+    if etag is not None and response.status_code in (200, 304):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # ユーザーごとのページのため共有キャッシュには置かせず、毎回再検証させる
+        patch_cache_control(response, private=True, no_cache=True)
+
+    return response
+
+
+class ConditionalCatalogMixin:
+    """
+    Answer GETs of catalog pages with 304 Not Modified while neither the
+    catalog nor (with ``conditional_entitlements``) the user's subscriptions
+    have changed, and expose ``catalog_version`` for {% cache %} fragments.
+    """
+    conditional_entitlements = False
+
+    def get(self, request, *args, **kwargs):
+        self.catalog = get_catalog()
+        entitlements = request.entitlements if self.conditional_entitlements else None
+        etag, last_modified = catalog_validators(request, self.catalog, entitlements)
+
+        response = conditional_response(request, etag, last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+
+        return set_validators(response, etag, last_modified)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['catalog_version'] = self.catalog.version
+
+        return context
@@ -0,0 +1,161 @@
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from omcen.catalog import get_catalog
+from omcen.models import Service, Plan, ServiceGroup, ServiceInUse, ServiceCounter, PlanCounter
+
+COUNTER_CACHE_KEY = 'omcen:counters:{}'
+REBUILD_BATCH_SIZE = 100
+
+Counter = namedtuple('Counter', ['subscribers', 'mrr'])
+ServiceCounters = namedtuple('ServiceCounters', ['service', 'plans'])
+
+EMPTY_COUNTER = Counter(0, 0)
+
+
+def adjust_counters(changes):
+    """
+    Add ``(service group pk, delta)`` subscription changes to the Plan and
+    Service counters with F() expressions. Call it inside the transaction
+    that changes the ServiceInUse rows, so that both commit or roll back
+    together.
+    """
+    service_groups = get_catalog().service_groups
+    plans, services = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    plan_services = {}
+    for service_group_id, delta in changes:
+        service_group = service_groups.get(service_group_id)
+        if service_group is None:
+            # カタログの再構築前に作られたサービスグループ
+            service_group = ServiceGroup.objects.select_related('plan').get(pk=service_group_id)
+        amount = (service_group.plan.price or 0) * delta
+        for totals, key in ((plans, service_group.plan_id), (services, service_group.service_id)):
+            totals[key][0] += delta
+            totals[key][1] += amount
+        plan_services[service_group.plan_id] = service_group.service_id
+
+    # デッドロックしないよう、行ロックは常にプラン→サービスの順、それぞれ主キー順に取る
+    for plan_id in sorted(plans):
+        _add(PlanCounter, plan_id, *plans[plan_id], service_id=plan_services[plan_id])
+    for service_id in sorted(services):
+        _add(ServiceCounter, service_id, *services[service_id])
+
+
+def _add(model, pk, subscribers, mrr, **defaults):
+    if not subscribers and not mrr:
+        return
+    query_set = model.objects.filter(pk=pk)
+    if not query_set.update(subscribers=F('subscribers') + subscribers, mrr=F('mrr') + mrr):
+        # 集計行がまだないプラン・サービスは 0 で作ってから加算する
+        model.objects.bulk_create([model(pk=pk, **defaults)], ignore_conflicts=True)
+        query_set.update(subscribers=F('subscribers') + subscribers, mrr=F('mrr') + mrr)
+
+
+def create_counters(service_ids=(), plans=()):
+    """Create the zeroed counter rows of new services and ``plans``."""
+    ServiceCounter.objects.bulk_create([ServiceCounter(pk=pk) for pk in service_ids], ignore_conflicts=True)
+    PlanCounter.objects.bulk_create(
+        [PlanCounter(pk=plan.pk, service_id=plan.service_id) for plan in plans], ignore_conflicts=True,
+    )
+
+
+def reprice_plan(plan):
+    """Recompute the MRR of ``plan`` and its service from the subscriber count, after the price changed."""
+    with transaction.atomic():
+        PlanCounter.objects.filter(pk=plan.pk).update(mrr=F('subscribers') * (plan.price or 0))
+        ServiceCounter.objects.filter(pk=plan.service_id).update(mrr=Coalesce(
+            Subquery(
+                PlanCounter.objects.filter(service_id=OuterRef('pk')).order_by()
+                .values('service_id').annotate(total=Sum('mrr')).values('total')
+            ),
+            Value(0),
+        ))
+
+
+def service_counters(service_id):
+    """
+    Return the ServiceCounters of one service for the service detail page.
+    Read from the cache, so the counts may lag by up to
+    ``OMCEN_COUNTER_CACHE_TTL`` seconds. A request that finds the cache
+    expired reads the PlanCounter rows with one query.
+    """
+    key = COUNTER_CACHE_KEY.format(service_id)
+    counters = cache.get(key)
+    if counters is None:
+        plans = {
+            plan_id: Counter(subscribers, mrr)
+            for plan_id, subscribers, mrr in PlanCounter.objects.filter(service_id=service_id)
+            .values_list('plan_id', 'subscribers', 'mrr')
+        }
+        # サービスの集計はプランの集計の合計と等しいため、同じクエリから求める
+        total = Counter(sum(c.subscribers for c in plans.values()), sum(c.mrr for c in plans.values()))
+        counters = ServiceCounters(total, plans)
+        cache.set(key, counters, getattr(settings, 'OMCEN_COUNTER_CACHE_TTL', 30))
+    return counters
+
+
+def rebuild_counters(service_ids=None, batch_size=REBUILD_BATCH_SIZE, using=DEFAULT_DB_ALIAS, stdout=None):
+    """
+    Recount the counters of ``service_ids`` (every service by default) from
+    the active subscriptions, ``batch_size`` services per transaction. The
+    counter rows of a batch are locked before counting, so subscriptions
+    changing meanwhile are counted exactly once. Returns the number of
+    services rebuilt.
+    """
+    query_set = Service.objects.using(using).order_by('pk').values_list('pk', flat=True)
+    if service_ids is not None:
+        query_set = query_set.filter(pk__in=list(service_ids))
+
+    after, done = None, 0
+    while True:
+        batch = list((query_set if after is None else query_set.filter(pk__gt=after))[:batch_size])
+        if not batch:
+            return done
+        with transaction.atomic(using=using):
+            _rebuild_batch(batch, using)
+        cache.delete_many([COUNTER_CACHE_KEY.format(service_id) for service_id in batch])
+        done += len(batch)
+        after = batch[-1]
+        if stdout is not None:
+            stdout.write(f'{done} services')
+
+
+def _rebuild_batch(service_ids, using):
+    plan_services = dict(Plan.objects.using(using).filter(service_id__in=service_ids).values_list('pk', 'service_id'))
+    PlanCounter.objects.using(using).bulk_create(
+        [PlanCounter(pk=plan_id, service_id=service_id) for plan_id, service_id in plan_services.items()],
+        ignore_conflicts=True,
+    )
+    ServiceCounter.objects.using(using).bulk_create(
+        [ServiceCounter(pk=service_id) for service_id in service_ids], ignore_conflicts=True,
+    )
+    # 数える前に adjust_counters と同じ順で集計行をロックし、並行する加入・解除が
+    # 数え直しの前 (数に含まれる) か後 (数え直した値に加算される) のどちらかになるようにする
+    plans = {
+        counter.pk: counter
+        for counter in PlanCounter.objects.using(using).select_for_update().filter(service_id__in=service_ids).order_by('pk')
+    }
+    services = {
+        counter.pk: counter
+        for counter in ServiceCounter.objects.using(using).select_for_update().filter(pk__in=service_ids).order_by('pk')
+    }
+    for counter in (*plans.values(), *services.values()):
+        counter.subscribers = counter.mrr = 0
+
+    rows = (
+        ServiceInUse.objects.using(using).filter(service_id__in=service_ids, is_active=True).order_by()
+        .values_list('service_id', 'omcen_service__plan_id')
+        .annotate(subscribers=Count('pk'), mrr=Sum('omcen_service__plan__price'))
+    )
+    for service_id, plan_id, subscribers, mrr in rows:
+        for counter in (plans[plan_id], services[service_id]):
+            counter.subscribers += subscribers
+            counter.mrr += mrr or 0
+
+    PlanCounter.objects.using(using).bulk_update(plans.values(), ['subscribers', 'mrr'], batch_size=1000)
+    ServiceCounter.objects.using(using).bulk_update(services.values(), ['subscribers', 'mrr'], batch_size=1000)
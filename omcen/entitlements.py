@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from omcen import metrics
+from omcen.catalog import get_catalog
+from omcen.models import ServiceInUse
+from omcen.routers import use_primary
+
+ENTITLEMENT_CACHE_KEY = 'omcen:entitlements:{}'
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+class Entitlement(namedtuple('Entitlement', ['service_in_use_id', 'service_group'])):
+    """A user's active subscription, resolved against the catalog snapshot."""
+
+    @property
+    def service_group_id(self):
+        return self.service_group.pk
+
+    @property
+    def service(self):
+        return self.service_group.service
+
+    @property
+    def plan(self):
+        return self.service_group.plan
+
+
+class Entitlements:
+    """
+    The active subscriptions of one user, keyed by service name.
+    Only ServiceInUse/ServiceGroup ids are cached per user; service, plan and
+    activation state come from the catalog snapshot, so catalog changes never
+    leave stale entitlements behind.
+    """
+
+    def __init__(self, version=None, items=()):
+        self.version = version
+        self._by_service_name = {}
+
+        service_groups = get_catalog().service_groups
+        for service_in_use_id, service_group_id in items:
+            service_group = service_groups.get(service_group_id)
+            if service_group is None or not service_group.is_active:
+                continue
+            self._by_service_name[service_group.service.service_name] = Entitlement(service_in_use_id, service_group)
+
+    def __contains__(self, service_name):
+        return service_name in self._by_service_name
+
+    def __iter__(self):
+        return iter(self._by_service_name.values())
+
+    def __len__(self):
+        return len(self._by_service_name)
+
+    def get(self, service_name):
+        return self._by_service_name.get(service_name)
+
+    def is_subscribed(self, service_name, plan_name=None):
+        entitlement = self.get(service_name)
+        if entitlement is None:
+            return False
+        return plan_name is None or entitlement.plan.plan_name == plan_name
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def entitlement_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+metrics.register_collector(lambda: {
+    'counters': {f'omcen_entitlement_cache_{name}_total': value for name, value in entitlement_cache_stats().items()},
+})
+
+
+def _load(user_id):
+    # 他のリクエストとも共有するキャッシュのため、カタログと同じく遅延のあるレプリカからは読まない
+    with use_primary():
+        items = list(
+            ServiceInUse.objects.filter(omcen_user_id=user_id, is_active=True).values_list('uuid', 'omcen_service_id')
+        )
+    return {'version': time.time_ns(), 'items': items}
+
+
+def get_entitlements(user):
+    if not user.is_authenticated:
+        return Entitlements()
+
+    key = ENTITLEMENT_CACHE_KEY.format(user.pk)
+    entry = cache.get(key)
+    if entry is None:
+        _count('misses')
+        entry = _load(user.pk)
+        cache.set(key, entry, getattr(settings, 'OMCEN_ENTITLEMENT_CACHE_TTL', 300))
+    else:
+        _count('hits')
+
+    return Entitlements(entry['version'], entry['items'])
+
+
+def invalidate_entitlements(*user_ids):
+    """Evict the cached entitlements of the given users once the transaction commits."""
+    keys = [ENTITLEMENT_CACHE_KEY.format(user_id) for user_id in user_ids]
+
+    def evict():
+        cache.delete_many(keys)
+        with _stats_lock:
+            _stats['evictions'] += len(keys)
+
+    if keys:
+        transaction.on_commit(evict)
+
+
+def lookup_entitlements(pairs):
+    """
+    Resolve many ``(user id, service name)`` pairs with one query and return
+    ``{(user id, service name): ServiceGroup}`` for the pairs that have an
+    active subscription. Inactive users and service groups are left out.
+    """
+    catalog = get_catalog()
+    user_ids = {user_id for user_id, _ in pairs}
+    service_ids = {
+        catalog.service_uuid_by_name[service_name]
+        for _, service_name in pairs
+        if service_name in catalog.service_uuid_by_name
+    }
+    if not user_ids or not service_ids:
+        return {}
+
+    rows = ServiceInUse.objects.filter(
+        omcen_user_id__in=user_ids, service_id__in=service_ids, is_active=True, omcen_user__is_active=True,
+    ).values_list('omcen_user_id', 'omcen_service_id')
+
+    found = {}
+    for user_id, service_group_id in rows:
+        service_group = catalog.service_groups.get(service_group_id)
+        if service_group is None or not service_group.is_active:
+            continue
+        found[(user_id, service_group.service.service_name)] = service_group
+    return found
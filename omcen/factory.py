@@ -0,0 +1,58 @@
+import factory
+from django.contrib.auth.hashers import make_password
+
+from omcen.models import OmcenUser, Service, Plan, ServiceGroup, ServiceInUse
+
+# 大量に生成するためハッシュ化は1度だけにする
+DEFAULT_PASSWORD = 'omcen-password'
+_password_hashes = []
+
+
+def password_hash():
+    if not _password_hashes:
+        _password_hashes.append(make_password(DEFAULT_PASSWORD))
+    return _password_hashes[0]
+
+
+class OmcenUserFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = OmcenUser
+        django_get_or_create = ('username',)
+
+    username = factory.Sequence(lambda n: f'user{n}')
+    email = factory.LazyAttribute(lambda o: f'{o.username}@example.com')
+    password = factory.LazyFunction(password_hash)
+
+
+class ServiceFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = Service
+        django_get_or_create = ('service_name',)
+
+    service_name = factory.Sequence(lambda n: f'service{n}')
+
+
+class PlanFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = Plan
+
+    service = factory.SubFactory(ServiceFactory)
+    plan_name = factory.Sequence(lambda n: f'plan{n}')
+    price = factory.Sequence(lambda n: (n % 10) * 500)
+
+
+class ServiceGroupFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = ServiceGroup
+
+    plan = factory.SubFactory(PlanFactory)
+    service = factory.SelfAttribute('plan.service')
+
+
+class ServiceInUseFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = ServiceInUse
+
+    omcen_user = factory.SubFactory(OmcenUserFactory)
+    omcen_service = factory.SubFactory(ServiceGroupFactory)
+    service = factory.SelfAttribute('omcen_service.service')
@@ -2,6 +2,7 @@ import sys
 
 from django import forms
 
+from omcen.catalog import get_catalog
 from omcen.models import ServiceGroup, Service, ServiceInUse, OmcenUser, Plan
 
 sys.path.append('../templates')
@@ -63,10 +64,30 @@ class UpdatePlanForm(forms.ModelForm):
         return self.cleaned_data.get('price')
 
 
-class DeletePlanForm(forms.ModelForm):
-    class Meta:
-        model = Plan
-        fields = []
+# 管理画面: サービス全体の有効・無効切り替えフォーム
+class ServiceLifecycleForm(forms.Form):
+    active = forms.TypedChoiceField(choices=[('1', '有効化'), ('0', '無効化')], coerce=lambda value: value == '1')
+    cascade = forms.BooleanField(label='加入中のユーザーも登録解除する', required=False)
+
+
+# 管理画面: プラン削除フォーム (加入中のユーザーの移行先を選ぶ)
+class DeletePlanForm(forms.Form):
+    target_plan = forms.ChoiceField(label='加入中のユーザーの移行先', required=False)
+
+    def __init__(self, *args, plan, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 移行先は同じサービスの有効なプランから選ぶ (カタログから引くためクエリは発生しない)
+        service_groups = [
+            service_group for service_group in get_catalog().service_groups_for(plan.service.service_name)
+            if service_group.plan_id != plan.pk and service_group.plan.is_active
+        ]
+        self.plans = {str(service_group.plan_id): service_group.plan for service_group in service_groups}
+        self.fields['target_plan'].choices = [('', '移行せずに登録解除する')] + [
+            (plan_id, target.plan_name) for plan_id, target in self.plans.items()
+        ]
+
+    def clean_target_plan(self):
+        return self.plans.get(self.cleaned_data['target_plan'])
 
 
 # サービス登録フォーム
@@ -0,0 +1,107 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.hashers import identify_hasher, make_password
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def hash_password(value):
+    """Hash a raw password; make empty ones unusable."""
+    return make_password(value or None)
+
+
+def hashed_password(value):
+    """
+    Return a password that is already hashed (the ``password_hash`` column of
+    omcen_export) as is. Anything that is not a known hash becomes unusable
+    rather than being stored verbatim.
+    """
+    try:
+        identify_hasher(value)
+    except ValueError:
+        return make_password(None)
+    return value
+
+
+def password_to_hash(row):
+    # ハッシュ済みのパスワードがある行はハッシュ化しない
+    return None if row.get('password_hash') else row.get('password')
+
+
+def stored_password(row, password):
+    """The password to store for ``row``: its ``password_hash`` if given, else the hash of ``password``."""
+    if row.get('password_hash'):
+        return hashed_password(row['password_hash'])
+    return password
+
+
+def _init_worker():
+    # spawn で起動した場合も設定を読み込む
+    django.setup()
+
+
+def _hash_chunk(passwords):
+    return [hash_password(password) for password in passwords]
+
+
+class ParallelPasswordHasher:
+    """
+    Hash passwords in a ProcessPoolExecutor sized to the available cores.
+    ``workers=1`` hashes in-process, which is the baseline of the benchmark.
+    """
+
+    def __init__(self, workers=None, chunk_size=200):
+        self.workers = workers or available_cpus()
+        self.chunk_size = chunk_size
+        self.executor = None
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _submit(self, passwords):
+        chunks = [passwords[i:i + self.chunk_size] for i in range(0, len(passwords), self.chunk_size)]
+        if self.executor is None:
+            return [_hash_chunk(chunk) for chunk in chunks]
+        return [self.executor.submit(_hash_chunk, chunk) for chunk in chunks]
+
+    def _collect(self, pending):
+        hashes = []
+        for chunk in pending:
+            hashes.extend(chunk if isinstance(chunk, list) else chunk.result())
+        return hashes
+
+    def hash_many(self, passwords):
+        return self._collect(self._submit(list(passwords)))
+
+    def hash_batches(self, batches, password_of):
+        """
+        Yield ``(batch, hashes)`` for each batch, hashing the next batch while
+        the caller inserts the current one. At most two batches are in memory.
+        """
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, self._submit([password_of(item) for item in batch])))
+            if len(pending) > 1:
+                done_batch, futures = pending.popleft()
+                yield done_batch, self._collect(futures)
+        while pending:
+            done_batch, futures = pending.popleft()
+            yield done_batch, self._collect(futures)
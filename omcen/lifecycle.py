@@ -0,0 +1,70 @@
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from omcen.catalog import invalidate_catalog
+from omcen.counters import adjust_counters
+from omcen.entitlements import invalidate_entitlements
+from omcen.models import Service, Plan, ServiceGroup, ServiceInUse
+
+CASCADE_BATCH_SIZE = 5000
+
+LifecycleResult = namedtuple('LifecycleResult', ['services', 'plans', 'service_groups', 'subscriptions'])
+
+
+def set_services_active(service_ids, active, cascade=False, batch_size=CASCADE_BATCH_SIZE):
+    """
+    Enable or disable whole services. The Service rows and all their Plans
+    and ServiceGroups are changed with one UPDATE each, in one transaction.
+
+    With ``cascade``, disabling also deactivates the services' active
+    subscriptions afterwards, ``batch_size`` rows per transaction, so a
+    service with many subscribers never holds a long lock. Re-enabling
+    never reactivates subscriptions: users subscribe again themselves.
+
+    Returns a LifecycleResult with the number of rows changed per table.
+    """
+    service_ids = list(service_ids)
+    now = timezone.now()
+
+    # update() は auto_now もシグナルも扱わないため、更新日時とカタログの無効化は明示する
+    with transaction.atomic():
+        services = Service.objects.filter(pk__in=service_ids, is_active=not active).update(
+            is_active=active, updated_at=now
+        )
+        plans = Plan.objects.filter(service_id__in=service_ids, is_active=not active).update(
+            is_active=active, updated_at=now
+        )
+        service_groups = ServiceGroup.objects.filter(service_id__in=service_ids, is_active=not active).update(
+            is_active=active, updated_at=now
+        )
+        transaction.on_commit(invalidate_catalog)
+
+    subscriptions = 0
+    if cascade and not active:
+        subscriptions = deactivate_service_subscriptions(service_ids, batch_size)
+
+    return LifecycleResult(services, plans, service_groups, subscriptions)
+
+
+def deactivate_service_subscriptions(service_ids, batch_size=CASCADE_BATCH_SIZE):
+    """Deactivate the active subscriptions of ``service_ids`` in batches; returns the number of rows changed."""
+    total = 0
+    while True:
+        with transaction.atomic():
+            # 有効な加入の部分インデックス (サービス単位) から1バッチ分だけ選ぶ
+            batch = list(
+                ServiceInUse.objects.select_for_update().filter(service_id__in=service_ids, is_active=True)
+                .values_list('uuid', 'omcen_user_id', 'omcen_service_id')[:batch_size]
+            )
+            if not batch:
+                return total
+
+            # 日割り計算に使うため update() でも解除日時を残す
+            now = timezone.now()
+            total += ServiceInUse.objects.filter(pk__in=[pk for pk, _, _ in batch], is_active=True).update(
+                is_active=False, updated_at=now, deactivated_at=now
+            )
+            adjust_counters((service_group_id, -1) for _, _, service_group_id in batch)
+            invalidate_entitlements(*{user_id for _, user_id, _ in batch})
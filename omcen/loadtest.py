@@ -0,0 +1,180 @@
+import asyncio
+import ssl
+import statistics
+import threading
+import time
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.db import DEFAULT_DB_ALIAS
+from django.db.utils import ConnectionHandler
+
+DEFAULT_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+def session_cookie(user):
+    """Create a logged-in session for ``user`` (as Client.force_login does) and return its Cookie header."""
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = DEFAULT_BACKEND
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        size = 0
+        while True:
+            chunk_size = int((await reader.readline()).split(b';')[0], 16)
+            if chunk_size == 0:
+                await reader.readline()
+                break
+            size += len(await reader.readexactly(chunk_size + 2)) - 2
+    else:
+        size = len(await reader.readexactly(int(headers.get('content-length', 0))))
+
+    return status, size, headers.get('connection', '').lower() == 'close'
+
+
+async def _client(url, paths, headers, deadline, offset, result):
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    ssl_context = ssl.create_default_context() if parts.scheme == 'https' else None
+    host_header = parts.netloc
+    writer = None
+    i = offset
+
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        request = [f'GET {parts.path.rstrip("/")}{path} HTTP/1.1', f'Host: {host_header}']
+        request += [f'{name}: {value}' for name, value in headers.items()]
+        data = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+
+        started = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+            writer.write(data)
+            await writer.drain()
+            status, size, close = await _read_response(reader)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            result['errors'] += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+            # 接続を受け付けられない場合に再接続を繰り返し続けないようにする
+            await asyncio.sleep(0.05)
+            continue
+
+        result['latencies'].append(time.monotonic() - started)
+        result['bytes'] += size
+        if status >= 400:
+            result['failures'] += 1
+        if close:
+            writer.close()
+            writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def _run(url, paths, concurrency, duration, headers):
+    result = {'latencies': [], 'errors': 0, 'failures': 0, 'bytes': 0}
+    started = time.monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(_client(url, paths, headers, deadline, i, result) for i in range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(result['latencies'])
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else 0.0,
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        'errors': result['errors'],
+        'failures': result['failures'],
+        'bytes': result['bytes'],
+    }
+
+
+def run_load(url, paths, concurrency, duration, headers=None):
+    """
+    Keep ``concurrency`` keep-alive connections busy against ``url`` for
+    ``duration`` seconds, cycling through ``paths``, and return throughput
+    and latency percentiles.
+    """
+    return asyncio.run(_run(url, list(paths), concurrency, duration, headers or {}))
+
+
+def run_db_load(settings_dict, concurrency, duration, sql='SELECT 1', alias='omcen_loadtest'):
+    """
+    Simulate ``concurrency`` request threads against one database for
+    ``duration`` seconds: each "request" connects (or checks a connection out
+    of the pool), runs ``sql`` and closes, as Django does with
+    CONN_MAX_AGE = 0. Return the request latency percentiles.
+    """
+    # ConnectionHandler は 'default' を必須とする (計測では使わない)
+    settings_dict = dict(settings_dict, CONN_MAX_AGE=0)
+    handler = ConnectionHandler({DEFAULT_DB_ALIAS: settings_dict, alias: settings_dict})
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+
+    def worker():
+        connection = handler[alias]
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+                    cursor.fetchall()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else 0.0,
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        'errors': len(errors),
+    }
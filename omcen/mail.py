@@ -0,0 +1,180 @@
+import random
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.core.mail.message import sanitize_address
+from django.db import transaction
+from django.utils import timezone
+
+from omcen.models import OutboundEmail
+
+# 一時的なエラーとして再送する SMTP の応答コード (4xx)
+TRANSIENT_CODES = range(400, 500)
+
+
+class SMTPUnavailable(Exception):
+    """The SMTP server could not be reached; every pending message is retried later."""
+
+    # 接続できずに送信を試していない場合は False (試行回数に数えない)
+    attempted = False
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    Store messages in the OutboundEmail table instead of talking to SMTP, so
+    the request (e.g. allauth's signup confirmation) never waits on the mail
+    server. The row is written in the caller's transaction; the
+    omcen_send_mail worker delivers it.
+    """
+
+    def send_messages(self, email_messages):
+        rows = []
+        for message in email_messages:
+            recipients = message.recipients()
+            if not recipients:
+                continue
+            encoding = message.encoding or settings.DEFAULT_CHARSET
+            rows.append(OutboundEmail(
+                from_email=sanitize_address(message.from_email, encoding),
+                recipients=[sanitize_address(address, encoding) for address in recipients],
+                subject=str(message.subject)[:255],
+                message=message.message().as_bytes(linesep='\r\n'),
+            ))
+
+        try:
+            OutboundEmail.objects.bulk_create(rows)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
+
+        return len(rows)
+
+
+def backoff(attempts, base=None, maximum=None):
+    """Exponential backoff with jitter for the ``attempts``-th failure."""
+    base = base or getattr(settings, 'OMCEN_EMAIL_RETRY_BASE', 30)
+    maximum = maximum or getattr(settings, 'OMCEN_EMAIL_RETRY_MAX', 3600)
+    delay = min(base * 2 ** (attempts - 1), maximum)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+class MailDeliverer:
+    """
+    Deliver queued messages in batches over one persistent SMTP connection,
+    which is reopened only after the server drops it.
+    """
+
+    def __init__(self, batch_size=100, max_attempts=None, **smtp_kwargs):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts or getattr(settings, 'OMCEN_EMAIL_MAX_ATTEMPTS', 8)
+        self.smtp = SMTPBackend(fail_silently=False, **smtp_kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        try:
+            self.smtp.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _open(self):
+        try:
+            self.smtp.open()
+        except OSError as error:
+            self.close()
+            raise SMTPUnavailable(error) from error
+
+    def _send(self, row):
+        for reconnect in (True, False):
+            if self.smtp.connection is None:
+                self._open()
+            try:
+                self.smtp.connection.sendmail(row.from_email, row.recipients, bytes(row.message))
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                raise
+            except OSError as error:
+                # 接続が切れていたら1度だけ接続し直す
+                self.close()
+                if not reconnect:
+                    # 接続し直した直後にも切れた場合は、この行の送信を試したものとする
+                    unavailable = SMTPUnavailable(error)
+                    unavailable.attempted = True
+                    raise unavailable from error
+
+    def _failed(self, row, error, permanent, now):
+        row.attempts += 1
+        row.last_error = f'{type(error).__name__}: {error}'[:2000]
+        if permanent or row.attempts >= self.max_attempts:
+            row.status = OutboundEmail.Status.FAILED
+        else:
+            row.next_attempt_at = now + backoff(row.attempts)
+
+    def _deferred(self, row, error, now):
+        # 送信を試していないため、試行回数は増やさずに送信日時だけを後ろにずらす
+        row.last_error = f'{type(error).__name__}: {error}'[:2000]
+        row.next_attempt_at = now + backoff(max(row.attempts, 1))
+
+    def _claim(self):
+        """
+        Lock a batch of due messages and push their next attempt past the claim
+        timeout, then commit, so other workers skip them while this one talks
+        to SMTP outside the transaction. If the worker dies mid-batch the rows
+        become due again once the timeout has passed.
+        """
+        timeout = timedelta(seconds=getattr(settings, 'OMCEN_EMAIL_CLAIM_TIMEOUT', 300))
+        with transaction.atomic():
+            rows = list(
+                OutboundEmail.objects.due()
+                .select_for_update(skip_locked=True)
+                .order_by('next_attempt_at')[:self.batch_size]
+            )
+            OutboundEmail.objects.filter(pk__in=[row.pk for row in rows]).update(
+                next_attempt_at=timezone.now() + timeout,
+            )
+        return rows
+
+    def deliver_batch(self):
+        """Send one batch of due messages; return ``(sent, failed)`` where failed counts every unsent row."""
+        sent = failed = 0
+        rows = self._claim()
+        for i, row in enumerate(rows):
+            now = timezone.now()
+            try:
+                self._send(row)
+            except SMTPUnavailable as error:
+                # サーバーに接続できない間は残りも送らずに後回しにする。
+                # 送信を試した行だけを1回の試行と数える
+                if error.attempted:
+                    self._failed(row, error.__cause__, False, now)
+                else:
+                    self._deferred(row, error.__cause__, now)
+                for pending in rows[i + 1:]:
+                    self._deferred(pending, error.__cause__, now)
+                failed += len(rows) - i
+                break
+            except smtplib.SMTPRecipientsRefused as error:
+                codes = [code for code, _ in error.recipients.values()]
+                self._failed(row, error, all(code not in TRANSIENT_CODES for code in codes), now)
+                failed += 1
+            except smtplib.SMTPResponseException as error:
+                self._failed(row, error, error.smtp_code not in TRANSIENT_CODES, now)
+                failed += 1
+            else:
+                row.status = OutboundEmail.Status.SENT
+                row.sent_at = now
+                row.attempts += 1
+                sent += 1
+
+        OutboundEmail.objects.bulk_update(
+            rows, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'],
+        )
+        return sent, failed
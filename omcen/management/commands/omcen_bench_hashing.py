@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from omcen.hashing import ParallelPasswordHasher, available_cpus
+
+
+class Command(BaseCommand):
+    help = 'パスワードハッシュ化のプロセス数ごとのスループットを計測します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--passwords', type=int, default=400, help='プロセス数ごとにハッシュ化する件数')
+        parser.add_argument('--max-workers', type=int, default=available_cpus())
+        parser.add_argument('--chunk-size', type=int, default=20)
+
+    def handle(self, *args, **options):
+        passwords = [f'omcen-benchmark-{i}' for i in range(options['passwords'])]
+        baseline = None
+
+        self.stdout.write(f'{"workers":>7} {"seconds":>9} {"hashes/s":>10} {"speedup":>8}')
+        for workers in range(1, options['max_workers'] + 1):
+            with ParallelPasswordHasher(workers, options['chunk_size']) as hasher:
+                # プロセスの起動時間は含めない
+                hasher.hash_many(passwords[:workers])
+                started = time.perf_counter()
+                hasher.hash_many(passwords)
+                elapsed = time.perf_counter() - started
+
+            rate = len(passwords) / elapsed
+            baseline = baseline or rate
+            self.stdout.write(f'{workers:>7} {elapsed:>9.2f} {rate:>10.1f} {rate / baseline:>7.2f}x')
@@ -0,0 +1,78 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import setup_test_environment
+
+from omcen import benchmark
+from omcen.catalog import invalidate_catalog
+from omcen.urls import app_name, urlpatterns
+
+
+class Command(BaseCommand):
+    help = '合成データを投入し、Omcen の全画面のレイテンシ・クエリ数・取得行数を計測します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='計測前に合成データを投入する')
+        parser.add_argument('--clean', action='store_true', help='投入済みの合成データを削除して終了する')
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--services', type=int, default=200)
+        parser.add_argument('--plans', type=int, default=1000, help='全サービス合計のプラン数')
+        parser.add_argument('--subscriptions', type=int, default=50000)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--api-checks', type=int, default=1000,
+                            help='加入状況 API の一括呼び出しと1件ずつの呼び出しを比べる件数 (0 で計測しない)')
+        parser.add_argument('--billing-workers', help='当月の請求処理を計測するプロセス数 (カンマ区切り、例: 1,4)。省略時は計測しない')
+        parser.add_argument('--billing-chunk-size', type=int)
+        parser.add_argument('--output', help='計測結果を書き出す JSON ファイル')
+        parser.add_argument('--baseline', help='比較対象の計測結果 JSON ファイル')
+        parser.add_argument('--threshold', type=float, default=1.2, help='基準値に対して許容する倍率')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['clean']:
+            benchmark.clean()
+            transaction.on_commit(invalidate_catalog)
+            self.stdout.write('Benchmark data removed.')
+            return
+
+        if options['seed']:
+            if options['services'] < 1 or options['plans'] < options['services']:
+                raise CommandError('--plans must be at least --services, and --services must be positive.')
+            benchmark.seed(
+                options['users'], options['services'], options['plans'], options['subscriptions'],
+                batch_size=options['batch_size'], stdout=self.stdout,
+            )
+            # bulk_create はシグナルを送らないため明示的に無効化する
+            invalidate_catalog()
+
+        # テンプレート描画を計測できるようにする
+        setup_test_environment()
+        results = benchmark.run(options['repeat'], stdout=self.stdout, api_checks=options['api_checks'])
+
+        if options['billing_workers']:
+            try:
+                workers = [int(count) for count in options['billing_workers'].split(',')]
+            except ValueError:
+                raise CommandError('--billing-workers must be a comma separated list of integers.')
+            results.update(benchmark.billing_throughput(workers, options['billing_chunk_size'], stdout=self.stdout))
+
+        covered = {label.split(' ')[0] for label in results}
+        missing = [f'{app_name}:{pattern.name}' for pattern in urlpatterns if f'{app_name}:{pattern.name}' not in covered]
+        if missing:
+            self.stderr.write(f'Not benchmarked: {", ".join(missing)}')
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                regressions = benchmark.compare(results, json.load(f), options['threshold'])
+            for regression in regressions:
+                self.stderr.write(f'REGRESSION {regression}')
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}.')
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS('No regressions.'))
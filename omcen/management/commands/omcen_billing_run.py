@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from omcen.billing import Period, run_billing
+
+
+class Command(BaseCommand):
+    help = (
+        '請求期間 (月) 中に有効だった加入から、ユーザーごとの請求を作成します。'
+        'プランの変更・登録解除は日割りで計算し、作成済みのユーザーは再実行しても請求しません。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', help='請求する月 (YYYY-MM)。省略時は前月')
+        parser.add_argument('--workers', type=int, help='並列に処理するプロセス数 (1 でこのプロセスのみ)。省略時は CPU 数')
+        parser.add_argument('--chunk-size', type=int, help='1プロセスが1トランザクションで処理する加入数の目安')
+        parser.add_argument('--quiet', action='store_true', help='チャンクごとの進捗を表示しない')
+
+    def handle(self, *args, **options):
+        if options['period']:
+            try:
+                period = Period.month(options['period'])
+            except ValueError:
+                raise CommandError('--period must be YYYY-MM.')
+        else:
+            today = timezone.localdate()
+            period = Period.month(f'{today.year - (today.month == 1)}-{(today.month - 2) % 12 + 1}')
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        result = run_billing(
+            period, workers=options['workers'], chunk_size=options['chunk_size'],
+            stdout=None if options['quiet'] else self.stdout,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'{period.start:%Y-%m}: {result.invoices} invoices ({result.lines} lines, total {result.total}) '
+            f'from {result.subscriptions} subscriptions in {result.chunks} chunks, {result.seconds:.1f}s '
+            f'({result.subscriptions / max(result.seconds, 1e-9):.0f} subscriptions/s)'
+        ))
@@ -0,0 +1,66 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from omcen.bulk import RateReporter, RowWriter
+from omcen.catalog import get_catalog
+from omcen.models import OmcenUser, ServiceInUse
+
+# password_hash はハッシュ済みのパスワード (omcen_import はこの列だけをハッシュ化せずに取り込む)
+USER_FIELDS = ['username', 'email', 'password_hash', 'first_name', 'last_name', 'is_active']
+SUBSCRIPTION_FIELDS = ['username', 'service_name', 'plan_name', 'is_active', 'created_at', 'updated_at', 'deactivated_at']
+
+
+class Command(BaseCommand):
+    help = 'Omcenユーザー・加入中サービスを CSV / JSONL に書き出します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['users', 'subscriptions'])
+        parser.add_argument('path', help="出力ファイル ('-' で標準出力)")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='省略時は拡張子から判定')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        if options['kind'] == 'users':
+            fieldnames, rows = USER_FIELDS, self.user_rows(options)
+        else:
+            fieldnames, rows = SUBSCRIPTION_FIELDS, self.subscription_rows(options)
+
+        stream = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        # 標準出力に書き出す場合、進捗は標準エラーに出す
+        reporter = RateReporter(self.stderr if path == '-' else self.stdout, options['kind'], every=options['batch_size'])
+        try:
+            writer = RowWriter(stream, fmt, fieldnames)
+            for values in rows:
+                writer.write(values)
+                reporter.add(1)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        reporter.report()
+
+    def user_rows(self, options):
+        # iterator() は PostgreSQL ではサーバーサイドカーソルになるので件数に関わらずメモリは一定
+        fields = ['password' if field == 'password_hash' else field for field in USER_FIELDS]
+        return OmcenUser.objects.using(options['database']).order_by().values_list(*fields).iterator(
+            chunk_size=options['batch_size']
+        )
+
+    def subscription_rows(self, options):
+        service_groups = get_catalog().service_groups
+        query_set = ServiceInUse.objects.using(options['database']).order_by().values_list(
+            'omcen_user__username', 'omcen_service_id', 'is_active', 'created_at', 'updated_at', 'deactivated_at'
+        )
+        for username, service_group_id, is_active, created_at, updated_at, deactivated_at in query_set.iterator(
+            chunk_size=options['batch_size']
+        ):
+            service_group = service_groups[service_group_id]
+            yield username, service_group.service.service_name, service_group.plan.plan_name, is_active, \
+                created_at.isoformat(), updated_at.isoformat(), deactivated_at.isoformat() if deactivated_at else ''
@@ -0,0 +1,176 @@
+import os
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from omcen.bulk import Checkpoint, RateReporter, batched, copy_insert, read_rows, supports_copy
+from omcen.catalog import get_catalog
+from omcen.counters import rebuild_counters
+from omcen.entitlements import invalidate_entitlements
+from omcen.hashing import ParallelPasswordHasher, password_to_hash, stored_password
+from omcen.models import OmcenUser, ServiceInUse
+
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y', 'on'}
+
+
+def to_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def to_datetime(value):
+    if not value:
+        return None
+    value = parse_datetime(value)
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+class Command(BaseCommand):
+    help = 'Omcenユーザー・加入中サービスを CSV / JSONL から一括登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['users', 'subscriptions'])
+        parser.add_argument('path', help="入力ファイル ('-' で標準入力)")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='省略時は拡張子から判定')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--checkpoint', help='再開用に処理済み行数を保存するファイル')
+        parser.add_argument('--no-copy', action='store_true', help='PostgreSQL でも COPY を使わない')
+        parser.add_argument('--hash-workers', type=int, default=1,
+                            help='パスワードをハッシュ化するプロセス数 (0 で CPU コア数)')
+        parser.add_argument('--hash-chunk-size', type=int, default=200)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        using = options['database']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        self.using = using
+        self.skipped = 0
+        self.conflicts = 0
+        self.imported_services = set()
+        use_copy = supports_copy(using) and not options['no_copy']
+        checkpoint = Checkpoint(options['checkpoint'], os.path.abspath(path) if path != '-' else path)
+        if checkpoint.rows:
+            self.stdout.write(f'Resuming after {checkpoint.rows} rows.')
+
+        reporter = RateReporter(self.stdout, options['kind'])
+        rows = islice(read_rows(path, fmt), checkpoint.rows, None)
+        done = checkpoint.rows
+
+        with ParallelPasswordHasher(options['hash_workers'], options['hash_chunk_size']) as hasher:
+            if options['kind'] == 'users':
+                model = OmcenUser
+                batches = (
+                    (batch, self.build_users(batch, hashes))
+                    for batch, hashes in hasher.hash_batches(batched(rows, batch_size), password_to_hash)
+                )
+            else:
+                model = ServiceInUse
+                self.service_groups = self.load_service_groups()
+                batches = ((batch, self.build_subscriptions(batch)) for batch in batched(rows, batch_size))
+
+            for batch, objs in batches:
+                # auto_now / auto_now_add は挿入時に現在時刻で上書きされるため、取り込む日時を先に控える
+                dates = [(obj.created_at, obj.updated_at) for obj in objs] if model is ServiceInUse else None
+                with transaction.atomic(using=using):
+                    if use_copy:
+                        inserted = copy_insert(model, objs, using)
+                    else:
+                        model.objects.using(using).bulk_create(objs, batch_size=batch_size, ignore_conflicts=True)
+                        # ignore_conflicts で捨てられた行は主キーが登録されていない
+                        inserted = model.objects.using(using).filter(pk__in=[obj.pk for obj in objs]).count()
+                    if model is ServiceInUse:
+                        self.restore_dates(objs, dates, batch_size)
+                        invalidate_entitlements(*{obj.omcen_user_id for obj in objs})
+                self.conflicts += len(objs) - inserted
+                done += len(batch)
+                checkpoint.save(done)
+                reporter.add(len(batch))
+
+        reporter.report()
+        if self.imported_services:
+            # 一括登録は集計を増減させないため、取り込んだサービスの集計を数え直す
+            rebuild_counters(self.imported_services, using=using)
+        if self.skipped:
+            self.stderr.write(f'{self.skipped} rows skipped (unknown user, service or plan).')
+        if self.conflicts:
+            self.stderr.write(
+                f'{self.conflicts} rows skipped (existing username or active subscription of the same service).'
+            )
+
+    def build_users(self, rows, hashes):
+        return [
+            OmcenUser(
+                username=OmcenUser.normalize_username(row['username']),
+                email=OmcenUser.objects.normalize_email(row['email']),
+                first_name=row.get('first_name') or None,
+                last_name=row.get('last_name') or None,
+                is_active=to_bool(row.get('is_active')),
+                password=stored_password(row, password),
+            )
+            for row, password in zip(rows, hashes)
+        ]
+
+    def load_service_groups(self):
+        # (サービス名, プラン名) -> ServiceGroup。有効なグループを優先する
+        service_groups = {}
+        for service_group in get_catalog().service_groups.values():
+            key = (service_group.service.service_name, service_group.plan.plan_name)
+            if key not in service_groups or service_group.is_active:
+                service_groups[key] = service_group
+        return service_groups
+
+    def build_subscriptions(self, rows):
+        user_ids = dict(
+            OmcenUser.objects.using(self.using)
+            .filter(username__in={row['username'] for row in rows})
+            .values_list('username', 'uuid')
+        )
+
+        objs = []
+        for row in rows:
+            user_id = user_ids.get(row['username'])
+            service_group = self.service_groups.get((row['service_name'], row['plan_name']))
+            if user_id is None or service_group is None:
+                self.skipped += 1
+                continue
+            self.imported_services.add(service_group.service_id)
+            is_active = to_bool(row.get('is_active'))
+            created_at, updated_at = to_datetime(row.get('created_at')), to_datetime(row.get('updated_at'))
+            objs.append(ServiceInUse(
+                omcen_user_id=user_id,
+                omcen_service_id=service_group.pk,
+                service_id=service_group.service_id,
+                is_active=is_active,
+                created_at=created_at,
+                updated_at=updated_at,
+                # 日割り請求の終わり。解除日時の列がない古い出力では更新日時 (なければ登録日時) を使う
+                deactivated_at=None if is_active else (
+                    to_datetime(row.get('deactivated_at')) or updated_at or created_at or timezone.now()
+                ),
+            ))
+        return objs
+
+    def restore_dates(self, objs, dates, batch_size):
+        """Write back the imported created_at/updated_at that auto_now(_add) replaced on insert."""
+        restored = []
+        for obj, (created_at, updated_at) in zip(objs, dates):
+            if created_at is None and updated_at is None:
+                continue
+            obj.created_at = created_at or obj.created_at
+            obj.updated_at = updated_at or obj.created_at
+            restored.append(obj)
+        # bulk_update は auto_now を適用しない。競合で登録されなかった行は主キーが一致しないため更新されない
+        ServiceInUse.objects.using(self.using).bulk_update(restored, ['created_at', 'updated_at'], batch_size=batch_size)
@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from omcen.catalog import get_catalog
+from omcen.loadtest import run_load, session_cookie
+from omcen.models import OmcenUser
+
+
+class Command(BaseCommand):
+    help = (
+        'WSGI と ASGI のサーバーに同じ閲覧画面の負荷をかけ、スループットとレイテンシを比較します。\n'
+        '例: gunicorn config.wsgi -w 4 --threads 8 -b :8000 と '
+        'OMCEN_ASYNC_VIEWS=service_list,plan_selection,service_in_use_list,my_page '
+        'uvicorn config.asgi:application --workers 4 --port 8001 を起動して実行する。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--asgi-url', default='http://127.0.0.1:8001')
+        parser.add_argument('--concurrency', default='50,200,1000', help='同時接続数 (カンマ区切り)')
+        parser.add_argument('--duration', type=float, default=10.0, help='1回の計測秒数')
+        parser.add_argument('--user', default='bench-user-0', help='ログインするユーザー名')
+        parser.add_argument('--path', action='append', dest='paths', help='計測するパス (省略時は非同期化した4画面)')
+        parser.add_argument('--output', help='計測結果を書き出す JSON ファイル')
+
+    def handle(self, *args, **options):
+        try:
+            user = OmcenUser.objects.get(username=options['user'])
+        except OmcenUser.DoesNotExist:
+            raise CommandError(f'User {options["user"]!r} does not exist; run omcen_benchmark --seed first.')
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma separated list of integers.')
+
+        paths = options['paths'] or self.default_paths()
+        headers = {'Cookie': session_cookie(user)}
+        results = []
+
+        self.stdout.write(f'{"server":<6} {"clients":>7} {"req/s":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"errors":>7}')
+        for concurrency in levels:
+            for server in ('wsgi', 'asgi'):
+                result = run_load(options[f'{server}_url'], paths, concurrency, options['duration'], headers)
+                result['server'] = server
+                results.append(result)
+                self.stdout.write(
+                    f'{server:<6} {concurrency:>7} {result["rps"]:>9.1f} {result["p50_ms"]:>7.1f}ms '
+                    f'{result["p95_ms"]:>7.1f}ms {result["p99_ms"]:>7.1f}ms {result["errors"] + result["failures"]:>7}'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+
+    def default_paths(self):
+        paths = [reverse('omcen:service_list'), reverse('omcen:service_in_use_list'), reverse('omcen:my_page')]
+        services = get_catalog().active_services()
+        if services:
+            paths.append(reverse('omcen:plan_selection', args=[services[0].service_name]))
+        return paths
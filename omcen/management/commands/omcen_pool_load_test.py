@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from omcen.backends.postgresql_pool.base import POOL_DEFAULTS
+from omcen.loadtest import run_db_load
+from omcen.pool import release_pool
+
+POOL_ENGINE = 'omcen.backends.postgresql_pool'
+PLAIN_ENGINE = 'django.db.backends.postgresql'
+
+
+class Command(BaseCommand):
+    help = (
+        'リクエストごとに接続する場合と接続プールを使う場合で、同じ同時実行数の DB 負荷をかけ、'
+        'レイテンシ (p50/p95/p99) を比較します。PostgreSQL が必要です。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--concurrency', default='8,32,64', help='同時実行スレッド数 (カンマ区切り)')
+        parser.add_argument('--duration', type=float, default=10.0, help='1回の計測秒数')
+        parser.add_argument('--max-size', type=int, default=POOL_DEFAULTS['MAX_SIZE'], help='プールの最大接続数')
+        parser.add_argument('--sql', default='SELECT 1', help='1リクエストで実行する SQL')
+        parser.add_argument('--output', help='計測結果を書き出す JSON ファイル')
+
+    def handle(self, *args, **options):
+        settings_dict = connections[options['database']].settings_dict
+        if settings_dict['ENGINE'] not in (POOL_ENGINE, PLAIN_ENGINE):
+            raise CommandError('The connection pool load test needs a PostgreSQL database.')
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma separated list of integers.')
+
+        variants = {
+            'plain': dict(settings_dict, ENGINE=PLAIN_ENGINE),
+            'pooled': dict(settings_dict, ENGINE=POOL_ENGINE, POOL={
+                **POOL_DEFAULTS, **settings_dict.get('POOL', {}), 'MAX_SIZE': options['max_size'],
+            }),
+        }
+        results = []
+
+        self.stdout.write(f'{"backend":<7} {"threads":>7} {"req/s":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"errors":>7}')
+        for concurrency in levels:
+            for name, variant in variants.items():
+                alias = f'omcen_loadtest_{name}_{concurrency}'
+                result = run_db_load(variant, concurrency, options['duration'], options['sql'], alias=alias)
+                result['backend'] = name
+                if name == 'pooled':
+                    result['pool'] = release_pool(alias)
+                results.append(result)
+                self.stdout.write(
+                    f'{name:<7} {concurrency:>7} {result["rps"]:>9.1f} {result["p50_ms"]:>7.2f}ms '
+                    f'{result["p95_ms"]:>7.2f}ms {result["p99_ms"]:>7.2f}ms {result["errors"]:>7}'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,23 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from omcen.counters import REBUILD_BATCH_SIZE, rebuild_counters
+
+
+class Command(BaseCommand):
+    help = (
+        '有効な加入からサービス・プランごとの加入者数と月間売上の集計を数え直します。'
+        'バッチごとに集計行をロックしてから数えるため、運用中に実行しても加入・解除を取りこぼしません。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('services', nargs='*', type=uuid.UUID, help='数え直すサービスの UUID (省略時は全サービス)')
+        parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH_SIZE, help='1トランザクションで数え直すサービス数')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        count = rebuild_counters(options['services'] or None, batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the counters of {count} services.'))
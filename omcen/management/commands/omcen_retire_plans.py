@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from omcen.retirement import PlanRetirer
+
+
+class Command(BaseCommand):
+    help = (
+        '削除・廃止されたプランの加入者を、キューに登録された順に移行先プランへ移すか登録解除します。'
+        '1バッチごとに短いトランザクションで処理し、進捗をプラン廃止の記録に残します。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='待機中の処理を終えたら終了する')
+        parser.add_argument('--batch-size', type=int, help='1トランザクションで処理する加入数の上限')
+        parser.add_argument('--max-lock-seconds', type=float, help='1バッチがロックを保持・待機する時間の上限[秒]')
+        parser.add_argument('--interval', type=float, default=5.0, help='キューが空のときの確認間隔[秒]')
+
+    def handle(self, *args, **options):
+        retirer = PlanRetirer(
+            batch_size=options['batch_size'], max_lock_seconds=options['max_lock_seconds'], stdout=self.stdout,
+        )
+        while True:
+            if retirer.run_once() is not None:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
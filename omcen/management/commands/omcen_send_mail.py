@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from omcen.mail import MailDeliverer
+from omcen.models import OutboundEmail
+
+
+class Command(BaseCommand):
+    help = 'キューに溜まったメールを1つの SMTP 接続でまとめて送信します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='送信待ちのメールを送り切ったら終了する')
+        parser.add_argument('--batch-size', type=int, default=100, help='1トランザクションで送信する件数')
+        parser.add_argument('--interval', type=float, default=5.0, help='キューが空のときの確認間隔[秒]')
+        parser.add_argument('--max-attempts', type=int, help='送信失敗とみなすまでの試行回数')
+        parser.add_argument('--keep-days', type=int, help='指定日数より前に送信済みのメールを削除する')
+
+    def handle(self, *args, **options):
+        with MailDeliverer(batch_size=options['batch_size'], max_attempts=options['max_attempts']) as deliverer:
+            while True:
+                sent, failed = deliverer.deliver_batch()
+                if sent or failed:
+                    self.stdout.write(f'sent={sent} failed={failed}')
+                    # 送信できなかった分は後回しになっているため、そのまま次のバッチへ進む
+                    if sent:
+                        continue
+
+                if options['keep_days'] is not None:
+                    self.purge(options['keep_days'])
+                if options['once']:
+                    break
+                # キューが空の間は接続を保持しない
+                deliverer.close()
+                time.sleep(options['interval'])
+
+    def purge(self, keep_days):
+        deleted, _ = OutboundEmail.objects.filter(
+            status=OutboundEmail.Status.SENT,
+            sent_at__lt=timezone.now() - timedelta(days=keep_days),
+        ).delete()
+        if deleted:
+            self.stdout.write(f'purged={deleted}')
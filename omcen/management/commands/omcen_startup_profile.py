@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from omcen.startup import profile_startup
+
+
+class Command(BaseCommand):
+    help = (
+        '新しいプロセスでワーカーと同じ手順で起動し、モジュールごとの import 時間と'
+        '最初のリクエストを返すまでの時間を計測します。\n'
+        '例: manage.py omcen_startup_profile --profile-settings config.settings_production --budget 1500'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/accounts/login/', help='最初のリクエストのパス')
+        parser.add_argument('--profile-settings', help='計測するプロセスの DJANGO_SETTINGS_MODULE (省略時は現在の設定)')
+        parser.add_argument('--top', type=int, default=20, help='表示するモジュール・パッケージの数')
+        parser.add_argument('--budget', type=float, help='最初のリクエストまでの許容時間[ms] (超えたら失敗)')
+        parser.add_argument('--output', help='計測結果を書き出す JSON ファイル')
+
+    def handle(self, *args, **options):
+        try:
+            result = profile_startup(options['path'], options['profile_settings'], options['top'])
+        except RuntimeError as e:
+            raise CommandError(f'Startup failed: {e}')
+
+        self.stdout.write('Phases (cumulative ms from the start of loading Django):')
+        for name in ('settings_ms', 'setup_ms', 'application_ms', 'first_request_ms'):
+            self.stdout.write(f'  {name[:-3]:<16} {result[name]:>9.1f}')
+        self.stdout.write(f'  {"second request":<16} {result["second_request_ms"]:>9.1f}')
+        self.stdout.write(f'First response: {result["status"]}; total imports {result["import_ms"]:.1f}ms; '
+                          f'process {result["process_ms"]:.1f}ms')
+
+        self.stdout.write('\nImport time by package (self):')
+        for package in result['packages']:
+            self.stdout.write(f'  {package["self_ms"]:>8.1f}ms  {package["package"]}')
+        self.stdout.write('\nSlowest modules (self / cumulative):')
+        for module in result['modules']:
+            self.stdout.write(f'  {module["self_ms"]:>8.1f}ms {module["cumulative_ms"]:>8.1f}ms  {module["module"]}')
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+
+        if options['budget'] is not None and result['first_request_ms'] > options['budget']:
+            raise CommandError(
+                f'Time to first request {result["first_request_ms"]:.1f}ms exceeds the budget of {options["budget"]:.1f}ms.'
+            )
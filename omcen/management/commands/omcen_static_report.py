@@ -0,0 +1,118 @@
+import gzip
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.http import HttpResponseNotFound
+from django.test import RequestFactory, override_settings
+
+from omcen.staticfiles import StaticFilesMiddleware, brotli
+
+_STATIC_TAG = re.compile(r"""{%\s*static\s+['"]([^'"]+)['"]\s*%}""")
+_EXTENDS = re.compile(r"""{%\s*extends\s+['"]([^'"]+)['"]\s*%}""")
+
+
+def template_assets(template_dir):
+    """Return ``{template: [static names]}`` for the templates in ``template_dir``, following {% extends %}."""
+    sources = {}
+    for filename in sorted(os.listdir(template_dir)):
+        if filename.endswith('.html'):
+            with open(os.path.join(template_dir, filename), encoding='utf-8') as f:
+                sources[f'omcen/{filename}'] = f.read()
+
+    def assets(name, seen=()):
+        source = sources.get(name, '')
+        names = _STATIC_TAG.findall(source)
+        for parent in _EXTENDS.findall(source):
+            if parent not in seen:
+                names += assets(parent, seen + (name,))
+        return list(dict.fromkeys(names))
+
+    return {name: assets(name) for name in sources}
+
+
+class Command(BaseCommand):
+    help = (
+        'templates/omcen の画面が読み込む静的ファイルについて、collectstatic (ハッシュ付き・事前圧縮) の結果を'
+        '一時ディレクトリに作り、転送量と配信時間を圧縮なし・毎回再検証の場合と比較します。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200, help='配信時間の計測回数')
+        parser.add_argument('--output', help='計測結果を書き出す JSON ファイル')
+
+    def handle(self, *args, **options):
+        pages = template_assets(os.path.join(settings.BASE_DIR, 'templates', 'omcen'))
+        names = sorted({name for assets in pages.values() for name in assets})
+
+        with tempfile.TemporaryDirectory() as root, override_settings(
+            STATIC_ROOT=root,
+            STATICFILES_STORAGE='omcen.staticfiles.CompressedManifestStaticFilesStorage',
+            OMCEN_SERVE_STATIC=True,
+        ):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            middleware = StaticFilesMiddleware(lambda request: HttpResponseNotFound())
+            assets = {name: self.measure(middleware, name, options['repeat']) for name in names}
+
+        if not brotli:
+            self.stdout.write('brotli is not installed; only gzip variants were generated.')
+        self.stdout.write(f'{"asset":<28} {"raw":>8} {"gzip":>8} {"br":>8} {"raw ms":>8} {"best ms":>8}  hashed name')
+        for name, asset in assets.items():
+            self.stdout.write(
+                f'{name:<28} {asset["raw_bytes"]:>8} {asset["gzip_bytes"]:>8} {asset["br_bytes"] or "-":>8} '
+                f'{asset["raw_ms"]:>8.3f} {asset["best_ms"]:>8.3f}  {asset["hashed_name"]}'
+            )
+
+        self.stdout.write('')
+        self.stdout.write(f'{"page":<34} {"first visit (raw -> best)":>26} {"repeat visit requests":>22}')
+        results = {'assets': assets, 'pages': {}}
+        for page, page_assets in pages.items():
+            raw = sum(assets[name]['raw_bytes'] for name in page_assets)
+            best = sum(assets[name]['best_bytes'] for name in page_assets)
+            # 変更前は毎回 If-Modified-Since で再検証し、変更後は immutable のため再取得しない
+            results['pages'][page] = {'raw_bytes': raw, 'best_bytes': best, 'revalidations_before': len(page_assets),
+                                      'revalidations_after': 0}
+            self.stdout.write(f'{page:<34} {raw:>12}B -> {best:>8}B {len(page_assets):>14} -> 0')
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+
+    def measure(self, middleware, name, repeat):
+        with open(finders.find(name), 'rb') as f:
+            data = f.read()
+        url = staticfiles_storage.url(name, force=True)
+        factory = RequestFactory()
+
+        def serve(accept_encoding):
+            timings, size, encoding = [], 0, None
+            for _ in range(repeat):
+                request = factory.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+                started = time.perf_counter()
+                response = middleware(request)
+                size = len(b''.join(response))
+                timings.append((time.perf_counter() - started) * 1000)
+                encoding = response.get('Content-Encoding')
+            return statistics.median(timings), size, encoding, response
+
+        raw_ms, raw_bytes, _, _ = serve('')
+        best_ms, best_bytes, encoding, response = serve('br, gzip')
+        return {
+            'hashed_name': url,
+            'raw_bytes': raw_bytes,
+            'gzip_bytes': len(gzip.compress(data, compresslevel=9, mtime=0)),
+            'br_bytes': len(brotli.compress(data, quality=11)) if brotli else None,
+            'best_bytes': best_bytes,
+            'best_encoding': encoding,
+            'raw_ms': round(raw_ms, 3),
+            'best_ms': round(best_ms, 3),
+            'cache_control': response['Cache-Control'],
+        }
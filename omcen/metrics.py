@@ -0,0 +1,230 @@
+import glob
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, math.inf)
+
+HISTOGRAMS = {
+    'omcen_request_duration_seconds': ('Total request latency per view.', LATENCY_BUCKETS),
+    'omcen_request_db_seconds': ('Time spent in database queries per view.', LATENCY_BUCKETS),
+    'omcen_request_template_seconds': ('Template render time per view.', LATENCY_BUCKETS),
+    'omcen_request_queries': ('Number of database queries per request.', QUERY_BUCKETS),
+}
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_histograms = defaultdict(dict)
+_collectors = []
+_last_flush = 0.0
+
+
+class Histogram:
+    def __init__(self, buckets, counts=None, total=0.0, count=0):
+        self.buckets = buckets
+        self.counts = counts or [0] * len(buckets)
+        self.sum = total
+        self.count = count
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation inside the matching bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            if seen + self.counts[i] >= rank and self.counts[i]:
+                lower = self.buckets[i - 1] if i else 0.0
+                if math.isinf(bound):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / self.counts[i]
+            seen += self.counts[i]
+        return self.buckets[-2]
+
+    def to_dict(self):
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+
+def register_collector(collector):
+    """
+    Register a callable returning ``{'counters': {...}, 'gauges': {...}}``;
+    it is evaluated on every snapshot.
+    """
+    _collectors.append(collector)
+
+
+def observe(name, view_name, value):
+    with _lock:
+        histogram = _histograms[name].get(view_name)
+        if histogram is None:
+            histogram = _histograms[name][view_name] = Histogram(HISTOGRAMS[name][1])
+        histogram.observe(value)
+
+
+def snapshot():
+    with _lock:
+        histograms = {
+            name: {view_name: histogram.to_dict() for view_name, histogram in views.items()}
+            for name, views in _histograms.items()
+        }
+    counters, gauges = {}, {}
+    for collector in _collectors:
+        values = collector()
+        counters.update(values.get('counters', {}))
+        gauges.update(values.get('gauges', {}))
+
+    return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+
+def _metrics_dir():
+    return getattr(settings, 'OMCEN_METRICS_DIR', None)
+
+
+def flush(force=False):
+    """
+    Write this process' snapshot to OMCEN_METRICS_DIR so that the metrics
+    endpoint of any worker can aggregate all gunicorn workers.
+    """
+    global _last_flush
+
+    directory = _metrics_dir()
+    now = time.monotonic()
+    if not directory or (not force and now - _last_flush < getattr(settings, 'OMCEN_METRICS_FLUSH_INTERVAL', 1.0)):
+        return
+    _last_flush = now
+
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def prune(directory=None):
+    """
+    Delete the snapshots of workers that have exited, and snapshots not
+    rewritten for OMCEN_METRICS_MAX_AGE seconds (e.g. when the PID was
+    reused). Returns the paths that are kept.
+    """
+    directory = directory or _metrics_dir()
+    if not directory:
+        return []
+
+    oldest = time.time() - getattr(settings, 'OMCEN_METRICS_MAX_AGE', 3600)
+    kept = []
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+        pid = os.path.basename(path)[len('metrics-'):].split('.', 1)[0]
+        try:
+            alive = pid.isdigit() and _pid_alive(int(pid)) and os.path.getmtime(path) >= oldest
+            if not alive:
+                os.remove(path)
+            elif path.endswith('.json'):
+                kept.append(path)
+        except OSError:
+            # 他のワーカーが同時に書き換え・削除した
+            continue
+    return kept
+
+
+def collect():
+    """Merge the snapshots of every worker (or only this process without OMCEN_METRICS_DIR)."""
+    snapshots = [snapshot()]
+    directory = _metrics_dir()
+    if directory:
+        own = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        # 終了したワーカーの値をいつまでも合算しないよう、読む前に消す
+        for path in prune(directory):
+            if path == own:
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    histograms = defaultdict(dict)
+    counters = defaultdict(float)
+    gauges = defaultdict(float)
+    for data in snapshots:
+        for name, views in data['histograms'].items():
+            for view_name, values in views.items():
+                histogram = Histogram(HISTOGRAMS[name][1], values['counts'], values['sum'], values['count'])
+                if view_name in histograms[name]:
+                    histograms[name][view_name].merge(histogram)
+                else:
+                    histograms[name][view_name] = histogram
+        for name, value in data['counters'].items():
+            counters[name] += value
+        for name, value in data['gauges'].items():
+            gauges[name] += value
+
+    return histograms, counters, gauges
+
+
+def _format_bound(bound):
+    return '+Inf' if math.isinf(bound) else repr(float(bound))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    histograms, counters, gauges = collect()
+    lines = []
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        views = histograms.get(name, {})
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for view_name, histogram in sorted(views.items()):
+            label = f'view="{_escape(view_name)}"'
+            cumulative = 0
+            for bound, count in zip(buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{_format_bound(bound)}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{label}}} {histogram.count}')
+
+        quantile_name = f'{name}_quantile'
+        lines.append(f'# HELP {quantile_name} p50/p95/p99 of {name} estimated from the histogram buckets.')
+        lines.append(f'# TYPE {quantile_name} gauge')
+        for view_name, histogram in sorted(views.items()):
+            for q in QUANTILES:
+                lines.append(f'{quantile_name}{{view="{_escape(view_name)}",quantile="{q}"}} {histogram.quantile(q)}')
+
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        for name, value in sorted(values.items()):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
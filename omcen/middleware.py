@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject
+
+from omcen import metrics
+from omcen.auth import get_user
+from omcen.entitlements import get_entitlements
+from omcen.queries import QueryInspector, execute_wrappers, get_query_budget
+from omcen.routers import (
+    choose_replica, current_routing_state, is_pinned, pin_to_primary, routing_state, uses_replica,
+)
+
+query_logger = logging.getLogger('omcen.queries')
+
+
+class AsyncCapableMiddleware:
+    """
+    Base for middleware that runs natively under both WSGI and ASGI, so that
+    async views are not forced back into a thread by a sync middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Django に非同期ミドルウェアとして扱わせる
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+# ログインユーザーをプロセス内キャッシュから取得し、リクエストごとの DB 参照をなくす
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+
+
+# request.entitlements でログインユーザーの加入中サービスを参照できるようにする
+class EntitlementMiddleware(AsyncCapableMiddleware):
+    def __call__(self, request):
+        request.entitlements = SimpleLazyObject(lambda: get_entitlements(request.user))
+
+        return self.get_response(request)
+
+
+# 閲覧画面の GET をレプリカから読み、書き込んだユーザーはしばらくプライマリに固定する
+class ReplicaRoutingMiddleware(AsyncCapableMiddleware):
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        with routing_state() as state:
+            response = self.get_response(request)
+        self.pin_writer(request, state)
+
+        return response
+
+    async def __acall__(self, request):
+        with routing_state() as state:
+            response = await self.get_response(request)
+        self.pin_writer(request, state)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD') or not uses_replica(view_func):
+            return None
+        # ユーザー (とセッション) はレプリカに切り替える前にプライマリから読む
+        user = request.user
+        if user.is_authenticated and is_pinned(user.pk):
+            return None
+
+        state = current_routing_state()
+        if state is not None:
+            state.replica = choose_replica()
+        return None
+
+    def pin_writer(self, request, state):
+        user = getattr(request, 'user', None)
+        if state.wrote and user is not None and user.is_authenticated:
+            pin_to_primary(user.pk)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+
+
+# ビューごとのクエリ数・DB時間・テンプレート描画時間・レイテンシを集計し Server-Timing で返す
+class MetricsMiddleware(AsyncCapableMiddleware):
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        stats = request._omcen_stats = RequestStats()
+        started = time.perf_counter()
+        with execute_wrappers(stats):
+            response = self.get_response(request)
+
+        return self.record(request, response, stats, started)
+
+    async def __acall__(self, request):
+        stats = request._omcen_stats = RequestStats()
+        started = time.perf_counter()
+        with execute_wrappers(stats):
+            response = await self.get_response(request)
+
+        return self.record(request, response, stats, started)
+
+    def record(self, request, response, stats, started):
+        total = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else '<unresolved>'
+        metrics.observe('omcen_request_duration_seconds', view_name, total)
+        metrics.observe('omcen_request_db_seconds', view_name, stats.db_time)
+        metrics.observe('omcen_request_template_seconds', view_name, stats.template_time)
+        metrics.observe('omcen_request_queries', view_name, stats.queries)
+        metrics.flush()
+
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+            f'tpl;dur={stats.template_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+        return response
+
+    def process_template_response(self, request, response):
+        stats = getattr(request, '_omcen_stats', None)
+        if stats is not None:
+            started = time.perf_counter()
+
+            def record(rendered):
+                stats.template_time += time.perf_counter() - started
+
+            response.add_post_render_callback(record)
+
+        return response
+
+
+# 開発時に N+1・重複クエリ・クエリ予算超過をログに出力する
+class QueryInspectorMiddleware(AsyncCapableMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'OMCEN_QUERY_INSPECTOR', settings.DEBUG):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        inspector = QueryInspector()
+        with inspector.capture():
+            response = self.get_response(request)
+
+        return self.report(request, response, inspector)
+
+    async def __acall__(self, request):
+        inspector = QueryInspector()
+        with inspector.capture():
+            response = await self.get_response(request)
+
+        return self.report(request, response, inspector)
+
+    def report(self, request, response, inspector):
+        # クエリ予算は GET (画面表示) に対する上限
+        match = getattr(request, 'resolver_match', None)
+        budget = get_query_budget(match.func) if match and request.method in ('GET', 'HEAD') else None
+        over_budget = budget is not None and len(inspector) > budget
+        if over_budget or inspector.findings():
+            query_logger.warning(
+                '%s %s (budget %s)\n%s', request.method, request.path, budget, inspector.report(),
+            )
+        response['X-Omcen-Queries'] = f'{len(inspector)}/{budget}' if budget is not None else str(len(inspector))
+
+        return response
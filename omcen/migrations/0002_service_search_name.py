@@ -0,0 +1,56 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:46
+
+import unicodedata
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+# カタカナ(ァ-ヶ, ヽヾ)をひらがなに寄せる (omcen.search.normalize_search_text のこの時点の複製)
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in list(range(0x30A1, 0x30F7)) + [0x30FD, 0x30FE]}
+
+
+def normalize_search_text(text):
+    text = unicodedata.normalize('NFKC', text or '')
+    return text.casefold().translate(_KATAKANA_TO_HIRAGANA).strip()
+
+
+def fill_search_name(apps, schema_editor):
+    Service = apps.get_model('omcen', 'Service')
+    services = list(Service.objects.using(schema_editor.connection.alias).only('uuid', 'service_name'))
+    for service in services:
+        service.search_name = normalize_search_text(service.service_name)
+    Service.objects.using(schema_editor.connection.alias).bulk_update(services, ['search_name'], batch_size=1000)
+
+
+class AddPostgreSQLIndex(migrations.AddIndex):
+    """AddIndex that only creates the index on PostgreSQL; SQLite searches with the in-process n-gram index."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='search_name',
+            field=models.CharField(default='', editable=False, max_length=128, verbose_name='検索用サービス名'),
+        ),
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+        TrigramExtension(),
+        AddPostgreSQLIndex(
+            model_name='service',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_name'], name='omcen_service_search_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
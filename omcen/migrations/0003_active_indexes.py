@@ -0,0 +1,77 @@
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, OuterRef, Subquery
+
+
+def fill_service(apps, schema_editor):
+    ServiceInUse = apps.get_model('omcen', 'ServiceInUse')
+    ServiceGroup = apps.get_model('omcen', 'ServiceGroup')
+    db_alias = schema_editor.connection.alias
+
+    ServiceInUse.objects.using(db_alias).update(
+        service_id=Subquery(
+            ServiceGroup.objects.using(db_alias).filter(pk=OuterRef('omcen_service_id')).values('service_id')[:1]
+        )
+    )
+
+
+def deactivate_duplicates(apps, schema_editor):
+    # 一意制約を張る前に、同じサービスで有効な登録が複数あれば最新の1件だけ残す
+    ServiceInUse = apps.get_model('omcen', 'ServiceInUse')
+    db_alias = schema_editor.connection.alias
+    active = ServiceInUse.objects.using(db_alias).filter(is_active=True)
+
+    duplicates = active.values('omcen_user_id', 'service_id').annotate(total=Count('uuid')).filter(total__gt=1)
+    for duplicate in duplicates.iterator():
+        rows = active.filter(
+            omcen_user_id=duplicate['omcen_user_id'],
+            service_id=duplicate['service_id'],
+        ).order_by('-updated_at', '-created_at')
+        latest = rows.values_list('uuid', flat=True).first()
+        rows.exclude(uuid=latest).update(is_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0002_service_search_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceinuse',
+            name='service',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='omcen.service'),
+        ),
+        migrations.RunPython(fill_service, migrations.RunPython.noop),
+        migrations.RunPython(deactivate_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='serviceinuse',
+            name='service',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='omcen.service'),
+        ),
+        migrations.AddIndex(
+            model_name='plan',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['service'], name='omcen_plan_active_service_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicegroup',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['service', 'plan'], name='omcen_sg_active_service_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceinuse',
+            index=models.Index(fields=['omcen_user', 'omcen_service', 'is_active'], name='omcen_siu_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceinuse',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['omcen_service'], name='omcen_siu_active_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceinuse',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['service'], name='omcen_siu_active_service_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='serviceinuse',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('omcen_user', 'service'), name='omcen_siu_one_active_per_service'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:07
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0003_active_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('from_email', models.CharField(max_length=320, verbose_name='送信元')),
+                ('recipients', models.JSONField(verbose_name='宛先')),
+                ('subject', models.CharField(blank=True, max_length=255, verbose_name='件名')),
+                ('message', models.BinaryField(verbose_name='メッセージ')),
+                ('status', models.CharField(choices=[('queued', '送信待ち'), ('sent', '送信済み'), ('failed', '送信失敗')], default='queued', max_length=10, verbose_name='状態')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='試行回数')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='次回送信日時')),
+                ('last_error', models.TextField(blank=True, verbose_name='最後のエラー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='送信日時')),
+            ],
+            options={
+                'verbose_name': '送信メール',
+                'verbose_name_plural': '送信メール',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboundemail',
+            index=models.Index(condition=models.Q(('status', 'queued')), fields=['next_attempt_at'], name='omcen_mail_queued_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0004_outboundemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanRetirement',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('plan_name', models.CharField(blank=True, max_length=32, verbose_name='プラン名')),
+                ('delete_plan', models.BooleanField(default=False, verbose_name='移行後にプランを削除する')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '実行中'), ('done', '完了'), ('failed', '失敗')], default='queued', max_length=10, verbose_name='状態')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='対象の加入数')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='処理済みの加入数')),
+                ('last_error', models.TextField(blank=True, verbose_name='最後のエラー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完了日時')),
+                ('plan', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='retirements', to='omcen.plan')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='omcen.service')),
+                ('target_plan', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='omcen.plan')),
+            ],
+            options={
+                'verbose_name': 'プラン廃止',
+                'verbose_name_plural': 'プラン廃止',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='planretirement',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('plan',), name='omcen_retirement_one_open_per_plan'),
+        ),
+    ]
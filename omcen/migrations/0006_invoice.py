@@ -0,0 +1,57 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0005_planretirement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Invoice',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('period_start', models.DateField(verbose_name='請求期間の開始日')),
+                ('period_end', models.DateField(verbose_name='請求期間の終了日')),
+                ('total', models.IntegerField(verbose_name='請求額')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('omcen_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '請求',
+                'verbose_name_plural': '請求',
+            },
+        ),
+        migrations.CreateModel(
+            name='InvoiceLine',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('plan_name', models.CharField(blank=True, max_length=32, verbose_name='プラン名')),
+                ('price', models.IntegerField(verbose_name='価格')),
+                ('started_at', models.DateTimeField(verbose_name='開始日時')),
+                ('ended_at', models.DateTimeField(verbose_name='終了日時')),
+                ('amount', models.IntegerField(verbose_name='金額')),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='omcen.invoice')),
+                ('plan', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='omcen.plan')),
+                ('service_in_use', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='omcen.serviceinuse')),
+            ],
+            options={
+                'verbose_name': '請求明細',
+                'verbose_name_plural': '請求明細',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['period_start'], name='omcen_invoice_period_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='invoice',
+            constraint=models.UniqueConstraint(fields=('omcen_user', 'period_start'), name='omcen_invoice_one_per_period'),
+        ),
+    ]
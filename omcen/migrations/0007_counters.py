@@ -0,0 +1,79 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+
+
+def fill_counters(apps, schema_editor):
+    # 既存の加入から初期値を作る (以降は omcen.counters が増減させる)
+    Service = apps.get_model('omcen', 'Service')
+    Plan = apps.get_model('omcen', 'Plan')
+    ServiceInUse = apps.get_model('omcen', 'ServiceInUse')
+    ServiceCounter = apps.get_model('omcen', 'ServiceCounter')
+    PlanCounter = apps.get_model('omcen', 'PlanCounter')
+    db_alias = schema_editor.connection.alias
+
+    active = ServiceInUse.objects.using(db_alias).filter(is_active=True).order_by()
+    by_plan = {
+        row['omcen_service__plan_id']: row
+        for row in active.values('omcen_service__plan_id').annotate(
+            subscribers=Count('uuid'), mrr=Sum('omcen_service__plan__price')
+        )
+    }
+    by_service = {
+        row['service_id']: row
+        for row in active.values('service_id').annotate(subscribers=Count('uuid'), mrr=Sum('omcen_service__plan__price'))
+    }
+
+    PlanCounter.objects.using(db_alias).bulk_create([
+        PlanCounter(
+            plan_id=plan_id, service_id=service_id,
+            subscribers=by_plan.get(plan_id, {}).get('subscribers', 0), mrr=by_plan.get(plan_id, {}).get('mrr') or 0,
+        )
+        for plan_id, service_id in Plan.objects.using(db_alias).values_list('pk', 'service_id')
+    ], batch_size=1000)
+    ServiceCounter.objects.using(db_alias).bulk_create([
+        ServiceCounter(
+            service_id=service_id,
+            subscribers=by_service.get(service_id, {}).get('subscribers', 0),
+            mrr=by_service.get(service_id, {}).get('mrr') or 0,
+        )
+        for service_id in Service.objects.using(db_alias).values_list('pk', flat=True)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0006_invoice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceCounter',
+            fields=[
+                ('service', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='omcen.service')),
+                ('subscribers', models.IntegerField(default=0, verbose_name='加入者数')),
+                ('mrr', models.BigIntegerField(default=0, verbose_name='月間売上')),
+            ],
+            options={
+                'verbose_name': 'サービスの加入集計',
+                'verbose_name_plural': 'サービスの加入集計',
+            },
+        ),
+        migrations.CreateModel(
+            name='PlanCounter',
+            fields=[
+                ('plan', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='omcen.plan')),
+                ('subscribers', models.IntegerField(default=0, verbose_name='加入者数')),
+                ('mrr', models.BigIntegerField(default=0, verbose_name='月間売上')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='plan_counters', to='omcen.service')),
+            ],
+            options={
+                'verbose_name': 'プランの加入集計',
+                'verbose_name_plural': 'プランの加入集計',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
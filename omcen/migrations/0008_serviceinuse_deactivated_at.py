@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:39
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_deactivated_at(apps, schema_editor):
+    # これまでは解除した加入の updated_at を解除日時として扱っていた
+    ServiceInUse = apps.get_model('omcen', 'ServiceInUse')
+    ServiceInUse.objects.using(schema_editor.connection.alias).filter(is_active=False).update(
+        deactivated_at=F('updated_at')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omcen', '0007_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceinuse',
+            name='deactivated_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='解除日時'),
+        ),
+        migrations.RunPython(fill_deactivated_at, migrations.RunPython.noop),
+    ]
@@ -6,11 +6,16 @@ from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.postgres.indexes import GinIndex
 from django.core.mail import send_mail
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from omcen.bulk import batched
+from omcen.hashing import ParallelPasswordHasher, password_to_hash, stored_password
+from omcen.search import normalize_search_text
+
 
 class OmcenUserManager(BaseUserManager):
     use_in_migrations = True
@@ -32,6 +37,37 @@ class OmcenUserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def create_users_bulk(self, users, hash_workers=None, chunk_size=200, batch_size=5000):
+        """
+        Create users from an iterable of dicts holding ``username``, ``email``,
+        ``password`` (or an already hashed ``password_hash``) and any extra
+        fields. Passwords are hashed in a process pool while the previous
+        batch is inserted with bulk_create.
+        Return the number of users processed.
+        """
+        GlobalUserModel = apps.get_model(self.model._meta.app_label, self.model._meta.object_name)
+        count = 0
+        with ParallelPasswordHasher(hash_workers, chunk_size) as hasher:
+            batches = batched(users, batch_size)
+            for batch, hashes in hasher.hash_batches(batches, password_to_hash):
+                objs = []
+                for user, password in zip(batch, hashes):
+                    extra_fields = {
+                        k: v for k, v in user.items() if k not in ('username', 'email', 'password', 'password_hash')
+                    }
+                    extra_fields.setdefault('is_staff', False)
+                    extra_fields.setdefault('is_superuser', False)
+                    objs.append(self.model(
+                        username=GlobalUserModel.normalize_username(user['username']),
+                        email=self.normalize_email(user.get('email')),
+                        password=stored_password(user, password),
+                        **extra_fields
+                    ))
+                self.bulk_create(objs, batch_size=batch_size)
+                count += len(objs)
+
+        return count
+
     def create_user(self, username, email=None, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', False)
         extra_fields.setdefault('is_superuser', False)
@@ -164,10 +200,58 @@ class OmcenUser(AbstractBaseUser, PermissionsMixin):
         send_mail(subject, message, from_email, [self.email], **kwargs)
 
 
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+class ServiceQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
+
+
+class PlanQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
+
+    def active_for_service(self, service):
+        return self.filter(service_id=_pk(service), is_active=True)
+
+
+class ServiceGroupQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
+
+    def active_for_service(self, service_name):
+        """Resolve the service name through the catalog and filter on service_id."""
+        from omcen.catalog import get_catalog
+
+        service_id = get_catalog().service_uuid_by_name.get(service_name)
+        if service_id is None:
+            return self.none()
+        return self.filter(service_id=service_id, is_active=True)
+
+
+class ServiceInUseQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True)
+
+    def active_for(self, user):
+        return self.filter(omcen_user_id=_pk(user), is_active=True)
+
+    def active_for_service(self, user, service):
+        return self.filter(omcen_user_id=_pk(user), service_id=_pk(service), is_active=True)
+
+
 class Service(models.Model):
     class Meta:
         verbose_name = _('サービス')
         verbose_name_plural = _('サービス')
+        indexes = [
+            # 部分一致検索 (LIKE '%...%') と類似度順に使う pg_trgm の索引 (PostgreSQL のみ作成される)
+            GinIndex(fields=['search_name'], name='omcen_service_search_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
+    objects = ServiceQuerySet.as_manager()
 
     uuid = models.UUIDField(
         default=uuid_lib.uuid4,
@@ -179,6 +263,12 @@ class Service(models.Model):
         max_length=32,
         unique=True,
     )
+    search_name = models.CharField(
+        _('検索用サービス名'),
+        max_length=128,
+        editable=False,
+        default='',
+    )
     is_active = models.BooleanField(
         _('active'),
         default=True,
@@ -196,11 +286,26 @@ class Service(models.Model):
         auto_now=True
     )
 
+    def save(self, *args, **kwargs):
+        self.search_name = normalize_search_text(self.service_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'service_name' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'search_name'}
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.service_name
+
 
 class Plan(models.Model):
     class Meta:
         verbose_name = _('プラン')
         verbose_name_plural = _('プラン')
+        indexes = [
+            models.Index(fields=['service'], condition=models.Q(is_active=True), name='omcen_plan_active_service_idx'),
+        ]
+
+    objects = PlanQuerySet.as_manager()
      
     uuid = models.UUIDField(
         default=uuid_lib.uuid4,
@@ -239,11 +344,19 @@ class Plan(models.Model):
         auto_now=True
     )
 
+    def __str__(self):
+        return f'{self.service.service_name} / {self.plan_name or "-"}'
+
 
 class ServiceGroup(models.Model):
     class Meta:
         verbose_name = _('サービスグループ')
         verbose_name_plural = _('サービスグループ')
+        indexes = [
+            models.Index(fields=['service', 'plan'], condition=models.Q(is_active=True), name='omcen_sg_active_service_idx'),
+        ]
+
+    objects = ServiceGroupQuerySet.as_manager()
 
     uuid = models.UUIDField(
         default=uuid_lib.uuid4,
@@ -275,11 +388,29 @@ class ServiceGroup(models.Model):
         auto_now=True
     )
 
+    def __str__(self):
+        return f'{self.service.service_name} / {self.plan.plan_name or "-"}'
+
 
 class ServiceInUse(models.Model):
     class Meta:
         verbose_name = _('加入中サービス')
         verbose_name_plural = _('加入中サービス')
+        indexes = [
+            models.Index(fields=['omcen_user', 'omcen_service', 'is_active'], name='omcen_siu_user_group_idx'),
+            models.Index(fields=['omcen_service'], condition=models.Q(is_active=True), name='omcen_siu_active_group_idx'),
+            models.Index(fields=['service'], condition=models.Q(is_active=True), name='omcen_siu_active_service_idx'),
+        ]
+        constraints = [
+            # 1ユーザーが同じサービスで有効にできるプランは1つだけ
+            models.UniqueConstraint(
+                fields=['omcen_user', 'service'],
+                condition=models.Q(is_active=True),
+                name='omcen_siu_one_active_per_service',
+            ),
+        ]
+
+    objects = ServiceInUseQuerySet.as_manager()
 
     uuid = models.UUIDField(
         default=uuid_lib.uuid4,
@@ -294,6 +425,12 @@ class ServiceInUse(models.Model):
         ServiceGroup,
         on_delete=models.CASCADE
     )
+    # 一意制約とサービス単位の集計のために ServiceGroup のサービスを複製して持つ
+    service = models.ForeignKey(
+        Service,
+        on_delete=models.CASCADE,
+        editable=False,
+    )
     is_active = models.BooleanField(
         _('active'),
         default=True,
@@ -310,3 +447,336 @@ class ServiceInUse(models.Model):
         _('更新日時'),
         auto_now=True
     )
+    # 日割り請求の終わりに使う登録解除の日時。解除したときだけ設定し、以降の保存では変えない
+    deactivated_at = models.DateTimeField(
+        _('解除日時'),
+        null=True,
+        blank=True,
+        editable=False
+    )
+
+    def save(self, *args, **kwargs):
+        if self.service_id is None:
+            self.service_id = self.omcen_service.service_id
+        if self.is_active:
+            self.deactivated_at = None
+        elif self.deactivated_at is None:
+            self.deactivated_at = timezone.now()
+        super().save(*args, **kwargs)
+
+
+class OutboundEmailQuerySet(models.QuerySet):
+    def due(self, now=None):
+        return self.filter(status=OutboundEmail.Status.QUEUED, next_attempt_at__lte=now or timezone.now())
+
+
+class OutboundEmail(models.Model):
+    """A message accepted by QueuedEmailBackend and waiting for the omcen_send_mail worker."""
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', _('送信待ち')
+        SENT = 'sent', _('送信済み')
+        FAILED = 'failed', _('送信失敗')
+
+    class Meta:
+        verbose_name = _('送信メール')
+        verbose_name_plural = _('送信メール')
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(status='queued'),
+                name='omcen_mail_queued_idx',
+            ),
+        ]
+
+    objects = OutboundEmailQuerySet.as_manager()
+
+    uuid = models.UUIDField(
+        default=uuid_lib.uuid4,
+        primary_key=True,
+        editable=False
+    )
+    # SMTP のエンベロープ (送信元・宛先) と送信する MIME メッセージ
+    from_email = models.CharField(
+        _('送信元'),
+        max_length=320
+    )
+    recipients = models.JSONField(
+        _('宛先')
+    )
+    subject = models.CharField(
+        _('件名'),
+        max_length=255,
+        blank=True
+    )
+    message = models.BinaryField(
+        _('メッセージ')
+    )
+    status = models.CharField(
+        _('状態'),
+        max_length=10,
+        choices=Status.choices,
+        default=Status.QUEUED
+    )
+    attempts = models.PositiveIntegerField(
+        _('試行回数'),
+        default=0
+    )
+    next_attempt_at = models.DateTimeField(
+        _('次回送信日時'),
+        default=timezone.now
+    )
+    last_error = models.TextField(
+        _('最後のエラー'),
+        blank=True
+    )
+    created_at = models.DateTimeField(
+        _('作成日時'),
+        auto_now_add=True
+    )
+    sent_at = models.DateTimeField(
+        _('送信日時'),
+        null=True,
+        blank=True
+    )
+
+
+class PlanRetirementQuerySet(models.QuerySet):
+    def open(self):
+        return self.filter(status__in=[PlanRetirement.Status.QUEUED, PlanRetirement.Status.RUNNING])
+
+
+class PlanRetirement(models.Model):
+    """
+    A queued request to move a plan's active subscribers to ``target_plan``
+    (or deactivate them) and optionally delete the plan afterwards, worked
+    off in batches by the omcen_retire_plans worker. A plan with
+    subscription history is kept deactivated instead, for billing.
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', _('待機中')
+        RUNNING = 'running', _('実行中')
+        DONE = 'done', _('完了')
+        FAILED = 'failed', _('失敗')
+
+    class Meta:
+        verbose_name = _('プラン廃止')
+        verbose_name_plural = _('プラン廃止')
+        constraints = [
+            # 1つのプランに同時に実行できる廃止処理は1つだけ
+            models.UniqueConstraint(
+                fields=['plan'],
+                condition=models.Q(status__in=['queued', 'running']),
+                name='omcen_retirement_one_open_per_plan',
+            ),
+        ]
+
+    objects = PlanRetirementQuerySet.as_manager()
+
+    uuid = models.UUIDField(
+        default=uuid_lib.uuid4,
+        primary_key=True,
+        editable=False
+    )
+    # 削除後も履歴を残すため、プランが消えたら NULL にしてプラン名を複製して持つ
+    plan = models.ForeignKey(
+        Plan,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='retirements'
+    )
+    plan_name = models.CharField(
+        _('プラン名'),
+        max_length=32,
+        blank=True
+    )
+    service = models.ForeignKey(
+        Service,
+        on_delete=models.CASCADE
+    )
+    # 移行先のプラン (NULL の場合は加入を無効にする)
+    target_plan = models.ForeignKey(
+        Plan,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    delete_plan = models.BooleanField(
+        _('移行後にプランを削除する'),
+        default=False
+    )
+    status = models.CharField(
+        _('状態'),
+        max_length=10,
+        choices=Status.choices,
+        default=Status.QUEUED
+    )
+    total = models.PositiveIntegerField(
+        _('対象の加入数'),
+        null=True,
+        blank=True
+    )
+    processed = models.PositiveIntegerField(
+        _('処理済みの加入数'),
+        default=0
+    )
+    last_error = models.TextField(
+        _('最後のエラー'),
+        blank=True
+    )
+    created_at = models.DateTimeField(
+        _('作成日時'),
+        auto_now_add=True
+    )
+    updated_at = models.DateTimeField(
+        _('更新日時'),
+        auto_now=True
+    )
+    finished_at = models.DateTimeField(
+        _('完了日時'),
+        null=True,
+        blank=True
+    )
+
+
+class Invoice(models.Model):
+    """What one user owes for one billing period, written by omcen_billing_run."""
+
+    class Meta:
+        verbose_name = _('請求')
+        verbose_name_plural = _('請求')
+        constraints = [
+            # 同じ期間を再実行しても二重に請求しない
+            models.UniqueConstraint(fields=['omcen_user', 'period_start'], name='omcen_invoice_one_per_period'),
+        ]
+        indexes = [
+            models.Index(fields=['period_start'], name='omcen_invoice_period_idx'),
+        ]
+
+    uuid = models.UUIDField(
+        default=uuid_lib.uuid4,
+        primary_key=True,
+        editable=False
+    )
+    omcen_user = models.ForeignKey(
+        OmcenUser,
+        on_delete=models.CASCADE
+    )
+    # 請求期間 [period_start, period_end)
+    period_start = models.DateField(
+        _('請求期間の開始日')
+    )
+    period_end = models.DateField(
+        _('請求期間の終了日')
+    )
+    total = models.IntegerField(
+        _('請求額')
+    )
+    created_at = models.DateTimeField(
+        _('作成日時'),
+        auto_now_add=True
+    )
+
+
+class InvoiceLine(models.Model):
+    """One subscription's (pro-rated) charge on an Invoice."""
+
+    class Meta:
+        verbose_name = _('請求明細')
+        verbose_name_plural = _('請求明細')
+
+    uuid = models.UUIDField(
+        default=uuid_lib.uuid4,
+        primary_key=True,
+        editable=False
+    )
+    invoice = models.ForeignKey(
+        Invoice,
+        on_delete=models.CASCADE,
+        related_name='lines'
+    )
+    # 加入・プランが削除されても明細は残すため、プラン名と価格を複製して持つ
+    service_in_use = models.ForeignKey(
+        ServiceInUse,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+'
+    )
+    plan = models.ForeignKey(
+        Plan,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='+'
+    )
+    plan_name = models.CharField(
+        _('プラン名'),
+        max_length=32,
+        blank=True
+    )
+    price = models.IntegerField(
+        _('価格')
+    )
+    # 請求期間のうち加入していた期間 [started_at, ended_at)
+    started_at = models.DateTimeField(
+        _('開始日時')
+    )
+    ended_at = models.DateTimeField(
+        _('終了日時')
+    )
+    amount = models.IntegerField(
+        _('金額')
+    )
+
+
+class ServiceCounter(models.Model):
+    """Active subscribers and monthly recurring revenue of a Service, maintained by omcen.counters."""
+
+    class Meta:
+        verbose_name = _('サービスの加入集計')
+        verbose_name_plural = _('サービスの加入集計')
+
+    service = models.OneToOneField(
+        Service,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counter'
+    )
+    subscribers = models.IntegerField(
+        _('加入者数'),
+        default=0
+    )
+    mrr = models.BigIntegerField(
+        _('月間売上'),
+        default=0
+    )
+
+
+class PlanCounter(models.Model):
+    """Active subscribers and monthly recurring revenue of a Plan, maintained by omcen.counters."""
+
+    class Meta:
+        verbose_name = _('プランの加入集計')
+        verbose_name_plural = _('プランの加入集計')
+
+    plan = models.OneToOneField(
+        Plan,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counter'
+    )
+    # サービス単位で読み出すため、プランのサービスを複製して持つ
+    service = models.ForeignKey(
+        Service,
+        on_delete=models.CASCADE,
+        related_name='plan_counters'
+    )
+    subscribers = models.IntegerField(
+        _('加入者数'),
+        default=0
+    )
+    mrr = models.BigIntegerField(
+        _('月間売上'),
+        default=0
+    )
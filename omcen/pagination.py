@@ -0,0 +1,261 @@
+import hashlib
+import json
+import uuid as uuid_lib
+from functools import reduce
+from operator import or_
+
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Q, QuerySet
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'omcen.pagination.cursor'
+
+
+def _normalize(value):
+    # UUID の文字列表現は数値順と同じ並びになる
+    if value is None:
+        return ''
+    if isinstance(value, uuid_lib.UUID):
+        return str(value)
+    return value
+
+
+def _resolve(obj, field):
+    for attname in field.split('__'):
+        obj = getattr(obj, attname)
+    return obj
+
+
+class KeysetPage:
+    def __init__(self, object_list, paginator, next_values=None, previous_values=None, cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        # 検証済みのカーソル (最初のページ・不正なカーソルは None)
+        self.cursor = cursor
+        self.next_token = paginator.encode(next_values, 'n') if next_values is not None else None
+        self.previous_token = paginator.encode(previous_values, 'p') if previous_values is not None else None
+
+    def __repr__(self):
+        return '<KeysetPage of %d objects>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    @property
+    def cursor_key(self):
+        """Identify the page by its validated cursor, e.g. in a template fragment cache key."""
+        if self.cursor is None:
+            return ''
+        return hashlib.md5(json.dumps(self.cursor, default=str).encode()).hexdigest()
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Cursor based paginator ordered by ``keys`` (the last key must be unique).
+    Every page costs one LIMIT query no matter how deep it is; the total
+    count is only computed when ``count_total`` is set.
+    Accepts a QuerySet or a list that is already sorted by ``keys``.
+    """
+
+    def __init__(self, object_list, per_page, keys, count_total=False):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.keys = [(key.lstrip('-'), key.startswith('-')) for key in keys]
+        self.count_total = count_total
+
+    @property
+    def count(self):
+        if not self.count_total:
+            return None
+        if isinstance(self.object_list, QuerySet):
+            return self.object_list.count()
+        return len(self.object_list)
+
+    def encode(self, values, direction):
+        return signing.dumps({'k': values, 'd': direction}, salt=CURSOR_SALT, compress=True)
+
+    def decode(self, token):
+        if not token:
+            return None, 'n'
+        try:
+            cursor = signing.loads(token, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None, 'n'
+        if len(cursor.get('k', ())) != len(self.keys) or cursor.get('d') not in ('n', 'p'):
+            return None, 'n'
+        return cursor['k'], cursor['d']
+
+    def page(self, token=None):
+        values, direction = self.decode(token)
+        if isinstance(self.object_list, QuerySet):
+            rows = self._slice_queryset(values, direction)
+            row_values = [[_normalize(getattr(row, f'keyset_{i}')) for i in range(len(self.keys))] for row in rows]
+        else:
+            rows = self._slice_list(values, direction)
+            row_values = [[_normalize(_resolve(row, field)) for field, _ in self.keys] for row in rows]
+
+        has_more = len(rows) > self.per_page
+        if direction == 'p':
+            # 逆順で取得しているので1件多い分は先頭側
+            rows, row_values = rows[:self.per_page][::-1], row_values[:self.per_page][::-1]
+            has_next, has_previous = True, has_more
+        else:
+            rows, row_values = rows[:self.per_page], row_values[:self.per_page]
+            has_next, has_previous = has_more, values is not None
+
+        cursor = (values, direction) if values is not None else None
+        if not rows:
+            return KeysetPage([], self, cursor=cursor)
+
+        return KeysetPage(
+            rows,
+            self,
+            next_values=row_values[-1] if has_next else None,
+            previous_values=row_values[0] if has_previous else None,
+            cursor=cursor,
+        )
+
+    def _slice_queryset(self, values, direction):
+        reverse = direction == 'p'
+        query_set = self.object_list.annotate(**{f'keyset_{i}': F(field) for i, (field, _) in enumerate(self.keys)})
+
+        if values is not None:
+            conditions = []
+            for i, (_, descending) in enumerate(self.keys):
+                lookup = 'lt' if descending != reverse else 'gt'
+                condition = {f'keyset_{j}': values[j] for j in range(i)}
+                condition[f'keyset_{i}__{lookup}'] = values[i]
+                conditions.append(Q(**condition))
+            query_set = query_set.filter(reduce(or_, conditions))
+
+        ordering = [
+            F(f'keyset_{i}').desc() if descending != reverse else F(f'keyset_{i}').asc()
+            for i, (_, descending) in enumerate(self.keys)
+        ]
+
+        return list(query_set.order_by(*ordering)[:self.per_page + 1])
+
+    def _compare(self, row, values):
+        for (field, descending), value in zip(self.keys, values):
+            row_value = _normalize(_resolve(row, field))
+            if row_value != value:
+                return (1 if row_value > value else -1) * (-1 if descending else 1)
+        return 0
+
+    def _slice_list(self, values, direction):
+        if values is None:
+            return self.object_list[:self.per_page + 1]
+
+        # values より後ろ(前)にある最初の位置を二分探索する
+        low, high = 0, len(self.object_list)
+        while low < high:
+            middle = (low + high) // 2
+            if self._compare(self.object_list[middle], values) <= 0:
+                low = middle + 1
+            else:
+                high = middle
+
+        if direction == 'p':
+            position = low
+            while position > 0 and self._compare(self.object_list[position - 1], values) >= 0:
+                position -= 1
+            return self.object_list[max(position - self.per_page - 1, 0):position][::-1]
+        return self.object_list[low:low + self.per_page + 1]
+
+
+def paginate(request, object_list, per_page, keys, count_total=False, cursor_kwarg='cursor'):
+    """
+    Return ``(paginator, page)`` for the cursor in ``request.GET``, with the
+    query strings of the neighbouring pages set on the page.
+    """
+    paginator = KeysetPaginator(object_list, per_page, keys, count_total=count_total)
+    page = paginator.page(request.GET.get(cursor_kwarg))
+
+    for name in ('next', 'previous'):
+        query = request.GET.copy()
+        query[cursor_kwarg] = getattr(page, f'{name}_token') or ''
+        setattr(page, f'{name}_query_string', query.urlencode())
+
+    return paginator, page
+
+
+def pagination_context(paginator, page):
+    """The pagination variables ListView puts in the template context."""
+    return {
+        'paginator': paginator,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
+        'object_list': page.object_list,
+    }
+
+
+class KeysetPaginationMixin:
+    """ListView mixin replacing OFFSET pagination with KeysetPaginator."""
+    keyset_fields = ('uuid',)
+    count_total = False
+    cursor_kwarg = 'cursor'
+
+    def get_keyset_fields(self):
+        return self.keyset_fields
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page = paginate(
+            self.request, queryset, page_size, self.get_keyset_fields(),
+            count_total=self.count_total, cursor_kwarg=self.cursor_kwarg,
+        )
+
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+def estimated_row_count(model, using):
+    """Return the planner's row estimate of ``model``'s table (PostgreSQL only), or None."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                       [connection.ops.quote_name(model._meta.db_table)])
+        row = cursor.fetchone()
+    # ANALYZE 前のテーブルは -1 になる
+    return int(row[0]) if row and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for admin changelists of large tables. The unfiltered count of
+    a table with at least ``estimate_threshold`` rows comes from
+    pg_class.reltuples, and filtered counts stop at ``count_limit`` rows, so
+    neither scans the whole table.
+    """
+    estimate_threshold = 100000
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        query_set = self.object_list
+        if not isinstance(query_set, QuerySet):
+            return len(query_set)
+
+        if not query_set.query.where:
+            estimate = estimated_row_count(query_set.model, query_set.db)
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        # 絞り込み後の件数は上限まで数え、それ以降のページは表示しない
+        return query_set.order_by()[:self.count_limit].count()
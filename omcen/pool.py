@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from collections import deque
+
+from omcen import metrics
+
+_STATS = ('checkouts', 'timeouts', 'wait_seconds', 'created', 'closed', 'health_check_failures')
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of DB-API connections for one database alias.
+
+    Idle connections are reused most-recently-used first. Connections older
+    than ``max_lifetime`` are replaced, and connections that sat idle longer
+    than ``check_interval`` are checked with ``check`` before they are handed
+    out. ``reset`` runs when a connection is returned (e.g. to roll back an
+    unfinished transaction); if it raises, the connection is discarded.
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=5.0, max_lifetime=1800.0,
+                 check_interval=30.0, check=None, reset=None):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('max_size must be positive and at least min_size.')
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.check = check
+        self.reset = reset
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        # (connection, 作成時刻, 最後に返却された時刻)
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._waiting = 0
+        self._stats = dict.fromkeys(_STATS, 0)
+
+    def _new_connection(self):
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats['created'] += 1
+            self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._created_at.pop(id(connection), None)
+            self._cond.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _usable(self, connection, created_at, returned_at, now):
+        if self.max_lifetime is not None and now - created_at > self.max_lifetime:
+            return False
+        if self.check is not None and self.check_interval is not None and now - returned_at > self.check_interval:
+            try:
+                self.check(connection)
+            except Exception:
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                return False
+        return True
+
+    def fill(self):
+        """Open connections until ``min_size`` exist."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            connection = self._new_connection()
+            self.putconn(connection)
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        if self._size < self.min_size:
+            self.fill()
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'No database connection available within {self.timeout}s '
+                            f'({self._size} in use, max_size={self.max_size}).'
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+                if self._idle:
+                    connection, created_at, returned_at = self._idle.pop()
+                else:
+                    connection = None
+                    self._size += 1
+
+            if connection is None:
+                connection = self._new_connection()
+            elif not self._usable(connection, created_at, returned_at, time.monotonic()):
+                self._discard(connection)
+                continue
+
+            with self._cond:
+                self._stats['checkouts'] += 1
+                self._stats['wait_seconds'] += time.monotonic() - started
+            return connection
+
+    def putconn(self, connection, discard=False):
+        if not discard and self.reset is not None:
+            try:
+                self.reset(connection)
+            except Exception:
+                discard = True
+        if discard or getattr(connection, 'closed', False):
+            self._discard(connection)
+            return
+
+        with self._cond:
+            created_at = self._created_at.get(id(connection), time.monotonic())
+            self._idle.append((connection, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """Close every idle connection; connections in use are closed when returned."""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiting': self._waiting,
+            })
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    """
+    Return the pool of ``alias`` in this process, creating it with
+    ``factory()``. A pool inherited through fork() is replaced, since its
+    sockets belong to the parent.
+    """
+    pool = _pools.get(alias)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[alias] = factory()
+        return pool
+
+
+def release_pool(alias):
+    """Close and forget the pool of ``alias``; return its final stats, or None if there was none."""
+    with _pools_lock:
+        pool = _pools.pop(alias, None)
+    if pool is None:
+        return None
+    pool.close()
+    return pool.stats()
+
+
+def _collect():
+    counters, gauges = {}, {}
+    for alias, pool in list(_pools.items()):
+        if pool.pid != os.getpid():
+            continue
+        prefix = 'omcen_db_pool' if alias == 'default' else f'omcen_db_pool_{alias}'
+        stats = pool.stats()
+        for name in ('size', 'idle', 'in_use', 'waiting'):
+            gauges[f'{prefix}_{name}'] = stats[name]
+        for name in _STATS:
+            counters[f'{prefix}_{name}_total'] = stats[name]
+    return {'counters': counters, 'gauges': gauges}
+
+
+metrics.register_collector(_collect)
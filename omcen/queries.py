@@ -0,0 +1,166 @@
+import functools
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Node
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 3
+
+_TRANSACTION_SQL = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.I)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.I)
+_SPACES = re.compile(r'\s+')
+
+_THIS_FILE = os.path.abspath(__file__)
+
+# 現在のリクエスト (コンテキスト) で有効な execute_wrapper。
+# sync_to_async のスレッドにも引き継がれるため、ASGI でも同じリクエストに集計される
+_active_wrappers = ContextVar('omcen_execute_wrappers', default=())
+
+Query = namedtuple('Query', ['alias', 'sql', 'params', 'duration', 'fingerprint', 'origin'])
+Finding = namedtuple('Finding', ['kind', 'fingerprint', 'count', 'origins'])
+
+
+def fingerprint(sql):
+    """Reduce SQL to its shape: literals become '?' and IN lists collapse to one placeholder."""
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql.replace('%s', '?'))
+    return _SPACES.sub(' ', sql).strip()
+
+
+def is_transaction_control(sql):
+    return bool(_TRANSACTION_SQL.match(sql))
+
+
+def _dispatch(execute, sql, params, many, context):
+    for wrapper in reversed(_active_wrappers.get()):
+        execute = functools.partial(wrapper, execute)
+    return execute(sql, params, many, context)
+
+
+def install_dispatcher(connection):
+    # execute_wrapper() は末尾を pop するため先頭に入れる
+    if _dispatch not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _dispatch)
+
+
+@contextmanager
+def execute_wrappers(*wrappers):
+    """
+    Apply ``wrappers`` to every query of the current context, on any
+    connection and in any thread that inherits the context.
+    """
+    for connection in connections.all():
+        install_dispatcher(connection)
+    token = _active_wrappers.set(_active_wrappers.get() + wrappers)
+    try:
+        yield
+    finally:
+        _active_wrappers.reset(token)
+
+
+def query_budget(budget):
+    """
+    Declare the maximum number of queries a GET of a function view may issue
+    (class-based views set a ``query_budget`` attribute instead).
+    """
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def get_query_budget(view_func):
+    view_class = getattr(view_func, 'view_class', None)
+    return getattr(view_class or view_func, 'query_budget', None)
+
+
+def _template_origin(frame):
+    # テンプレート描画中なら、描画中のノードの '<テンプレート>:<行番号>' を返す
+    while frame is not None:
+        # isinstance() は SimpleLazyObject を評価してしまうため type() で判定する
+        node = frame.f_locals.get('self')
+        if issubclass(type(node), Node) and getattr(node, 'origin', None) is not None:
+            name = node.origin.name
+            if os.path.isabs(name):
+                name = os.path.relpath(name, settings.BASE_DIR)
+            return f'{name}:{node.token.lineno}' if node.token else name
+        frame = frame.f_back
+    return None
+
+
+def find_origin(frame=None):
+    """Return where a query was issued: the template line, or else the innermost project frame."""
+    frame = frame or sys._getframe(1)
+    template = _template_origin(frame)
+    if template:
+        return template
+
+    base_dir = str(settings.BASE_DIR)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(base_dir) and filename != _THIS_FILE and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, base_dir)}:{frame.f_lineno} ({frame.f_code.co_name})'
+        frame = frame.f_back
+    return '<unknown>'
+
+
+class QueryInspector:
+    """
+    Record every query issued through the wrapped connections, with its
+    fingerprint and origin, to detect N+1 patterns and duplicate queries.
+    """
+
+    def __init__(self, n_plus_one_threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if not is_transaction_control(sql):
+                self.queries.append(Query(
+                    context['connection'].alias, sql, params, time.perf_counter() - started,
+                    fingerprint(sql), find_origin(sys._getframe(1)),
+                ))
+
+    @contextmanager
+    def capture(self):
+        with execute_wrappers(self):
+            yield self
+
+    def __len__(self):
+        return len(self.queries)
+
+    def findings(self):
+        by_fingerprint = defaultdict(list)
+        for query in self.queries:
+            by_fingerprint[(query.alias, query.fingerprint)].append(query)
+
+        findings = []
+        for (alias, shape), queries in by_fingerprint.items():
+            origins = sorted(Counter(query.origin for query in queries).items(), key=lambda item: -item[1])
+            identical = Counter((query.sql, repr(query.params)) for query in queries)
+            if len(identical) >= self.n_plus_one_threshold:
+                findings.append(Finding('n+1', shape, len(queries), origins))
+            elif max(identical.values()) > 1:
+                findings.append(Finding('duplicate', shape, len(queries), origins))
+        return findings
+
+    def report(self):
+        lines = [f'{len(self.queries)} queries, {sum(query.duration for query in self.queries) * 1000:.1f}ms']
+        for finding in self.findings():
+            lines.append(f'[{finding.kind}] x{finding.count} {finding.fingerprint}')
+            lines.extend(f'    {count}x {origin}' for origin, count in finding.origins)
+        return '\n'.join(lines)
@@ -0,0 +1,196 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from omcen.catalog import invalidate_catalog
+from omcen.counters import adjust_counters
+from omcen.entitlements import invalidate_entitlements
+from omcen.models import Plan, PlanRetirement, ServiceGroup, ServiceInUse
+
+logger = logging.getLogger(__name__)
+
+MIN_BATCH_SIZE = 10
+
+
+class RetirementError(Exception):
+    """The retirement cannot proceed, e.g. its target plan has no active ServiceGroup."""
+
+
+def enqueue_retirement(plan, target_plan=None, delete_plan=False):
+    """
+    Close ``plan`` to new subscriptions and queue the migration of its
+    subscribers. Only these few rows are written in the request; an open
+    retirement of the same plan is returned instead of queueing another.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        # update() は auto_now もシグナルも扱わないため、更新日時とカタログの無効化は明示する
+        Plan.objects.filter(pk=plan.pk).update(is_active=False, updated_at=now)
+        ServiceGroup.objects.filter(plan_id=plan.pk).update(is_active=False, updated_at=now)
+        transaction.on_commit(invalidate_catalog)
+
+        retirement = PlanRetirement.objects.open().filter(plan_id=plan.pk).first()
+        if retirement is None:
+            retirement = PlanRetirement.objects.create(
+                plan_id=plan.pk,
+                plan_name=plan.plan_name or '',
+                service_id=plan.service_id,
+                target_plan=target_plan,
+                delete_plan=delete_plan,
+            )
+
+    return retirement
+
+
+def set_lock_timeout(seconds):
+    # ロック待ちで上限を超えないよう、このトランザクションだけ lock_timeout を設定する
+    if seconds and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL lock_timeout = %s', [f'{int(seconds * 1000)}ms'])
+
+
+class PlanRetirer:
+    """
+    Work off PlanRetirement jobs. Each batch runs in its own transaction and
+    is sized so that it holds its row locks for at most ``max_lock_seconds``:
+    the batch shrinks after a slow batch and grows back up to ``batch_size``.
+    A batch that cannot get its locks within the limit is rolled back and
+    retried. Running jobs that stopped reporting progress for
+    ``stale_after`` seconds (a crashed worker) are picked up again.
+    """
+
+    def __init__(self, batch_size=None, max_lock_seconds=None, retries=5, stale_after=600, stdout=None):
+        self.max_batch_size = batch_size or getattr(settings, 'OMCEN_RETIREMENT_BATCH_SIZE', 1000)
+        self.batch_size = self.max_batch_size
+        self.max_lock_seconds = (
+            max_lock_seconds if max_lock_seconds is not None
+            else getattr(settings, 'OMCEN_RETIREMENT_MAX_LOCK_SECONDS', 1.0)
+        )
+        self.retries = retries
+        self.stale_after = stale_after
+        self.stdout = stdout
+
+    def claim(self):
+        """Mark the oldest waiting (or abandoned) job as running and return it, or None."""
+        stale = timezone.now() - timedelta(seconds=self.stale_after)
+        with transaction.atomic():
+            job = (
+                PlanRetirement.objects.select_for_update(skip_locked=True)
+                .filter(Q(status=PlanRetirement.Status.QUEUED) | Q(status=PlanRetirement.Status.RUNNING, updated_at__lt=stale))
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+
+            job.status = PlanRetirement.Status.RUNNING
+            if job.total is None:
+                job.total = ServiceInUse.objects.filter(omcen_service__plan_id=job.plan_id, is_active=True).count()
+            job.save(update_fields=['status', 'total', 'updated_at'])
+
+        return job
+
+    def run_once(self):
+        """Process one job to the end; return it, or None if the queue is empty."""
+        job = self.claim()
+        if job is None:
+            return None
+
+        try:
+            self.process(job)
+        except (RetirementError, OperationalError) as e:
+            logger.exception('Plan retirement %s failed', job.pk)
+            self.finish(job, PlanRetirement.Status.FAILED, str(e))
+        return job
+
+    def process(self, job):
+        group_ids = list(ServiceGroup.objects.filter(plan_id=job.plan_id).values_list('pk', flat=True))
+        target = None
+        if job.target_plan_id is not None:
+            target = ServiceGroup.objects.filter(plan_id=job.target_plan_id, is_active=True).first()
+            if target is None:
+                raise RetirementError('The target plan has no active service group.')
+
+        while self.timed(self.migrate_batch, job, group_ids, target):
+            self.log(job)
+
+        if job.delete_plan and job.plan_id is not None:
+            # 無効にした加入は日割り請求の履歴としてプラン・価格ごと残すため、加入のあったプランは
+            # 削除せず無効のままにする (論理削除)。一度も加入のなかったプランだけ削除する
+            with transaction.atomic():
+                set_lock_timeout(self.max_lock_seconds)
+                if not ServiceInUse.objects.filter(omcen_service_id__in=group_ids).exists():
+                    Plan.objects.filter(pk=job.plan_id).delete()
+
+        self.finish(job, PlanRetirement.Status.DONE)
+
+    def timed(self, batch, *args):
+        """Run ``batch`` in a transaction with retries on lock timeouts, adapting the batch size to the time it took."""
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            try:
+                with transaction.atomic():
+                    set_lock_timeout(self.max_lock_seconds)
+                    count = batch(*args)
+            except OperationalError:
+                if attempt == self.retries:
+                    raise
+                self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+                time.sleep(min(2 ** attempt * 0.1, 5))
+                continue
+
+            elapsed = time.monotonic() - started
+            if self.max_lock_seconds and elapsed > self.max_lock_seconds:
+                self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+            elif not self.max_lock_seconds or elapsed < self.max_lock_seconds / 4:
+                self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+            return count
+
+    def migrate_batch(self, job, group_ids, target):
+        rows = list(
+            ServiceInUse.objects.select_for_update()
+            .filter(omcen_service_id__in=group_ids, is_active=True)
+            .values_list('uuid', 'omcen_user_id', 'omcen_service_id')[:self.batch_size]
+        )
+        if not rows:
+            return 0
+
+        now = timezone.now()
+        user_ids = [user_id for _, user_id, _ in rows]
+        # 日割り計算に使うため、移行元の加入は無効にして履歴として残し、移行先の加入を新しく作る
+        ServiceInUse.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(
+            is_active=False, updated_at=now, deactivated_at=now
+        )
+        changes = [(service_group_id, -1) for _, _, service_group_id in rows]
+        if target is not None:
+            ServiceInUse.objects.bulk_create([
+                ServiceInUse(omcen_user_id=user_id, omcen_service_id=target.pk, service_id=target.service_id)
+                for user_id in user_ids
+            ])
+            changes.append((target.pk, len(rows)))
+        adjust_counters(changes)
+        invalidate_entitlements(*user_ids)
+
+        PlanRetirement.objects.filter(pk=job.pk).update(processed=F('processed') + len(rows), updated_at=now)
+        job.processed += len(rows)
+        return len(rows)
+
+    def finish(self, job, status, error=''):
+        job.status = status
+        job.last_error = error
+        job.finished_at = timezone.now()
+        PlanRetirement.objects.filter(pk=job.pk).update(
+            status=status, last_error=error, finished_at=job.finished_at, updated_at=job.finished_at
+        )
+        self.log(job)
+
+    def log(self, job):
+        if self.stdout is not None:
+            self.stdout.write(
+                f'{job.plan_name or job.plan_id}: {job.status} {job.processed}/{job.total} (batch size {self.batch_size})'
+            )
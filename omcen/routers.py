@@ -0,0 +1,101 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_KEY = 'omcen:primary-pin:{}'
+
+
+class RoutingState:
+    """Per-request routing decision, shared by every thread of the request's context."""
+
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+_state = ContextVar('omcen_routing_state', default=None)
+
+
+def replica_aliases():
+    return [alias for alias in getattr(settings, 'OMCEN_REPLICA_DATABASES', ()) if alias in settings.DATABASES]
+
+
+def choose_replica():
+    aliases = replica_aliases()
+    return random.choice(aliases) if aliases else None
+
+
+def read_replica(view):
+    """Allow a GET of a function view to read from a replica (class-based views set ``use_replica``)."""
+    view.use_replica = True
+    return view
+
+
+def uses_replica(view_func):
+    view_class = getattr(view_func, 'view_class', None)
+    return getattr(view_class or view_func, 'use_replica', False)
+
+
+def pin_to_primary(user_id):
+    # レプリカが追い付くまでの間、書き込んだユーザーの読み取りをプライマリに向ける。
+    # 次のリクエストは別のワーカーが受けることがあるため、共有キャッシュに置く (omcen.E004)
+    cache.set(PIN_KEY.format(user_id), True, getattr(settings, 'OMCEN_REPLICA_PIN_SECONDS', 10))
+
+
+def is_pinned(user_id):
+    return bool(cache.get(PIN_KEY.format(user_id)))
+
+
+def current_routing_state():
+    return _state.get()
+
+
+@contextmanager
+def routing_state():
+    state = RoutingState()
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary within the block, e.g. to build data that is cached for everyone."""
+    token = _state.set(None)
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Send the reads of replica-enabled views to a replica and everything else
+    to the primary. After the first write, the rest of the request also reads
+    from the primary, and ReplicaRoutingMiddleware pins the user to it.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.replica is None or state.wrote:
+            return DEFAULT_DB_ALIAS
+        # トランザクション中はプライマリの未コミットの変更を読めるようにする
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製のため、どちらから読んだオブジェクトでも関連付けられる
+        return True
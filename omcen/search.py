@@ -0,0 +1,94 @@
+import unicodedata
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import Case, Count, ExpressionWrapper, FloatField, IntegerField, Value, When, Window
+from django.db.models.functions import Cast
+
+# rank は類似度 (0〜1) を 10^-6 単位の整数にしたもの。float4 の類似度をそのまま
+# カーソル (JSON) に入れると往復で値が変わり、同じ rank の行の境界がずれるため
+RANK_SCALE = 1000000
+
+# カタカナ(ァ-ヶ, ヽヾ)をひらがなに寄せる
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in list(range(0x30A1, 0x30F7)) + [0x30FD, 0x30FE]}
+
+
+def normalize_search_text(text):
+    """
+    NFKC-normalize (half-width kana and full-width alphanumerics), casefold
+    and fold katakana to hiragana so that indexing and querying agree.
+    """
+    text = unicodedata.normalize('NFKC', text or '')
+    return text.casefold().translate(_KATAKANA_TO_HIRAGANA).strip()
+
+
+def ngrams(text, n=2):
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class NgramIndex:
+    """
+    In-process bigram index over the normalized service names, used when the
+    database has no trigram support (SQLite).
+    """
+
+    def __init__(self, services):
+        self._names = {}
+        self._postings = defaultdict(set)
+        for service in services:
+            self._names[service.pk] = service.search_name
+            for gram in ngrams(service.search_name) | ngrams(service.search_name, 1):
+                self._postings[gram].add(service.pk)
+
+    def search(self, text, limit=None):
+        """Return ``[(pk, rank), ...]`` of names containing ``text``, best first."""
+        grams = ngrams(text) if len(text) > 1 else ngrams(text, 1)
+        if not grams:
+            return []
+
+        candidates = set.intersection(*(self._postings.get(gram, set()) for gram in grams))
+        ranked = []
+        for pk in candidates:
+            name = self._names[pk]
+            if text in name:
+                ranked.append((pk, 2 * len(grams) / (len(grams) + len(ngrams(name)))))
+        ranked.sort(key=lambda item: (-item[1], self._names[item[0]]))
+
+        return ranked[:limit] if limit else ranked
+
+
+def search_services(query_set, text):
+    """
+    Filter ``query_set`` (Service) by the normalized name and annotate ``rank``
+    (the similarity as an integer out of RANK_SCALE, so that keyset cursors
+    compare exactly) and ``search_total``, the number of hits counted by the
+    same query.
+    """
+    normalized = normalize_search_text(text)
+
+    if connections[query_set.db].vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        # LIKE '%...%' は pg_trgm の GIN インデックスで処理される
+        query_set = query_set.filter(search_name__contains=normalized).annotate(
+            rank=Cast(
+                ExpressionWrapper(TrigramSimilarity('search_name', normalized) * RANK_SCALE, output_field=FloatField()),
+                IntegerField(),
+            )
+        )
+    else:
+        from omcen.catalog import get_catalog
+
+        # 件数 (search_total) が正しくなるよう、一致したサービスはすべて対象にする
+        ranked = get_catalog().search_index.search(normalized)
+        query_set = query_set.filter(pk__in=[pk for pk, _ in ranked]).annotate(
+            rank=Case(
+                *[When(pk=pk, then=Value(round(rank * RANK_SCALE))) for pk, rank in ranked],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+
+    return query_set.annotate(search_total=Window(Count('pk')))
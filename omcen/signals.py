@@ -0,0 +1,78 @@
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+
+from omcen.auth import invalidate_user
+from omcen.catalog import invalidate_catalog
+from omcen.counters import create_counters, reprice_plan
+from omcen.models import Service, Plan, ServiceGroup, OmcenUser
+from omcen.queries import install_dispatcher
+
+
+# カタログの変更はコミット後に反映する
+def invalidate_catalog_on_change(sender, **kwargs):
+    transaction.on_commit(invalidate_catalog)
+
+
+for model in (Service, Plan, ServiceGroup):
+    post_save.connect(invalidate_catalog_on_change, sender=model, dispatch_uid=f'omcen_catalog_{model.__name__}_save')
+    post_delete.connect(invalidate_catalog_on_change, sender=model, dispatch_uid=f'omcen_catalog_{model.__name__}_delete')
+
+
+# 加入・解除のたびに集計行の有無を確かめずに済むよう、サービス・プランの作成時に集計行も作る
+def create_service_counter(sender, instance, created, **kwargs):
+    if created:
+        create_counters(service_ids=[instance.pk])
+
+
+# 価格の変更で月間売上の集計がずれないよう、プランの保存時に数え直す
+def update_plan_counter(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        create_counters(plans=[instance])
+    elif update_fields is None or 'price' in update_fields:
+        reprice_plan(instance)
+
+
+post_save.connect(create_service_counter, sender=Service, dispatch_uid='omcen_counters_service_save')
+post_save.connect(update_plan_counter, sender=Plan, dispatch_uid='omcen_counters_plan_save')
+
+
+# プロフィール変更・停止・パスワード変更でキャッシュ済みのユーザーを破棄する
+def invalidate_user_on_change(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+post_save.connect(invalidate_user_on_change, sender=OmcenUser, dispatch_uid='omcen_user_save')
+post_delete.connect(invalidate_user_on_change, sender=OmcenUser, dispatch_uid='omcen_user_delete')
+
+
+# スレッドごとに作られる接続にもリクエスト単位の execute_wrapper を適用する
+def install_query_dispatcher(sender, connection, **kwargs):
+    install_dispatcher(connection)
+
+
+connection_created.connect(install_query_dispatcher, dispatch_uid='omcen_query_dispatcher')
+
+
+# Django 3.2 には CONN_HEALTH_CHECKS がないため、しばらく使われていなかった永続接続は
+# リクエストの開始時に疎通を確認し、切れていれば閉じて次のクエリで接続し直させる
+def check_connection_health(sender, **kwargs):
+    interval = getattr(settings, 'OMCEN_CONN_HEALTH_CHECK_INTERVAL', None)
+    if interval is None:
+        return
+
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        last_used = getattr(connection, 'omcen_last_request_at', now)
+        connection.omcen_last_request_at = now
+        if now - last_used > interval and not connection.is_usable():
+            connection.close()
+
+
+request_started.connect(check_connection_health, dispatch_uid='omcen_connection_health')
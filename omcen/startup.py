@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+_IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+_RESULT_PREFIX = 'omcen-startup:'
+
+
+def _first_request(path):
+    # 計測対象の子プロセスで実行する。ワーカーの起動と同じ順に読み込み、各段階の時刻を記録する
+    started = time.perf_counter()
+    timings = {}
+
+    import django
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    timings['settings_ms'] = time.perf_counter() - started
+
+    django.setup(set_prefix=False)
+    timings['setup_ms'] = time.perf_counter() - started
+
+    from django.core.handlers.wsgi import WSGIHandler
+    application = WSGIHandler()
+    timings['application_ms'] = time.perf_counter() - started
+
+    host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': host,
+        'SERVER_PORT': '443',
+        'HTTP_HOST': host,
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'https',
+    }
+    status = []
+    b''.join(application(environ, lambda line, headers, exc_info=None: status.append(line)))
+    timings['first_request_ms'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    b''.join(application(environ, lambda line, headers, exc_info=None: None))
+    timings['second_request_ms'] = time.perf_counter() - started
+
+    result = {name: round(value * 1000, 1) for name, value in timings.items()}
+    result['status'] = status[0]
+    print(_RESULT_PREFIX + json.dumps(result))
+
+
+def parse_import_times(lines):
+    """Parse ``python -X importtime`` output into ``[(module, self_us, cumulative_us, depth)]``."""
+    modules = []
+    for line in lines:
+        match = _IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+
+def profile_startup(path='/accounts/login/', settings_module=None, top=20):
+    """
+    Start a fresh interpreter with ``-X importtime``, load Django and the WSGI
+    application as a worker does and serve ``path`` once. Return the phase
+    timings, the slowest modules and the import time per top-level package.
+    """
+    env = dict(os.environ)
+    if settings_module:
+        env['DJANGO_SETTINGS_MODULE'] = settings_module
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'from omcen.startup import _first_request; _first_request({path!r})'],
+        env=env, capture_output=True, text=True,
+    )
+    wall_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    result = None
+    for line in process.stdout.splitlines():
+        if line.startswith(_RESULT_PREFIX):
+            result = json.loads(line[len(_RESULT_PREFIX):])
+    if process.returncode or result is None:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'startup failed')
+
+    modules = parse_import_times(process.stderr.splitlines())
+    packages = defaultdict(int)
+    for module, self_us, _, _ in modules:
+        packages[module.split('.')[0]] += self_us
+
+    result.update({
+        'process_ms': wall_ms,
+        'import_ms': round(sum(self_us for _, self_us, _, _ in modules) / 1000, 1),
+        'modules': [
+            {'module': module, 'self_ms': round(self_us / 1000, 1), 'cumulative_ms': round(cumulative_us / 1000, 1)}
+            for module, self_us, cumulative_us, _ in sorted(modules, key=lambda item: -item[1])[:top]
+        ],
+        'packages': [
+            {'package': package, 'self_ms': round(self_us / 1000, 1)}
+            for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        ],
+    })
+    return result
@@ -0,0 +1,172 @@
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.http import http_date
+
+from omcen.middleware import AsyncCapableMiddleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.svg', '.txt', '.html', '.json', '.xml', '.ico')
+# これより小さいファイルは圧縮しても効果がない
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+# ファイル名に付いたハッシュ (ManifestStaticFilesStorage の 12 桁)
+_HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^/.]+$')
+
+
+def compress_file(path):
+    """Write ``path``.gz (and ``path``.br with brotli) when it makes the file smaller; return the written paths."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    written = []
+    if len(data) < MIN_COMPRESS_SIZE:
+        return written
+
+    variants = [('.gz', lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', lambda: brotli.compress(data, quality=11)))
+    for suffix, compress in variants:
+        compressed = compress()
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that also writes gzip (and brotli) variants of
+    every hashed text asset during collectstatic, so nothing is compressed
+    per request.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        for hashed_name in set(self.hashed_files.values()):
+            if hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                compress_file(self.path(hashed_name))
+
+
+def accepted_encodings(header):
+    """Map each content-coding in an Accept-Encoding header to its q-value."""
+    qvalues = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    return qvalues
+
+
+class StaticFile:
+    def __init__(self, path, immutable):
+        self.path = path
+        self.immutable = immutable
+        stat = os.stat(path)
+        self.last_modified = http_date(stat.st_mtime)
+        self.version = f'{stat.st_size:x}-{int(stat.st_mtime):x}'
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        # (Content-Encoding, パス) を優先順に並べる
+        self.encodings = [
+            (encoding, path + suffix)
+            for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+            if os.path.exists(path + suffix)
+        ]
+
+    def select(self, accept_encoding):
+        qvalues = accepted_encodings(accept_encoding)
+        # q 値の高いものを選び、同じ値ならこちらの優先順 (br, gzip) に従う。q=0 は拒否
+        best = max(
+            ((qvalues.get(encoding, qvalues.get('*', 0.0)), -i, encoding, path)
+             for i, (encoding, path) in enumerate(self.encodings)),
+            default=None,
+        )
+        if best is None or best[0] <= 0:
+            return None, self.path
+        return best[2], best[3]
+
+
+def scan_static_root(root):
+    """Index the files below STATIC_ROOT by URL path relative to STATIC_URL."""
+    files = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(('.gz', '.br')) and os.path.exists(os.path.join(directory, filename[:-3])):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            files[name] = StaticFile(path, immutable=bool(_HASHED_NAME.search(name)))
+    return files
+
+
+# collectstatic で出力したファイルを、事前圧縮版と長期キャッシュ付きで配信する
+class StaticFilesMiddleware(AsyncCapableMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'OMCEN_SERVE_STATIC', False) or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.prefix = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else f'/{settings.STATIC_URL}'
+        self.files = scan_static_root(settings.STATIC_ROOT)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        response = self.serve(request)
+        return response if response is not None else self.get_response(request)
+
+    async def __acall__(self, request):
+        response = self.serve(request)
+        return response if response is not None else await self.get_response(request)
+
+    def serve(self, request):
+        if not request.path_info.startswith(self.prefix) or request.method not in ('GET', 'HEAD'):
+            return None
+        static_file = self.files.get(posixpath.normpath(request.path_info[len(self.prefix):]))
+        if static_file is None:
+            return None
+
+        encoding, path = static_file.select(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        # 圧縮方式ごとに別の表現のため ETag も分ける
+        etag = f'"{static_file.version}-{encoding}"' if encoding else f'"{static_file.version}"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=static_file.content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+
+        response['ETag'] = etag
+        response['Last-Modified'] = static_file.last_modified
+        if static_file.encodings:
+            response['Vary'] = 'Accept-Encoding'
+        if static_file.immutable:
+            response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response['Cache-Control'] = 'public, max-age=60'
+        return response
@@ -0,0 +1,79 @@
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from omcen.counters import adjust_counters
+from omcen.entitlements import invalidate_entitlements
+from omcen.models import OmcenUser, ServiceInUse
+
+SUBSCRIBE_ATTEMPTS = 3
+
+
+def subscribe(user, service_group):
+    """
+    Subscribe ``user`` to ``service_group``, deactivating any other plan of
+    the same service in the same transaction.
+    The user row is locked so concurrent requests of one user are serialized;
+    the partial unique constraint backs this up on databases without
+    SELECT ... FOR UPDATE.
+    Returns ``(service_in_use, previous)``; ``previous`` is the deactivated
+    subscription or None.
+    """
+    for attempt in range(SUBSCRIBE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                list(OmcenUser.objects.select_for_update().filter(pk=user.pk).values_list('pk', flat=True))
+                previous = ServiceInUse.objects.active_for_service(user, service_group.service_id).first()
+
+                if previous is not None and previous.omcen_service_id == service_group.pk:
+                    return previous, None
+
+                changes = [(service_group.pk, 1)]
+                if previous is not None:
+                    # 日割り計算に使うため update() でも解除日時を残す
+                    previous.is_active = False
+                    previous.updated_at = previous.deactivated_at = timezone.now()
+                    if ServiceInUse.objects.filter(pk=previous.pk, is_active=True).update(
+                        is_active=False, updated_at=previous.updated_at, deactivated_at=previous.deactivated_at
+                    ):
+                        changes.append((previous.omcen_service_id, -1))
+
+                service_in_use = ServiceInUse.objects.create(
+                    omcen_user_id=user.pk,
+                    omcen_service=service_group,
+                    service_id=service_group.service_id,
+                )
+                adjust_counters(changes)
+                invalidate_entitlements(user.pk)
+
+            return service_in_use, previous
+        except IntegrityError:
+            if attempt == SUBSCRIBE_ATTEMPTS - 1:
+                raise
+
+
+def unsubscribe(service_in_use):
+    with transaction.atomic():
+        service_in_use.is_active = False
+        service_in_use.updated_at = service_in_use.deactivated_at = timezone.now()
+        # 二重送信で集計を二度減らさないよう、有効な行だけを更新する
+        if ServiceInUse.objects.filter(pk=service_in_use.pk, is_active=True).update(
+            is_active=False, updated_at=service_in_use.updated_at, deactivated_at=service_in_use.deactivated_at
+        ):
+            adjust_counters([(service_in_use.omcen_service_id, -1)])
+        invalidate_entitlements(service_in_use.omcen_user_id)
+
+    return service_in_use
+
+
+def deactivate_user_subscriptions(user):
+    """Deactivate every active subscription of ``user``; returns the number of rows changed."""
+    with transaction.atomic():
+        rows = list(ServiceInUse.objects.active_for(user).select_for_update().values_list('pk', 'omcen_service_id'))
+        now = timezone.now()
+        count = ServiceInUse.objects.filter(pk__in=[pk for pk, _ in rows]).update(
+            is_active=False, updated_at=now, deactivated_at=now
+        )
+        adjust_counters((service_group_id, -1) for _, service_group_id in rows)
+        invalidate_entitlements(user.pk)
+
+    return count
@@ -0,0 +1,1823 @@
+import gzip
+import importlib
+import io
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import msgpack
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher, is_password_usable, make_password
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.utils import make_template_fragment_key
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.mail import send_mail
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import config.urls
+import omcen.auth
+import omcen.routers
+import omcen.urls
+from omcen import benchmark, metrics
+from omcen.billing import Period, run_billing
+from omcen.bulk import copy_field, copy_insert
+from omcen.checks import check_brotli_for_static_files, check_shared_cache_for_catalog, check_shared_cache_for_replicas, \
+    check_shared_cache_for_sessions, check_social_django_disabled
+from omcen.catalog import CATALOG_VERSION_KEY, CatalogSnapshot, get_catalog, invalidate_catalog
+from omcen.counters import COUNTER_CACHE_KEY, rebuild_counters
+from omcen.mail import MailDeliverer
+from omcen.models import OmcenUser, Service, Plan, ServiceGroup, ServiceInUse, OutboundEmail, PlanRetirement, Invoice, \
+    ServiceCounter, PlanCounter
+from omcen.entitlements import ENTITLEMENT_CACHE_KEY, entitlement_cache_stats, get_entitlements
+from omcen.hashing import ParallelPasswordHasher, hash_password, hashed_password
+from omcen.lifecycle import deactivate_service_subscriptions, set_services_active
+from omcen.loadtest import run_db_load
+from omcen.pagination import CURSOR_SALT, EstimatedCountPaginator, KeysetPaginator
+from omcen.pool import ConnectionPool, PoolTimeout, get_pool, release_pool
+from omcen.queries import QueryInspector, get_query_budget
+from omcen.retirement import PlanRetirer, enqueue_retirement
+from omcen.search import NgramIndex, normalize_search_text, search_services
+from omcen.routers import ReplicaRouter, is_pinned, pin_to_primary, routing_state, use_primary
+from omcen.signals import check_connection_health
+from omcen.startup import parse_import_times
+from omcen.staticfiles import StaticFile, accepted_encodings
+from omcen.subscriptions import subscribe, unsubscribe, deactivate_user_subscriptions
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+
+class ActiveIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('taro', 'taro@example.com', 'password')
+        cls.service = Service.objects.create(service_name='テスト')
+        cls.plan = Plan.objects.create(service=cls.service, plan_name='基本', price=100)
+        cls.service_group = ServiceGroup.objects.create(service=cls.service, plan=cls.plan)
+
+    def setUp(self):
+        # 行数が少ないとシーケンシャルスキャンが選ばれるため
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertUsesIndex(self, query_set, *index_names):
+        plan = query_set.explain()
+        self.assertTrue(any(name in plan for name in index_names), plan)
+
+    def test_active_for(self):
+        self.assertUsesIndex(
+            ServiceInUse.objects.active_for(self.user),
+            'omcen_siu_one_active_per_service', 'omcen_siu_user_group_idx',
+        )
+
+    def test_active_for_service(self):
+        self.assertUsesIndex(
+            ServiceInUse.objects.active_for_service(self.user, self.service),
+            'omcen_siu_one_active_per_service',
+        )
+
+    def test_active_subscribers_of_service_group(self):
+        self.assertUsesIndex(
+            ServiceInUse.objects.active().filter(omcen_service=self.service_group),
+            'omcen_siu_active_group_idx',
+        )
+
+    def test_active_plans_of_service(self):
+        self.assertUsesIndex(Plan.objects.active_for_service(self.service), 'omcen_plan_active_service_idx')
+
+    def test_active_service_groups_of_service(self):
+        self.assertUsesIndex(ServiceGroup.objects.active_for_service('テスト'), 'omcen_sg_active_service_idx')
+
+    def test_one_active_subscription_per_service(self):
+        other_plan = Plan.objects.create(service=self.service, plan_name='上位', price=500)
+        other_group = ServiceGroup.objects.create(service=self.service, plan=other_plan)
+        ServiceInUse.objects.create(omcen_user=self.user, omcen_service=self.service_group, is_active=False)
+        ServiceInUse.objects.create(omcen_user=self.user, omcen_service=self.service_group)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ServiceInUse.objects.create(omcen_user=self.user, omcen_service=other_group)
+
+
+class SubscribeTest(TransactionTestCase):
+    def setUp(self):
+        self.user = OmcenUser.objects.create_user('taro', 'taro@example.com', 'password')
+        self.service = Service.objects.create(service_name='テスト')
+        self.service_groups = []
+        for i in range(8):
+            plan = Plan.objects.create(service=self.service, plan_name=f'プラン{i}', price=100 * i)
+            self.service_groups.append(ServiceGroup.objects.create(service=self.service, plan=plan))
+
+    def test_switch_plan(self):
+        first, previous = subscribe(self.user, self.service_groups[0])
+        self.assertIsNone(previous)
+
+        with CaptureQueriesContext(connection) as queries:
+            second, previous = subscribe(self.user, self.service_groups[1])
+
+        # ロック・現在の登録・無効化・登録の4回と、新旧プラン・サービスの集計の加算3回 (BEGIN を除く)
+        self.assertEqual(len([query for query in queries if query['sql'] != 'BEGIN']), 7)
+
+        self.assertEqual(previous.pk, first.pk)
+        self.assertEqual(list(ServiceInUse.objects.active_for(self.user)), [second])
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_subscribe(self):
+        barrier = threading.Barrier(len(self.service_groups))
+        errors = []
+
+        def run(service_group):
+            try:
+                barrier.wait()
+                subscribe(self.user, service_group)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(service_group,)) for service_group in self.service_groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(ServiceInUse.objects.active_for_service(self.user, self.service).count(), 1)
+        self.assertEqual(ServiceInUse.objects.filter(omcen_user=self.user).count(), len(self.service_groups))
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class BenchmarkTest(TestCase):
+    def test_every_view_responds(self):
+        benchmark.seed(users=5, services=3, plans=6, subscriptions=10)
+        invalidate_catalog()
+        results = benchmark.run(repeat=1, api_checks=20)
+
+        self.assertIn('omcen:service_unsubscribe', results)
+        self.assertEqual(results['omcen:api_entitlements (batch of 20)']['queries'], 1)
+        for label, result in results.items():
+            self.assertLess(result['status'], 400, label)
+        self.assertEqual(benchmark.compare(results, results), [])
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False, **benchmark.SHARED_CACHE_SETTINGS)
+class QueryBudgetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # 1ユーザーあたり4件加入し、N+1 が検出できる件数にする
+        benchmark.seed(users=3, services=4, plans=8, subscriptions=12)
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_every_view_declares_budget(self):
+        for pattern in omcen.urls.urlpatterns:
+            self.assertIsNotNone(get_query_budget(pattern.callback), pattern.name)
+
+    def test_views_within_budget(self):
+        with override_settings(ROOT_URLCONF=benchmark.bench_urlconf()):
+            user, urls = benchmark.bench_requests()
+            self.client.force_login(user)
+            for label, url in urls.items():
+                with self.subTest(label):
+                    # カタログ・加入中サービスのキャッシュを温めてから計測する
+                    self.client.get(url)
+                    inspector = QueryInspector()
+                    with inspector.capture():
+                        response = self.client.get(url)
+
+                    self.assertLessEqual(len(inspector), get_query_budget(response.resolver_match.func), inspector.report())
+                    self.assertEqual(inspector.findings(), [], inspector.report())
+
+    def test_detects_n_plus_one(self):
+        inspector = QueryInspector()
+        with inspector.capture():
+            for service_in_use in ServiceInUse.objects.all():
+                service_in_use.omcen_service
+
+        finding, = inspector.findings()
+        self.assertEqual(finding.kind, 'n+1')
+        self.assertEqual(finding.count, 12)
+        self.assertIn('omcen/tests.py', finding.origins[0][0])
+
+
+@override_settings(OMCEN_QUERY_INSPECTOR=False, **benchmark.SHARED_CACHE_SETTINGS)
+class AsyncViewTest(TestCase):
+    async_views = ('service_list', 'plan_selection', 'service_in_use_list', 'my_page')
+
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.seed(users=3, services=4, plans=8, subscriptions=12)
+
+    def setUp(self):
+        invalidate_catalog()
+        self.addCleanup(self.reload_urls)
+
+    def reload_urls(self):
+        # ルートの同期・非同期は URLconf の読み込み時に決まる
+        importlib.reload(omcen.urls)
+        importlib.reload(config.urls)
+
+    def get_pages(self, client, get):
+        with override_settings(ROOT_URLCONF=benchmark.bench_urlconf()):
+            user, urls = benchmark.bench_requests()
+            client.force_login(user)
+            pages = {}
+            for name in self.async_views:
+                get(urls[f'omcen:{name}'])
+                inspector = QueryInspector()
+                with inspector.capture():
+                    response = get(urls[f'omcen:{name}'])
+                pages[name] = (response, inspector)
+        return pages
+
+    async def async_get(self, path):
+        return await self.async_client.get(path)
+
+    def test_async_views_match_sync_views(self):
+        sync_pages = self.get_pages(self.client, self.client.get)
+        with override_settings(OMCEN_ASYNC_VIEWS=list(self.async_views)):
+            self.reload_urls()
+            async_pages = self.get_pages(self.async_client, async_to_sync(self.async_get))
+
+        def content(response):
+            return re.sub(r'name="csrfmiddlewaretoken" value="[^"]*"', '', response.content.decode())
+
+        for name in self.async_views:
+            with self.subTest(name):
+                (sync_response, _), (async_response, inspector) = sync_pages[name], async_pages[name]
+                self.assertTrue(async_response.resolver_match.func.__name__.endswith('_async'))
+                self.assertEqual(async_response.status_code, 200)
+                self.assertEqual(content(async_response), content(sync_response))
+                self.assertEqual(async_response.get('ETag'), sync_response.get('ETag'))
+                self.assertLessEqual(len(inspector), get_query_budget(async_response.resolver_match.func))
+
+
+@override_settings(OMCEN_QUERY_INSPECTOR=False, **benchmark.SHARED_CACHE_SETTINGS)
+class CachedUserTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('hanako', 'hanako@example.com', 'password')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('omcen:my_page'))
+
+    def test_no_queries_for_authenticated_request(self):
+        inspector = QueryInspector()
+        with inspector.capture():
+            response = self.client.get(reverse('omcen:my_page'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(inspector), 0, inspector.report())
+
+    def test_profile_change_invalidates_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('omcen:change_profile', args=[self.user.pk]),
+                {'username': 'hanako', 'email': 'hanako@example.com', 'first_name': '花子', 'last_name': '山田'},
+            )
+        self.assertEqual(response.status_code, 302)
+
+        self.assertContains(self.client.get(reverse('omcen:my_page')), '花子')
+
+    def test_password_change_logs_out(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('new-password')
+            self.user.save()
+
+        response = self.client.get(reverse('omcen:my_page'))
+        self.assertRedirects(response, f'{reverse("account_login")}?next={reverse("omcen:my_page")}', fetch_redirect_response=False)
+
+    def test_inactive_user_is_not_served_from_cache(self):
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        self.client.get(reverse('omcen:my_page'))
+        # 無効化が届く前にキャッシュされた停止済みユーザー
+        OmcenUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        _, _, cached = omcen.auth._users[str(self.user.pk)]
+        cached.is_active = False
+
+        response = self.client.get(reverse('omcen:my_page'))
+        self.assertRedirects(response, f'{reverse("account_login")}?next={reverse("omcen:my_page")}', fetch_redirect_response=False)
+
+    def test_invalidation_reaches_other_workers(self):
+        with tempfile.TemporaryDirectory() as location:
+            shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': shared}):
+                self.client.force_login(self.user)
+                self.client.get(reverse('omcen:my_page'))
+
+                # 別のワーカー (別のプロセス内キャッシュ・同じ共有キャッシュ) でプロフィールを変更する
+                other_worker = FileBasedCache(location, {})
+                with mock.patch.object(omcen.auth, 'cache', other_worker), \
+                        mock.patch.object(omcen.auth, '_users', OrderedDict()):
+                    with self.captureOnCommitCallbacks(execute=True):
+                        self.user.first_name = '花子'
+                        self.user.save()
+
+                self.assertContains(self.client.get(reverse('omcen:my_page')), '花子')
+
+    def test_process_local_cache_is_refused(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=locmem):
+            self.assertEqual([error.id for error in check_shared_cache_for_sessions(None)], ['omcen.E001', 'omcen.E002'])
+        with override_settings(CACHES=locmem, SESSION_ENGINE='django.contrib.sessions.backends.db', OMCEN_USER_CACHE=False):
+            self.assertEqual(check_shared_cache_for_sessions(None), [])
+
+
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('jiro', 'jiro@example.com', 'password')
+        cls.service = Service.objects.create(service_name='テスト')
+        cls.plan = Plan.objects.create(service=cls.service, plan_name='基本', price=100)
+        cls.service_group = ServiceGroup.objects.create(service=cls.service, plan=cls.plan)
+
+    def setUp(self):
+        invalidate_catalog()
+        self.client.force_login(self.user)
+        self.url = reverse('omcen:plan_selection', args=[self.service.service_name])
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_subscription_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            subscribe(self.user, self.service_group)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '登録中')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_catalog_change_refreshes_fragment(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plan.price = 200
+            self.plan.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '200')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_is_per_user(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(OmcenUser.objects.create_user('saburo', 'saburo@example.com', 'password'))
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class StartupTest(TransactionTestCase):
+    def test_parse_import_times(self):
+        modules = parse_import_times([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       120 |        120 |     django.utils.version',
+            'import time:      2500 |       2620 | django',
+        ])
+        self.assertEqual(modules, [('django.utils.version', 120, 120, 2), ('django', 2500, 2620, 0)])
+
+    @override_settings(OMCEN_CONN_HEALTH_CHECK_INTERVAL=60)
+    def test_idle_connection_is_checked_before_reuse(self):
+        connection.ensure_connection()
+        with mock.patch.object(connection, 'is_usable', return_value=False) as is_usable, \
+                mock.patch.object(connection, 'close') as close:
+            check_connection_health(sender=self.__class__)
+            is_usable.assert_not_called()
+
+            connection.omcen_last_request_at -= 120
+            check_connection_health(sender=self.__class__)
+
+        is_usable.assert_called_once()
+        close.assert_called_once()
+
+    def test_disabled_social_django_has_no_references(self):
+        # 開発設定のままでは設定・import ともに social_django が残っている
+        with override_settings(OMCEN_SOCIAL_DJANGO=False):
+            messages = [error.msg for error in check_social_django_disabled(None)]
+        self.assertTrue(any('settings.INSTALLED_APPS: social_django' in message for message in messages))
+        self.assertTrue(any('import: social_django' in message for message in messages))
+
+        def without_social(values):
+            return [value for value in values if not value.startswith(('social_django', 'social_core'))]
+
+        templates = [dict(settings.TEMPLATES[0], OPTIONS=dict(
+            settings.TEMPLATES[0]['OPTIONS'],
+            context_processors=without_social(settings.TEMPLATES[0]['OPTIONS']['context_processors']),
+        ))]
+        disabled = override_settings(
+            OMCEN_SOCIAL_DJANGO=False,
+            INSTALLED_APPS=without_social(settings.INSTALLED_APPS),
+            MIDDLEWARE=without_social(settings.MIDDLEWARE),
+            AUTHENTICATION_BACKENDS=without_social(settings.AUTHENTICATION_BACKENDS),
+        )
+        modules = {name: module for name, module in sys.modules.items() if not name.startswith(('social_django', 'social_core'))}
+        with disabled, mock.patch.dict(sys.modules, modules, clear=True):
+            with override_settings(TEMPLATES=templates):
+                self.assertEqual(check_social_django_disabled(None), [])
+
+            with tempfile.TemporaryDirectory(dir=settings.BASE_DIR) as directory:
+                with open(os.path.join(directory, 'login.html'), 'w', encoding='utf-8') as f:
+                    f.write("<a href=\"{% url 'social:begin' 'google-oauth2' %}\">Google</a>")
+                with override_settings(TEMPLATES=[dict(templates[0], DIRS=[directory])]):
+                    errors = check_social_django_disabled(None)
+
+        self.assertEqual([error.id for error in errors], ['omcen.E005'])
+        self.assertIn('login.html', errors[0].msg)
+
+
+class _FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(_FakeConnection, max_size=2)
+        connection = pool.getconn()
+        pool.putconn(connection)
+
+        self.assertIs(pool.getconn(), connection)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_checkout_waits_for_a_returned_connection(self):
+        pool = ConnectionPool(_FakeConnection, max_size=1, timeout=2)
+        connection = pool.getconn()
+        threading.Timer(0.05, pool.putconn, [connection]).start()
+
+        self.assertIs(pool.getconn(), connection)
+        self.assertGreater(pool.stats()['wait_seconds'], 0)
+
+    def test_checkout_timeout(self):
+        pool = ConnectionPool(_FakeConnection, max_size=1, timeout=0.01)
+        pool.getconn()
+
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_broken_and_expired_connections_are_replaced(self):
+        def check(connection):
+            raise OSError('server closed the connection')
+
+        pool = ConnectionPool(_FakeConnection, max_size=1, check_interval=0, check=check)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        self.assertIsNot(pool.getconn(), connection)
+        self.assertTrue(connection.closed)
+
+        pool = ConnectionPool(_FakeConnection, max_size=1, max_lifetime=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        self.assertIsNot(pool.getconn(), connection)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_metrics(self):
+        pool = get_pool('omcen_test', lambda: ConnectionPool(_FakeConnection, min_size=2))
+        self.addCleanup(release_pool, 'omcen_test')
+        pool.getconn()
+
+        gauges = metrics.snapshot()['gauges']
+        self.assertEqual(gauges['omcen_db_pool_omcen_test_in_use'], 1)
+        self.assertEqual(gauges['omcen_db_pool_omcen_test_idle'], 1)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL')
+class PooledBackendTest(TransactionTestCase):
+    def test_backend_reuses_connections(self):
+        settings_dict = dict(connection.settings_dict, ENGINE='omcen.backends.postgresql_pool', POOL={'MAX_SIZE': 2})
+        result = run_db_load(settings_dict, concurrency=4, duration=0.5, sql='SELECT pg_backend_pid()')
+        stats = release_pool('omcen_loadtest')
+
+        self.assertEqual(result['errors'], 0)
+        self.assertLessEqual(stats['created'], 2)
+        self.assertGreater(stats['checkouts'], stats['created'])
+
+
+@unittest.skipUnless('replica' in settings.DATABASES, 'needs a replica alias (set REPLICA_DATABASE_URL)')
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class ReplicaRoutingTest(TransactionTestCase):
+    databases = set(settings.DATABASES)
+
+    def setUp(self):
+        # レプリカが遅れている状態を再現するため、データはプライマリにだけ作る
+        invalidate_catalog()
+        self.user = OmcenUser.objects.create_user('shiro', 'shiro@example.com', 'password')
+        service = Service.objects.create(service_name=f'{benchmark.BENCH_PREFIX}replica')
+        plan = Plan.objects.create(service=service, plan_name='基本', price=100)
+        self.service_group = ServiceGroup.objects.create(service=service, plan=plan)
+        self.client.force_login(self.user)
+        # ユーザーはキャッシュ (またはプライマリ) から読むため、先に読み込んでおく
+        self.client.get(reverse('omcen:my_page'))
+
+    def get_in_use_list(self):
+        inspector = QueryInspector()
+        with inspector.capture():
+            response = self.client.get(reverse('omcen:service_in_use_list'))
+        return response, {query.alias for query in inspector.queries}
+
+    def test_read_view_reads_from_replica(self):
+        subscribe(self.user, self.service_group)
+
+        response, aliases = self.get_in_use_list()
+        self.assertNotContains(response, '基本')
+        self.assertEqual(aliases, {'replica'})
+
+    def test_writer_is_pinned_to_primary(self):
+        with override_settings(ROOT_URLCONF=benchmark.bench_urlconf()):
+            response = self.client.post(reverse('omcen:service_subscribe', args=[self.service_group.pk]))
+        self.assertEqual(response.status_code, 302)
+
+        response, aliases = self.get_in_use_list()
+        self.assertContains(response, '基本')
+        self.assertEqual(aliases, {'default'})
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Service), 'default')
+        with routing_state() as state:
+            state.replica = 'replica'
+            self.assertEqual(router.db_for_read(Service), 'replica')
+            with use_primary():
+                self.assertEqual(router.db_for_read(Service), 'default')
+
+            router.db_for_write(Service)
+            self.assertEqual(router.db_for_read(Service), 'default')
+
+
+class PrimaryPinTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('goro', 'goro@example.com', 'password')
+        service = Service.objects.create(service_name='テスト')
+        plan = Plan.objects.create(service=service, plan_name='基本', price=100)
+        cls.service_group = ServiceGroup.objects.create(service=service, plan=plan)
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_pin_reaches_other_workers(self):
+        with tempfile.TemporaryDirectory() as location:
+            shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': shared}):
+                pin_to_primary(self.user.pk)
+                # 登録後のリダイレクトを受ける別のワーカー
+                with mock.patch.object(omcen.routers, 'cache', FileBasedCache(location, {})):
+                    self.assertTrue(is_pinned(self.user.pk))
+
+    def test_entitlements_are_loaded_from_primary(self):
+        ServiceInUse.objects.create(omcen_user=self.user, omcen_service=self.service_group)
+
+        get_catalog()
+
+        # 閲覧画面のリクエスト中でも、キャッシュする加入中サービスはプライマリから読む
+        # (テストのトランザクション中はルーターがプライマリを選ぶため、トランザクション外として扱う)
+        with routing_state() as state, mock.patch.object(connection, 'in_atomic_block', False), \
+                CaptureQueriesContext(connection) as queries:
+            state.replica = 'replica'
+            entitlements = get_entitlements(self.user)
+
+        self.assertTrue(entitlements.is_subscribed('テスト', '基本'))
+        self.assertEqual(len(queries), 1)
+
+    def test_replicas_require_shared_cache(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=locmem, OMCEN_REPLICA_DATABASES=['replica']):
+            self.assertEqual([error.id for error in check_shared_cache_for_replicas(None)], ['omcen.E004'])
+        with override_settings(CACHES=locmem, OMCEN_REPLICA_DATABASES=[]):
+            self.assertEqual(check_shared_cache_for_replicas(None), [])
+
+
+class _SMTPHandler:
+    def __init__(self):
+        self.sessions = set()
+        self.messages = []
+        self.reject_with = None
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        if self.reject_with:
+            return self.reject_with
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+@override_settings(
+    EMAIL_BACKEND='omcen.mail.QueuedEmailBackend',
+    EMAIL_HOST='127.0.0.1', EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False,
+)
+class OutboundEmailTest(TestCase):
+    def setUp(self):
+        self.handler = _SMTPHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+        self.deliverer = MailDeliverer(batch_size=10, port=port)
+        self.addCleanup(self.deliverer.close)
+
+    def queue(self, count):
+        for i in range(count):
+            send_mail(f'件名{i}', '本文', 'omcen@example.com', [f'user{i}@example.com'])
+
+    def test_send_mail_only_queues(self):
+        self.queue(3)
+
+        self.assertEqual(OutboundEmail.objects.due().count(), 3)
+        self.assertEqual(self.handler.messages, [])
+
+    def test_batches_share_one_connection(self):
+        self.queue(25)
+
+        while self.deliverer.deliver_batch() != (0, 0):
+            pass
+
+        self.assertEqual(len(self.handler.messages), 25)
+        self.assertEqual(len(self.handler.sessions), 1)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.Status.SENT).count(), 25)
+
+    def test_transient_error_is_retried_later(self):
+        self.queue(1)
+        self.handler.reject_with = '451 Try again later'
+
+        self.assertEqual(self.deliverer.deliver_batch(), (0, 1))
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.Status.QUEUED, 1))
+        self.assertGreater(email.next_attempt_at, email.created_at)
+        self.assertEqual(self.deliverer.deliver_batch(), (0, 0))
+
+        self.handler.reject_with = None
+        OutboundEmail.objects.update(next_attempt_at=email.created_at)
+        self.assertEqual(self.deliverer.deliver_batch(), (1, 0))
+
+    def test_permanent_error_fails(self):
+        self.queue(1)
+        self.handler.reject_with = '550 No such user'
+
+        self.assertEqual(self.deliverer.deliver_batch(), (0, 1))
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.Status.FAILED)
+
+    def test_unreachable_server_defers_without_attempts(self):
+        self.queue(3)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            deliverer = MailDeliverer(batch_size=10, port=sock.getsockname()[1])
+
+        # 停止が長引いても、送信を試していないメールは失敗扱いにならない
+        for _ in range(deliverer.max_attempts + 1):
+            self.assertEqual(deliverer.deliver_batch(), (0, 3))
+            self.assertEqual(OutboundEmail.objects.filter(next_attempt_at__gt=timezone.now()).count(), 3)
+            OutboundEmail.objects.update(next_attempt_at=timezone.now())
+
+        self.assertEqual(
+            list(OutboundEmail.objects.values_list('status', 'attempts')), [(OutboundEmail.Status.QUEUED, 0)] * 3,
+        )
+        self.assertIn('ConnectionRefusedError', OutboundEmail.objects.first().last_error)
+
+    def test_claimed_rows_are_skipped_by_other_workers(self):
+        self.queue(2)
+
+        claimed = self.deliverer._claim()
+
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(OutboundEmail.objects.due().count(), 0)
+        # ワーカーが落ちても、確保の期限を過ぎれば再び送信待ちになる
+        later = timezone.now() + timedelta(seconds=settings.OMCEN_EMAIL_CLAIM_TIMEOUT + 1)
+        self.assertEqual(OutboundEmail.objects.due(later).count(), 2)
+
+
+class StaticPipelineTest(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        override = override_settings(
+            STATIC_ROOT=root.name,
+            STATICFILES_STORAGE='omcen.staticfiles.CompressedManifestStaticFilesStorage',
+            OMCEN_SERVE_STATIC=True,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.root = root.name
+        self.url = staticfiles_storage.url('admin/css/base.css', force=True)
+
+    def test_collectstatic_writes_compressed_variants(self):
+        path = os.path.join(self.root, self.url[len(settings.STATIC_URL):])
+
+        self.assertRegex(self.url, r'base\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(path + '.gz'))
+        self.assertLess(os.path.getsize(path + '.gz'), os.path.getsize(path))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'css', 'style.css.gz')))
+
+    def test_serves_precompressed_immutable_file(self):
+        client = Client()
+        response = client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content))[:2], b'/*')
+
+        response = client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get(self.url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_accept_encoding_q_values(self):
+        static_file = StaticFile(os.path.join(self.root, self.url[len(settings.STATIC_URL):]), immutable=True)
+        static_file.encodings = [('br', static_file.path + '.br'), ('gzip', static_file.path + '.gz')]
+
+        self.assertEqual(accepted_encodings('gzip;q=0.5, br , identity; q=0'), {'gzip': 0.5, 'br': 1.0, 'identity': 0.0})
+        self.assertEqual(static_file.select('gzip;q=0')[0], None)
+        self.assertEqual(static_file.select('br;q=0, gzip')[0], 'gzip')
+        self.assertEqual(static_file.select('gzip, br;q=0.8')[0], 'gzip')
+        self.assertEqual(static_file.select('gzip, br')[0], 'br')
+        self.assertEqual(static_file.select('*;q=0.1, gzip;q=0')[0], 'br')
+        self.assertEqual(static_file.select('')[0], None)
+
+    def test_missing_brotli_is_reported(self):
+        with mock.patch('omcen.staticfiles.brotli', None):
+            self.assertEqual([warning.id for warning in check_brotli_for_static_files(None)], ['omcen.W001'])
+            with override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+                self.assertEqual(check_brotli_for_static_files(None), [])
+
+    def test_unhashed_name_is_revalidated(self):
+        response = Client().get('/static/css/style.css')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_API_TOKEN='secret', OMCEN_QUERY_INSPECTOR=False)
+class EntitlementApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [OmcenUser.objects.create_user(f'user{i}', f'user{i}@example.com', 'password') for i in range(3)]
+        cls.service = Service.objects.create(service_name='サービスA')
+        cls.plan = Plan.objects.create(service=cls.service, plan_name='基本', price=500)
+        cls.service_group = ServiceGroup.objects.create(service=cls.service, plan=cls.plan)
+        Service.objects.create(service_name='サービスB')
+        for user in cls.users[:2]:
+            ServiceInUse.objects.create(omcen_user=user, omcen_service=cls.service_group)
+        cls.users[1].is_active = False
+        cls.users[1].save()
+
+    def setUp(self):
+        invalidate_catalog()
+        self.url = reverse('omcen:api_entitlements')
+
+    def post(self, checks, **extra):
+        body = json.dumps({'checks': [{'user': str(user), 'service': service} for user, service in checks]})
+        return self.client.post(self.url, body, content_type='application/json', HTTP_AUTHORIZATION='Bearer secret', **extra)
+
+    def test_batch_uses_one_query(self):
+        checks = [(user.pk, service) for user in self.users for service in ('サービスA', 'サービスB', '不明')]
+        self.post(checks)
+
+        with self.assertNumQueries(1):
+            response = self.post(checks)
+
+        results = response.json()['results']
+        self.assertEqual([(r['user'], r['service']) for r in results], [(str(u), s) for u, s in checks])
+        self.assertEqual([r['entitled'] for r in results], [True, False, False] + [False] * 6)
+        self.assertEqual(results[0]['service_group'], str(self.service_group.pk))
+        self.assertEqual((results[0]['plan_name'], results[0]['price']), ('基本', 500))
+
+    def test_get_and_etag(self):
+        response = self.client.get(self.url, {'check': f'{self.users[0].pk}:サービスA'}, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertTrue(response.json()['results'][0]['entitled'])
+
+        response = self.client.get(self.url, {'check': f'{self.users[0].pk}:サービスA'}, HTTP_AUTHORIZATION='Bearer secret',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        etag = response['ETag']
+        ServiceInUse.objects.filter(omcen_user=self.users[0]).update(is_active=False)
+        response = self.client.get(self.url, {'check': f'{self.users[0].pk}:サービスA'}, HTTP_AUTHORIZATION='Bearer secret',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_is_never_not_modified(self):
+        # 条件付きリクエストの 304 は GET / HEAD だけ (RFC 9110)
+        etag = self.post([(self.users[0].pk, 'サービスA')])['ETag']
+
+        self.assertEqual(self.post([(self.users[0].pk, 'サービスA')], HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_msgpack(self):
+        body = msgpack.packb({'checks': [{'user': str(self.users[0].pk), 'service': 'サービスA'}]})
+        response = self.client.post(self.url, body, content_type='application/msgpack', HTTP_AUTHORIZATION='Bearer secret',
+                                    HTTP_ACCEPT='application/msgpack')
+
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertTrue(msgpack.unpackb(response.content)['results'][0]['entitled'])
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.client.post(self.url, '{}', content_type='application/json').status_code, 403)
+        self.assertEqual(self.post([('not-a-uuid', 'サービスA')]).status_code, 400)
+        with override_settings(OMCEN_API_MAX_CHECKS=2):
+            response = self.post([(self.users[0].pk, 'サービスA')] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('At most 2', response.json()['error'])
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class AdminTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = OmcenUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.services = [Service.objects.create(service_name=f'サービス{i}') for i in range(3)]
+        cls.plans = [Plan.objects.create(service=service, plan_name='基本', price=100) for service in cls.services]
+        cls.service_groups = [ServiceGroup.objects.create(service=plan.service, plan=plan) for plan in cls.plans]
+
+    def setUp(self):
+        invalidate_catalog()
+        self.client.force_login(self.admin)
+
+    def add_subscriptions(self, count):
+        start = OmcenUser.objects.count()
+        for i in range(start, start + count):
+            user = OmcenUser.objects.create(username=f'user{i}', email=f'user{i}@example.com')
+            ServiceInUse.objects.create(omcen_user=user, omcen_service=self.service_groups[i % 3])
+
+    def test_changelist_queries_do_not_grow(self):
+        for model in ('omcenuser', 'serviceinuse', 'servicegroup', 'plan', 'service'):
+            url = reverse(f'admin:omcen_{model}_changelist')
+            with self.subTest(model):
+                self.add_subscriptions(3)
+                self.client.get(url)
+                with CaptureQueriesContext(connection) as before:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                self.add_subscriptions(20)
+                with CaptureQueriesContext(connection) as after:
+                    self.client.get(url)
+                self.assertEqual(len(after), len(before))
+
+    def test_change_forms_do_not_list_every_row(self):
+        service_group = self.service_groups[0]
+        response = self.client.get(reverse('admin:omcen_servicegroup_change', args=[service_group.pk]))
+        self.assertContains(response, 'admin-autocomplete')
+        self.assertNotContains(response, str(self.services[1].pk))
+
+        self.add_subscriptions(1)
+        response = self.client.get(reverse('admin:omcen_serviceinuse_change', args=[ServiceInUse.objects.get().pk]))
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        self.assertNotContains(response, 'admin@example.com')
+
+    def test_prefix_and_uuid_search(self):
+        self.add_subscriptions(12)
+        url = reverse('admin:omcen_omcenuser_changelist')
+
+        # user1, user10, user11, user12
+        self.assertEqual(len(self.client.get(url, {'q': 'user1'}).context['cl'].result_list), 4)
+        self.assertEqual(len(self.client.get(url, {'q': 'ser1'}).context['cl'].result_list), 0)
+        user = OmcenUser.objects.get(username='user5')
+        response = self.client.get(reverse('admin:omcen_serviceinuse_changelist'), {'q': str(user.pk)})
+        self.assertEqual([obj.omcen_user for obj in response.context['cl'].result_list], [user])
+
+    def test_estimated_count_paginator_caps_filtered_counts(self):
+        self.add_subscriptions(5)
+
+        paginator = EstimatedCountPaginator(ServiceInUse.objects.filter(is_active=True).order_by('pk'), 2)
+        paginator.count_limit = 3
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(EstimatedCountPaginator(ServiceInUse.objects.order_by('pk'), 2).count, 5)
+
+    def test_subscription_change_invalidates_entitlements(self):
+        self.add_subscriptions(1)
+        service_in_use = ServiceInUse.objects.get()
+        user = service_in_use.omcen_user
+        self.client.force_login(user)
+        self.assertEqual(len(self.client.get(reverse('omcen:my_page')).wsgi_request.entitlements), 1)
+
+        self.client.force_login(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:omcen_serviceinuse_change', args=[service_in_use.pk]), {
+                'omcen_user': user.pk, 'omcen_service': self.service_groups[2].pk,
+            })
+        service_in_use.refresh_from_db()
+        self.assertEqual((service_in_use.service_id, service_in_use.is_active), (self.services[2].pk, False))
+        self.client.force_login(user)
+        self.assertEqual(len(self.client.get(reverse('omcen:my_page')).wsgi_request.entitlements), 0)
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class LifecycleTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = OmcenUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.service, cls.other = Service.objects.create(service_name='サービスA'), Service.objects.create(service_name='サービスB')
+        cls.service_groups = []
+        for service in (cls.service, cls.other):
+            for i in range(3):
+                plan = Plan.objects.create(service=service, plan_name=f'プラン{i}', price=100)
+                cls.service_groups.append(ServiceGroup.objects.create(service=service, plan=plan))
+        for i in range(7):
+            user = OmcenUser.objects.create(username=f'user{i}', email=f'user{i}@example.com')
+            ServiceInUse.objects.create(omcen_user=user, omcen_service=cls.service_groups[i % 3])
+            ServiceInUse.objects.create(omcen_user=user, omcen_service=cls.service_groups[3])
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_disable_with_cascade(self):
+        user = OmcenUser.objects.get(username='user0')
+        self.client.force_login(user)
+        self.assertEqual(len(self.client.get(reverse('omcen:my_page')).wsgi_request.entitlements), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            # サービス・プラン・サービスグループは件数によらず UPDATE 1回ずつ (と SAVEPOINT・RELEASE)
+            with self.assertNumQueries(5):
+                result = set_services_active([self.service.pk], False)
+            cascaded = deactivate_service_subscriptions([self.service.pk], batch_size=3)
+
+        self.assertEqual(result, (1, 3, 3, 0))
+        self.assertEqual(cascaded, 7)
+        self.assertFalse(get_catalog().services[self.service.pk].is_active)
+        self.assertFalse(ServiceInUse.objects.filter(service=self.service, is_active=True).exists())
+        self.assertEqual(ServiceInUse.objects.filter(service=self.other, is_active=True).count(), 7)
+        self.assertTrue(all(plan.is_active for plan in get_catalog().plans_for(self.other.pk)))
+        self.assertEqual(len(self.client.get(reverse('omcen:my_page')).wsgi_request.entitlements), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = set_services_active([self.service.pk], True, cascade=True)
+        self.assertEqual(result, (1, 3, 3, 0))
+        self.assertEqual(len(self.client.get(reverse('omcen:my_page')).wsgi_request.entitlements), 1)
+
+    def test_service_detail_endpoint(self):
+        url = reverse('omcen:service_detail', args=[self.service.pk])
+        self.client.force_login(OmcenUser.objects.get(username='user0'))
+        self.assertEqual(self.client.post(url, {'active': '0'}).status_code, 403)
+
+        self.client.force_login(self.admin)
+        self.assertContains(self.client.get(url), 'サービス全体を無効化')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'active': '0', 'cascade': 'on'})
+
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        response = self.client.get(url)
+        self.assertContains(response, 'プラン 3 件、サービスグループ 3 件、登録解除した加入 7 件')
+        self.assertContains(response, 'サービス全体を有効化')
+
+    def test_admin_action(self):
+        self.client.force_login(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:omcen_service_changelist'), {
+                'action': 'disable_services', '_selected_action': [self.service.pk, self.other.pk],
+            }, follow=True)
+        # 加入は cascade なしでは変えない
+        self.assertContains(response, 'サービス 2 件、プラン 6 件、サービスグループ 6 件を無効にしました。')
+        self.assertEqual(ServiceInUse.objects.filter(is_active=True).count(), 14)
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class PlanRetirementTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = OmcenUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.service = Service.objects.create(service_name='サービスA')
+        cls.plan, cls.target = [Plan.objects.create(service=cls.service, plan_name=name, price=100) for name in ('旧', '新')]
+        cls.service_group = ServiceGroup.objects.create(service=cls.service, plan=cls.plan)
+        cls.target_group = ServiceGroup.objects.create(service=cls.service, plan=cls.target)
+        for i in range(7):
+            user = OmcenUser.objects.create(username=f'user{i}', email=f'user{i}@example.com')
+            ServiceInUse.objects.create(omcen_user=user, omcen_service=cls.service_group)
+        ServiceInUse.objects.create(omcen_user=user, omcen_service=cls.service_group, is_active=False)
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_delete_plan_only_enqueues(self):
+        url = reverse('omcen:delete_plan', args=[self.service.pk, self.plan.pk])
+        self.client.force_login(self.admin)
+        self.assertContains(self.client.get(url), f'<option value="{self.target.pk}">新</option>', html=True)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'target_plan': str(self.target.pk)})
+
+        self.assertRedirects(response, reverse('omcen:service_detail', args=[self.service.pk]), fetch_redirect_response=False)
+        retirement = PlanRetirement.objects.get()
+        self.assertEqual((retirement.plan, retirement.target_plan, retirement.delete_plan), (self.plan, self.target, True))
+        self.assertEqual(ServiceInUse.objects.filter(omcen_service=self.service_group, is_active=True).count(), 7)
+        self.assertFalse(get_catalog().plans[self.plan.pk].is_active)
+        self.assertFalse(get_catalog().service_groups[self.service_group.pk].is_active)
+        self.assertEqual(enqueue_retirement(self.plan), retirement)
+
+    def test_admin_has_no_bulk_delete(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:omcen_plan_changelist'))
+
+        actions = [name for name, label in response.context['action_form'].fields['action'].choices]
+        self.assertIn('retire_plans', actions)
+        self.assertNotIn('delete_selected', actions)
+
+    def test_moves_subscribers_in_batches_and_keeps_history(self):
+        enqueue_retirement(self.plan, self.target, delete_plan=True)
+        retirer = PlanRetirer(batch_size=3, max_lock_seconds=None)
+        with CaptureQueriesContext(connection) as queries:
+            retirement = retirer.run_once()
+
+        retirement.refresh_from_db()
+        self.assertEqual((retirement.status, retirement.total, retirement.processed), (PlanRetirement.Status.DONE, 7, 7))
+        self.assertEqual(retirement.plan, self.plan)
+        self.assertFalse(Plan.objects.get(pk=self.plan.pk).is_active)
+        self.assertEqual(ServiceInUse.objects.filter(omcen_service=self.target_group, is_active=True).count(), 7)
+        # 無効にした加入は請求の履歴として残す
+        self.assertEqual(ServiceInUse.objects.filter(omcen_service=self.service_group, is_active=False).count(), 8)
+        # 3件ずつ移行するため、1トランザクションで全件を扱うことはない
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "omcen_serviceinuse"')]), 3)
+        self.assertIsNone(retirer.run_once())
+
+    def test_deactivates_without_target_and_shrinks_slow_batches(self):
+        enqueue_retirement(self.plan)
+        retirer = PlanRetirer(batch_size=40, max_lock_seconds=1e-9)
+        attempts = []
+
+        def lock_timeout(seconds):
+            attempts.append(seconds)
+            if len(attempts) == 1:
+                raise OperationalError('canceling statement due to lock timeout')
+
+        with mock.patch('omcen.retirement.set_lock_timeout', lock_timeout), mock.patch('omcen.retirement.time.sleep'):
+            retirement = retirer.run_once()
+
+        retirement.refresh_from_db()
+        self.assertEqual((retirement.status, retirement.processed), (PlanRetirement.Status.DONE, 7))
+        self.assertFalse(ServiceInUse.objects.filter(is_active=True).exists())
+        self.assertTrue(Plan.objects.filter(pk=self.plan.pk).exists())
+        self.assertEqual(retirer.batch_size, 10)
+
+    def test_deletes_plan_without_history(self):
+        unused = Plan.objects.create(service=self.service, plan_name='未使用', price=100)
+        ServiceGroup.objects.create(service=self.service, plan=unused)
+        enqueue_retirement(unused, delete_plan=True)
+
+        retirement = PlanRetirer(max_lock_seconds=None).run_once()
+
+        retirement.refresh_from_db()
+        self.assertEqual((retirement.status, retirement.plan, retirement.plan_name), (PlanRetirement.Status.DONE, None, '未使用'))
+        self.assertFalse(Plan.objects.filter(pk=unused.pk).exists())
+
+    def test_retired_subscriptions_are_billed(self):
+        period = Period.month(f'{timezone.localdate():%Y-%m}')
+        start, end = period.bounds()
+        ServiceInUse.objects.filter(omcen_service=self.service_group, is_active=True).update(created_at=start)
+        enqueue_retirement(self.plan, self.target, delete_plan=True)
+        PlanRetirer(max_lock_seconds=None).run_once()
+
+        result = run_billing(period, workers=1)
+
+        # 月初からの旧プランと、移行後の新プランを日割りで請求する
+        self.assertEqual(result.invoices, 7)
+        for invoice in Invoice.objects.prefetch_related('lines'):
+            self.assertEqual({(line.plan_id, line.plan_name) for line in invoice.lines.all()},
+                             {(self.plan.pk, '旧'), (self.target.pk, '新')})
+            self.assertLessEqual(abs(invoice.total - 100), 1)
+
+
+class BillingTest(TestCase):
+    period = Period.month('2026-10')
+
+    @classmethod
+    def setUpTestData(cls):
+        service = Service.objects.create(service_name='サービスA')
+        monthly, premium = [Plan.objects.create(service=service, plan_name=name, price=price)
+                            for name, price in (('月額', 3100), ('上位', 6200))]
+        cls.monthly, cls.premium = [ServiceGroup.objects.create(service=service, plan=plan) for plan in (monthly, premium)]
+        cls.users = [OmcenUser.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(4)]
+
+        def subscription(user, service_group, created, ended=None):
+            # created_at・updated_at は auto_now のため作成後に書き換える
+            row = ServiceInUse.objects.create(omcen_user=user, omcen_service=service_group, is_active=ended is None)
+            ServiceInUse.objects.filter(pk=row.pk).update(
+                created_at=cls.at(*created), updated_at=cls.at(*(ended or created)),
+                deactivated_at=cls.at(*ended) if ended else None,
+            )
+
+        subscription(cls.users[0], cls.monthly, (2026, 9, 15))
+        # 10/11 に上位プランへ変更: 10日分と21日分を日割りで請求する
+        subscription(cls.users[1], cls.monthly, (2026, 9, 1), ended=(2026, 10, 11))
+        subscription(cls.users[1], cls.premium, (2026, 10, 11))
+        # 期間前に登録解除・期間後に登録した加入は請求しない
+        subscription(cls.users[2], cls.monthly, (2026, 8, 1), ended=(2026, 9, 30))
+        subscription(cls.users[3], cls.monthly, (2026, 11, 1))
+
+    @staticmethod
+    def at(year, month, day):
+        return timezone.make_aware(datetime(year, month, day))
+
+    def test_prorates_plan_switches(self):
+        result = run_billing(self.period, workers=1)
+
+        self.assertEqual((result.invoices, result.lines, result.total), (2, 3, 8300))
+        invoices = {invoice.omcen_user_id: invoice for invoice in Invoice.objects.prefetch_related('lines')}
+        self.assertEqual(set(invoices), {self.users[0].pk, self.users[1].pk})
+        self.assertEqual(invoices[self.users[0].pk].total, 3100)
+        self.assertEqual(sorted(line.amount for line in invoices[self.users[1].pk].lines.all()), [1000, 4200])
+        self.assertEqual((invoices[self.users[1].pk].period_start, invoices[self.users[1].pk].period_end),
+                         (date(2026, 10, 1), date(2026, 11, 1)))
+
+    def test_later_edits_do_not_change_the_bill(self):
+        # 解除済みの行を後から保存しても (管理画面での編集など) 請求は解除日時で決まる
+        for row in ServiceInUse.objects.filter(is_active=False):
+            row.save()
+        ServiceInUse.objects.filter(is_active=False).update(updated_at=self.at(2026, 10, 31))
+
+        result = run_billing(self.period, workers=1)
+
+        self.assertEqual((result.invoices, result.lines, result.total), (2, 3, 8300))
+
+    def test_rerun_is_idempotent_across_chunks(self):
+        first = run_billing(self.period, workers=1, chunk_size=1)
+        self.assertEqual((first.chunks, first.invoices), (3, 2))
+
+        Invoice.objects.filter(omcen_user=self.users[0]).delete()
+        second = run_billing(self.period, workers=1, chunk_size=1)
+
+        self.assertEqual((second.subscriptions, second.invoices, second.total), (3, 1, 3100))
+        self.assertEqual(Invoice.objects.count(), 2)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('omcen_billing_run', '--period', '2026-10', '--workers', '1', '--quiet', stdout=out)
+        self.assertIn('2026-10: 2 invoices (3 lines, total 8300)', out.getvalue())
+
+
+# キャッシュを温める初回リクエストの警告を出さない
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class CounterTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = OmcenUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.service = Service.objects.create(service_name='サービスA')
+        cls.plans = [Plan.objects.create(service=cls.service, plan_name=name, price=price)
+                     for name, price in (('月額', 100), ('上位', 300))]
+        cls.service_groups = [ServiceGroup.objects.create(service=cls.service, plan=plan) for plan in cls.plans]
+        cls.users = [OmcenUser.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def counters(self):
+        return (
+            ServiceCounter.objects.values_list('subscribers', 'mrr').get(pk=self.service.pk),
+            [PlanCounter.objects.values_list('subscribers', 'mrr').get(pk=plan.pk) for plan in self.plans],
+        )
+
+    def test_subscription_paths_update_counters(self):
+        for user in self.users:
+            subscribe(user, self.service_groups[0])
+        subscribe(self.users[1], self.service_groups[1])
+        unsubscribe(ServiceInUse.objects.get(omcen_user=self.users[0], is_active=True))
+        unsubscribe(ServiceInUse.objects.get(omcen_user=self.users[0], is_active=False))
+        deactivate_user_subscriptions(self.users[2])
+
+        expected = ((1, 300), [(0, 0), (1, 300)])
+        self.assertEqual(self.counters(), expected)
+        self.assertEqual(rebuild_counters(), 1)
+        self.assertEqual(self.counters(), expected)
+
+        self.plans[1].price = 500
+        self.plans[1].save()
+        self.assertEqual(self.counters(), ((1, 500), [(0, 0), (1, 500)]))
+
+    def test_rebuild_command_repairs_drift(self):
+        subscribe(self.users[0], self.service_groups[0])
+        ServiceInUse.objects.create(omcen_user=self.users[1], omcen_service=self.service_groups[1])
+        ServiceCounter.objects.filter(pk=self.service.pk).update(subscribers=42, mrr=-1)
+
+        out = io.StringIO()
+        call_command('omcen_rebuild_counters', '--batch-size', '1', stdout=out)
+
+        self.assertIn('Rebuilt the counters of 1 services.', out.getvalue())
+        self.assertEqual(self.counters(), ((2, 400), [(1, 100), (1, 300)]))
+
+    def test_pages_show_counters_without_extra_queries(self):
+        for user in self.users:
+            subscribe(user, self.service_groups[1])
+        self.client.force_login(self.admin)
+
+        response = self.client.get(reverse('omcen:service_control'))
+        self.assertContains(response, '<td class="text-end">900</td>', html=True)
+
+        url = reverse('omcen:service_detail', args=[self.service.pk])
+        self.assertContains(self.client.get(url), '加入者数: 3人 / 月間売上: 900')
+        # 2回目以降はキャッシュから表示する
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(url), '<td class="text-end">900</td>', html=True)
+        self.assertFalse([query for query in queries if 'counter' in query['sql']])
+
+        # キャッシュが切れたときは集計テーブルを1回だけ読む (ビューの予算の1クエリ)
+        cache.delete(COUNTER_CACHE_KEY.format(self.service.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(len([query for query in queries if 'counter' in query['sql']]), 1)
+        self.assertEqual(get_query_budget(response.resolver_match.func), 1)
+
+
+class CatalogTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = Service.objects.create(service_name='テスト')
+        cls.stopped = Service.objects.create(service_name='停止中', is_active=False)
+        cls.plans = [Plan.objects.create(service=cls.service, plan_name=name, price=price) for name, price in (('上位', 500), ('基本', 100))]
+        cls.service_groups = [ServiceGroup.objects.create(service=cls.service, plan=plan) for plan in cls.plans]
+        cls.service_groups[0].is_active = False
+        cls.service_groups[0].save()
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_snapshot(self):
+        catalog = get_catalog()
+
+        self.assertEqual(catalog.active_services(), [self.service])
+        self.assertEqual(catalog.service_uuid_by_name['停止中'], self.stopped.pk)
+        self.assertEqual(catalog.plans_for(self.service.pk), self.plans)
+        self.assertEqual(catalog.service_groups_for('テスト'), [self.service_groups[1]])
+        self.assertEqual(
+            [group.plan.plan_name for group in catalog.service_groups_for('テスト', active_only=False)], ['上位', '基本'],
+        )
+        service_group = catalog.service_groups[self.service_groups[1].pk]
+        self.assertIs(service_group.plan, catalog.plans[self.plans[1].pk])
+        self.assertIs(service_group.service, catalog.services[self.service.pk])
+
+    def test_rows_committed_between_reads_are_dropped(self):
+        # サービスを読んだ後に、新しいサービスとそのプラン・サービスグループがコミットされた場合
+        services = list(Service.objects.all())
+        created = Service.objects.create(service_name='追加')
+        plan = Plan.objects.create(service=created, plan_name='基本', price=100)
+        ServiceGroup.objects.create(service=created, plan=plan)
+        orphan_group = ServiceGroup.objects.create(service=self.service, plan=plan)
+
+        catalog = CatalogSnapshot(1, services, list(Plan.objects.all()), list(ServiceGroup.objects.all()))
+
+        self.assertNotIn(plan.pk, catalog.plans)
+        self.assertNotIn(orphan_group.pk, catalog.service_groups)
+        self.assertEqual(catalog.service_groups_for('追加'), [])
+        self.assertEqual(catalog.plans_for(self.service.pk), self.plans)
+
+    def test_snapshot_is_reused(self):
+        catalog = get_catalog()
+        with self.assertNumQueries(0):
+            self.assertIs(get_catalog(), catalog)
+
+    def test_change_invalidates_on_commit(self):
+        catalog = get_catalog()
+        with self.captureOnCommitCallbacks() as callbacks:
+            Plan.objects.filter(pk=self.plans[1].pk).update(price=200)
+            self.plans[1].save(update_fields=['updated_at'])
+            self.assertIs(get_catalog(), catalog)
+
+        for callback in callbacks:
+            callback()
+        self.assertIsNot(get_catalog(), catalog)
+        self.assertEqual(get_catalog().plans[self.plans[1].pk].price, 200)
+
+    def test_invalidation_reaches_other_workers(self):
+        with tempfile.TemporaryDirectory() as location:
+            shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': shared}):
+                catalog = get_catalog()
+
+                # 別のワーカーが管理画面からプランを変更し、共有キャッシュの版番号を上げる
+                Plan.objects.filter(pk=self.plans[1].pk).update(price=300)
+                FileBasedCache(location, {}).set(CATALOG_VERSION_KEY, catalog.version + 1, None)
+
+                self.assertEqual(get_catalog().plans[self.plans[1].pk].price, 300)
+
+    def test_deploy_check_requires_shared_cache(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_shared_cache_for_catalog(None)], ['omcen.E003'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:11211'}}):
+            self.assertEqual(check_shared_cache_for_catalog(None), [])
+
+
+class EntitlementCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('rokuro', 'rokuro@example.com', 'password')
+        service = Service.objects.create(service_name='サービスA')
+        cls.plans = [Plan.objects.create(service=service, plan_name=name, price=100) for name in ('基本', '上位')]
+        cls.service_groups = [ServiceGroup.objects.create(service=service, plan=plan) for plan in cls.plans]
+        ServiceInUse.objects.create(omcen_user=cls.user, omcen_service=cls.service_groups[0])
+
+    def setUp(self):
+        invalidate_catalog()
+        get_catalog()
+        cache.delete(ENTITLEMENT_CACHE_KEY.format(self.user.pk))
+
+    def test_miss_then_hit(self):
+        before = entitlement_cache_stats()
+        with self.assertNumQueries(1):
+            first = get_entitlements(self.user)
+        with self.assertNumQueries(0):
+            second = get_entitlements(self.user)
+
+        after = entitlement_cache_stats()
+        self.assertEqual((after['misses'] - before['misses'], after['hits'] - before['hits']), (1, 1))
+        self.assertEqual(second.version, first.version)
+        self.assertTrue(second.is_subscribed('サービスA', '基本'))
+        self.assertEqual(len(get_entitlements(AnonymousUser())), 0)
+
+    def test_invalidated_on_commit(self):
+        cached = get_entitlements(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            subscribe(self.user, self.service_groups[1])
+            # コミットされるまでは古いキャッシュを返す
+            self.assertEqual(get_entitlements(self.user).version, cached.version)
+
+        entitlements = get_entitlements(self.user)
+        self.assertNotEqual(entitlements.version, cached.version)
+        self.assertTrue(entitlements.is_subscribed('サービスA', '上位'))
+
+    def test_rolled_back_change_keeps_cache(self):
+        cached = get_entitlements(self.user)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                subscribe(self.user, self.service_groups[1])
+                raise RuntimeError
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_entitlements(self.user).version, cached.version)
+
+    def test_catalog_change_applies_without_reload(self):
+        get_entitlements(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service_groups[0].is_active = False
+            self.service_groups[0].save()
+
+        get_catalog()
+        with self.assertNumQueries(0):
+            self.assertNotIn('サービスA', get_entitlements(self.user))
+
+
+class KeysetPaginatorTest(TestCase):
+    keys = ('-price', 'uuid')
+
+    @classmethod
+    def setUpTestData(cls):
+        service = Service.objects.create(service_name='サービスA')
+        # 同じ価格のプランを含め、2つ目のキーで並びが決まるようにする
+        for i in range(7):
+            Plan.objects.create(service=service, plan_name=f'プラン{i}', price=i // 2 * 100)
+        cls.ordered = list(Plan.objects.order_by('-price', 'uuid'))
+
+    def walk(self, paginator):
+        pages, page = [], paginator.page()
+        while True:
+            pages.append(list(page))
+            if not page.has_next():
+                return pages, page
+            page = paginator.page(page.next_token)
+
+    def test_next_and_previous(self):
+        for object_list in (Plan.objects.all(), self.ordered):
+            with self.subTest(type(object_list).__name__):
+                paginator = KeysetPaginator(object_list, 3, self.keys)
+                pages, last = self.walk(paginator)
+                self.assertEqual(pages, [self.ordered[:3], self.ordered[3:6], self.ordered[6:]])
+                self.assertFalse(paginator.page().has_previous())
+
+                previous = paginator.page(last.previous_token)
+                self.assertEqual(list(previous), self.ordered[3:6])
+                first = paginator.page(previous.previous_token)
+                self.assertEqual(list(first), self.ordered[:3])
+                self.assertFalse(first.has_previous())
+                self.assertTrue(first.has_next())
+
+    def test_page_is_one_query(self):
+        paginator = KeysetPaginator(Plan.objects.all(), 3, self.keys, count_total=False)
+        token = paginator.page().next_token
+        with self.assertNumQueries(1):
+            self.assertEqual(list(paginator.page(token)), self.ordered[3:6])
+        self.assertIsNone(paginator.count)
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        paginator = KeysetPaginator(Plan.objects.all(), 3, self.keys)
+        token = paginator.page().next_token
+        tampered = [
+            token[:-1] + ('A' if token[-1] != 'A' else 'B'),
+            signing.dumps({'k': [0, ''], 'd': 'n'}, salt='other'),
+            signing.dumps({'k': [0], 'd': 'n'}, salt=CURSOR_SALT),
+            signing.dumps({'k': [0, ''], 'd': 'x'}, salt=CURSOR_SALT),
+            'not-a-cursor',
+        ]
+        for cursor in tampered:
+            with self.subTest(cursor):
+                self.assertEqual(paginator.decode(cursor), (None, 'n'))
+                page = paginator.page(cursor)
+                self.assertEqual(list(page), self.ordered[:3])
+                self.assertEqual(page.cursor_key, '')
+
+    def test_cursor_key_follows_validated_cursor(self):
+        paginator = KeysetPaginator(self.ordered, 3, self.keys)
+        token = paginator.page().next_token
+        # 署名した時刻などでトークンが違っても、同じカーソルなら同じキーになる
+        with mock.patch('django.core.signing.time.time', return_value=0):
+            same = signing.dumps(signing.loads(token, salt=CURSOR_SALT), salt=CURSOR_SALT)
+
+        self.assertNotEqual(same, token)
+        self.assertEqual(paginator.page(same).cursor_key, paginator.page(token).cursor_key)
+        self.assertNotEqual(paginator.page(token).cursor_key, '')
+
+    @override_settings(OMCEN_QUERY_INSPECTOR=False)
+    def test_invalid_cursors_share_fragment_cache(self):
+        user = OmcenUser.objects.create_user('hachiro', 'hachiro@example.com', 'password')
+        self.client.force_login(user)
+        # サブサービスのトップ画面の URL がないため、一覧は空にする
+        Service.objects.update(is_active=False)
+        invalidate_catalog()
+        version = get_catalog().version
+
+        for cursor in ('garbage1', 'garbage2', ''):
+            self.client.get(reverse('omcen:service_list'), {'cursor': cursor})
+
+        for cursor_key in ('garbage1', 'garbage2'):
+            self.assertIsNone(cache.get(make_template_fragment_key('omcen_service_list', [version, 'ja', cursor_key])))
+        self.assertIsNotNone(cache.get(make_template_fragment_key('omcen_service_list', [version, 'ja', ''])))
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.services = {
+            name: Service.objects.create(service_name=name)
+            for name in ('テスト', 'テストサービス', 'ﾃｽﾄ管理', 'ＡＢＣテスト', 'ほかのサービス')
+        }
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_normalize(self):
+        self.assertEqual(normalize_search_text('ﾃｽﾄ'), 'てすと')
+        self.assertEqual(normalize_search_text('テスト'), 'てすと')
+        self.assertEqual(normalize_search_text('ｶﾞｲﾄﾞ'), 'がいど')
+        self.assertEqual(normalize_search_text('ＡＢＣ１２３'), 'abc123')
+        self.assertEqual(normalize_search_text(' Omcen '), 'omcen')
+        self.assertEqual(normalize_search_text(None), '')
+        self.assertEqual(Service.objects.get(pk=self.services['ﾃｽﾄ管理'].pk).search_name, 'てすと管理')
+
+    def test_ngram_index_ranks_closest_names_first(self):
+        names = {service.pk: name for name, service in self.services.items()}
+        index = NgramIndex(self.services.values())
+        ranked = [names[pk] for pk, _ in index.search(normalize_search_text('ﾃｽﾄ'))]
+
+        self.assertEqual(ranked[0], 'テスト')
+        self.assertEqual(set(ranked), {'テスト', 'テストサービス', 'ﾃｽﾄ管理', 'ＡＢＣテスト'})
+        self.assertEqual(index.search('さ'), index.search('さ', limit=10))
+        self.assertEqual(index.search(''), [])
+
+    def test_search_services(self):
+        results = list(search_services(Service.objects.all(), 'てすと').order_by('-rank', 'service_name', 'uuid'))
+
+        self.assertEqual([service.service_name for service in results][0], 'テスト')
+        self.assertEqual({service.search_total for service in results}, {4})
+        self.assertEqual([service.rank for service in results], sorted((service.rank for service in results), reverse=True))
+
+    def test_search_pages_by_rank(self):
+        paginator = KeysetPaginator(search_services(Service.objects.all(), 'てすと'), 1, ('-rank', 'service_name', 'uuid'))
+        page, found = paginator.page(), []
+        while True:
+            found.extend(service.service_name for service in page)
+            self.assertIsInstance(page[0].rank, int)
+            if not page.has_next():
+                break
+            page = paginator.page(page.next_token)
+
+        # 類似度を整数にしているため、カーソルを往復しても同じ rank の行を取りこぼさない
+        self.assertEqual(sorted(found), sorted(['テスト', 'テストサービス', 'ﾃｽﾄ管理', 'ＡＢＣテスト']))
+        self.assertEqual(found[0], 'テスト')
+
+
+class ImportExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        service = Service.objects.create(service_name='サービスA')
+        plans = [Plan.objects.create(service=service, plan_name=name, price=price) for name, price in (('基本', 100), ('上位', 300))]
+        cls.service_groups = [ServiceGroup.objects.create(service=service, plan=plan) for plan in plans]
+        cls.users = [OmcenUser.objects.create_user(f'user{i}', f'user{i}@example.com', f'password{i}') for i in range(3)]
+        ServiceInUse.objects.create(omcen_user=cls.users[0], omcen_service=cls.service_groups[0], is_active=False)
+        ServiceInUse.objects.create(omcen_user=cls.users[0], omcen_service=cls.service_groups[1])
+        ServiceInUse.objects.create(omcen_user=cls.users[1], omcen_service=cls.service_groups[0])
+
+    def setUp(self):
+        invalidate_catalog()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def export(self, kind, name):
+        path = os.path.join(self.directory, name)
+        call_command('omcen_export', kind, path, stdout=io.StringIO())
+        return path
+
+    def load(self, kind, path, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('omcen_import', kind, path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def subscriptions(self):
+        return sorted(ServiceInUse.objects.values_list(
+            'omcen_user__username', 'omcen_service__plan__plan_name', 'is_active', 'created_at', 'updated_at',
+        ))
+
+    def test_round_trip(self):
+        # 登録・解除の日時も取り込み後に復元される
+        ServiceInUse.objects.filter(is_active=False).update(
+            created_at=timezone.make_aware(datetime(2026, 9, 1)), updated_at=timezone.make_aware(datetime(2026, 9, 15)),
+        )
+        users_path, subscriptions_path = self.export('users', 'users.csv'), self.export('subscriptions', 'subscriptions.jsonl')
+        expected = self.subscriptions()
+        ServiceInUse.objects.all().delete()
+        OmcenUser.objects.all().delete()
+
+        self.load('users', users_path)
+        self.load('subscriptions', subscriptions_path)
+
+        self.assertEqual(OmcenUser.objects.count(), 3)
+        user = OmcenUser.objects.get(username='user1')
+        self.assertEqual(user.email, 'user1@example.com')
+        # ハッシュ済みのパスワードはそのまま取り込む
+        self.assertTrue(user.check_password('password1'))
+        self.assertEqual(self.subscriptions(), expected)
+        self.assertEqual(Service.objects.get().counter.subscribers, 2)
+
+    def test_password_column_is_always_hashed(self):
+        # ハッシュに見える値も、password 列なら平文として扱う
+        lookalike = make_password('secret')
+        path = os.path.join(self.directory, 'users.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(f'username,email,password\nlookalike,lookalike@example.com,{lookalike}\n')
+
+        self.load('users', path)
+
+        user = OmcenUser.objects.get(username='lookalike')
+        self.assertFalse(user.check_password('secret'))
+        self.assertTrue(user.check_password(lookalike))
+
+    def test_resume_from_checkpoint(self):
+        path = os.path.join(self.directory, 'users.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write('username,email,password\n' + ''.join(f'new{i},new{i}@example.com,secret\n' for i in range(5)))
+        checkpoint = os.path.join(self.directory, 'users.checkpoint')
+        # 3行目までをコミットした後に中断した状態
+        with open(checkpoint, 'w', encoding='utf-8') as f:
+            json.dump({'source': os.path.abspath(path), 'rows': 3}, f)
+
+        out, _ = self.load('users', path, '--checkpoint', checkpoint, '--batch-size', '1')
+
+        self.assertIn('Resuming after 3 rows.', out)
+        self.assertEqual(sorted(OmcenUser.objects.filter(username__startswith='new').values_list('username', flat=True)),
+                         ['new3', 'new4'])
+        with open(checkpoint, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['rows'], 5)
+
+    def test_unknown_rows_are_skipped(self):
+        path = os.path.join(self.directory, 'subscriptions.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write('username,service_name,plan_name\nuser2,サービスA,上位\nnobody,サービスA,上位\nuser2,不明,基本\n')
+
+        _, err = self.load('subscriptions', path)
+
+        self.assertIn('2 rows skipped', err)
+        self.assertTrue(ServiceInUse.objects.filter(omcen_user=self.users[2], is_active=True).exists())
+
+    def test_conflicting_rows_are_counted(self):
+        path = os.path.join(self.directory, 'subscriptions.jsonl')
+        rows = [
+            # user0 はすでに同じサービスに加入中のため、有効な加入は登録されない
+            {'username': 'user0', 'service_name': 'サービスA', 'plan_name': '基本', 'is_active': True},
+            {'username': 'user0', 'service_name': 'サービスA', 'plan_name': '基本', 'is_active': False},
+            {'username': 'user2', 'service_name': 'サービスA', 'plan_name': '基本', 'is_active': True},
+            {'username': 'user2', 'service_name': 'サービスA', 'plan_name': '上位', 'is_active': True},
+        ]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(row) + '\n' for row in rows)
+
+        _, err = self.load('subscriptions', path)
+
+        self.assertIn('2 rows skipped (existing username or active subscription', err)
+        self.assertEqual(ServiceInUse.objects.count(), 5)
+        self.assertEqual(ServiceInUse.objects.filter(omcen_user=self.users[2], is_active=True).count(), 1)
+
+    def test_copy_field(self):
+        # COPY は引用符のない空欄だけを NULL として読む
+        self.assertEqual([copy_field(value) for value in (None, '', 'a"b', 3)], ['', '""', '"a""b"', '"3"'])
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL')
+    def test_copy_insert_keeps_nulls(self):
+        users = [OmcenUser(username=None, email='copy@example.com', password='!', first_name='', last_name=None)]
+
+        self.assertEqual(copy_insert(OmcenUser, users), 1)
+
+        user = OmcenUser.objects.get(email='copy@example.com')
+        self.assertIsNone(user.username)
+        self.assertIsNone(user.last_login)
+        self.assertIsNone(user.last_name)
+        self.assertEqual(user.first_name, '')
+
+
+# テストを速くするため、ハッシュ化の遅くないハッシャーを使う
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordHashingTest(TestCase):
+    def test_hash_password(self):
+        hashed = make_password('secret')
+        # ハッシュに見える値も平文のパスワードとしてハッシュ化する
+        self.assertNotEqual(hash_password(hashed), hashed)
+        self.assertTrue(check_password(hashed, hash_password(hashed)))
+        self.assertEqual(hashed_password(hashed), hashed)
+        self.assertFalse(is_password_usable(hashed_password('secret')))
+        self.assertTrue(check_password('secret', hash_password('secret')))
+        self.assertEqual(identify_hasher(hash_password('secret')).algorithm, 'md5')
+        self.assertFalse(is_password_usable(hash_password('')))
+        self.assertFalse(is_password_usable(hash_password(None)))
+
+    def test_parallel_hashes_keep_order(self):
+        passwords = [f'password{i}' for i in range(7)] + [make_password('hashed'), '']
+        with ParallelPasswordHasher(workers=1, chunk_size=2) as hasher:
+            serial = hasher.hash_many(passwords)
+        with ParallelPasswordHasher(workers=2, chunk_size=2) as hasher:
+            self.assertIsNotNone(hasher.executor)
+            batches = list(hasher.hash_batches([passwords[:4], passwords[4:]], lambda password: password))
+
+        self.assertEqual([batch for batch, _ in batches], [passwords[:4], passwords[4:]])
+        parallel = [password for _, hashes in batches for password in hashes]
+        for password, first, second in zip(passwords[:7], serial, parallel):
+            self.assertTrue(check_password(password, first))
+            self.assertTrue(check_password(password, second))
+        self.assertTrue(check_password(passwords[7], parallel[7]))
+        self.assertFalse(is_password_usable(parallel[8]))
+
+    def test_create_users_bulk(self):
+        users = [{'username': f'bulk{i}', 'email': f'bulk{i}@EXAMPLE.com', 'password': f'password{i}'} for i in range(5)]
+        users.append({'username': 'staff', 'email': 'staff@example.com', 'password_hash': make_password('hashed'), 'is_staff': True})
+        users.append({'username': 'lookalike', 'email': 'lookalike@example.com', 'password': make_password('hashed')})
+
+        count = OmcenUser.objects.create_users_bulk(iter(users), hash_workers=2, chunk_size=2, batch_size=2)
+
+        self.assertEqual(count, 7)
+        self.assertFalse(OmcenUser.objects.get(username='lookalike').check_password('hashed'))
+        user = OmcenUser.objects.get(username='bulk3')
+        self.assertEqual(user.email, 'bulk3@example.com')
+        self.assertTrue(user.check_password('password3'))
+        self.assertFalse(user.is_staff)
+        staff = OmcenUser.objects.get(username='staff')
+        self.assertTrue(staff.is_staff and staff.check_password('hashed'))
+
+
+@override_settings(OMCEN_QUERY_INSPECTOR=False, OMCEN_METRICS_TOKEN='metrics-secret')
+class MetricsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = OmcenUser.objects.create_user('shichiro', 'shichiro@example.com', 'password')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_server_timing_header(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('omcen:my_page'))
+
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=[0-9.]+;desc="\d+ queries", tpl;dur=[0-9.]+, total;dur=[0-9.]+$',
+        )
+
+    def test_collect_merges_worker_files(self):
+        # 別のワーカー (親プロセスの PID) が書き出したスナップショット
+        other = {
+            'histograms': {'omcen_request_queries': {'omcen:bench-worker': {'counts': [0, 2] + [0] * 8, 'sum': 2, 'count': 2}}},
+            'counters': {'omcen_bench_worker_total': 3},
+            'gauges': {},
+        }
+        with open(os.path.join(self.directory, f'metrics-{os.getppid()}.json'), 'w', encoding='utf-8') as f:
+            json.dump(other, f)
+        with open(os.path.join(self.directory, f'metrics-{os.getppid()}.json.tmp'), 'w', encoding='utf-8') as f:
+            f.write('{broken')
+
+        with override_settings(OMCEN_METRICS_DIR=self.directory):
+            metrics.observe('omcen_request_queries', 'omcen:bench-worker', 1)
+            metrics.flush(force=True)
+            self.assertTrue(os.path.exists(os.path.join(self.directory, f'metrics-{os.getpid()}.json')))
+            histograms, counters, _ = metrics.collect()
+
+        histogram = histograms['omcen_request_queries']['omcen:bench-worker']
+        self.assertGreaterEqual(histogram.count, 3)
+        self.assertGreaterEqual(histogram.counts[1], 3)
+        self.assertEqual(counters['omcen_bench_worker_total'], 3)
+
+    def test_exited_and_stale_workers_are_pruned(self):
+        dead_pid = max(os.getpid(), os.getppid()) + 1
+        while os.path.exists(f'/proc/{dead_pid}'):
+            dead_pid += 1
+        snapshot = {'histograms': {}, 'counters': {'omcen_bench_worker_total': 1}, 'gauges': {}}
+        paths = {
+            name: os.path.join(self.directory, f'metrics-{pid}.json')
+            for name, pid in (('alive', os.getppid()), ('dead', dead_pid), ('stale', 1))
+        }
+        for path in paths.values():
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+        os.utime(paths['stale'], (0, 0))
+
+        with override_settings(OMCEN_METRICS_DIR=self.directory):
+            _, counters, _ = metrics.collect()
+
+        self.assertEqual(counters['omcen_bench_worker_total'], 1)
+        self.assertEqual(sorted(os.listdir(self.directory)), [f'metrics-{os.getppid()}.json'])
+
+    def test_histogram_quantile(self):
+        histogram = metrics.Histogram(metrics.LATENCY_BUCKETS)
+        for value in (0.001, 0.002, 0.003, 0.2):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count, 4)
+        self.assertLessEqual(histogram.quantile(0.5), 0.005)
+        self.assertGreater(histogram.quantile(0.99), 0.1)
+
+    def test_endpoint_requires_staff_or_token(self):
+        url = reverse('omcen:metrics')
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer metrics-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE omcen_request_duration_seconds histogram', response.content.decode())
+
+
+@override_settings(OMCEN_QUERY_INSPECTOR=False)
+class ServiceUnsubscribeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.other = [OmcenUser.objects.create_user(name, f'{name}@example.com', 'password') for name in ('kuro', 'juro')]
+        service = Service.objects.create(service_name=f'{benchmark.BENCH_PREFIX}unsubscribe')
+        plan = Plan.objects.create(service=service, plan_name='基本', price=100)
+        service_group = ServiceGroup.objects.create(service=service, plan=plan)
+        cls.service_in_use = ServiceInUse.objects.create(omcen_user=cls.owner, omcen_service=service_group)
+
+    def setUp(self):
+        invalidate_catalog()
+        self.url = reverse('omcen:service_unsubscribe', args=[self.service_in_use.pk])
+
+    def test_other_users_subscription_is_not_found(self):
+        self.client.force_login(self.other)
+
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 404)
+        self.assertTrue(ServiceInUse.objects.get(pk=self.service_in_use.pk).is_active)
+
+    def test_owner_unsubscribes(self):
+        self.client.force_login(self.owner)
+        with override_settings(ROOT_URLCONF=benchmark.bench_urlconf()):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url)
+
+        self.assertRedirects(response, reverse('omcen:service_list'), fetch_redirect_response=False)
+        self.assertFalse(ServiceInUse.objects.get(pk=self.service_in_use.pk).is_active)
+        # 登録解除済みの自分の加入は一覧へ戻し、他のユーザーには見つからないままにする
+        for method in (self.client.get, self.client.post):
+            self.assertRedirects(method(self.url), reverse('omcen:service_list'), fetch_redirect_response=False)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.post(self.url).status_code, 404)
@@ -1,8 +1,16 @@
+from django.conf import settings
 from django.urls import path
 
+from omcen.api import api_entitlements
 from omcen.views import ServiceControl, CreateService, ServiceList, ServiceSubscribe, PlanSelection, ServiceInUseList, \
     ServiceUnsubscribe, switching_enabled, ServiceDetail, CreatePlan, UpdatePlan, DeletePlan, OmcenUserDeactivate, \
-    MyPage, ChangeProfile
+    MyPage, ChangeProfile, prometheus_metrics, service_list_async, plan_selection_async, service_in_use_list_async, \
+    my_page_async
+
+
+# OMCEN_ASYNC_VIEWS に含まれるルートは非同期版のビューを使う
+def sync_or_async(name, sync_view, async_view):
+    return async_view if name in settings.OMCEN_ASYNC_VIEWS else sync_view
 
 
 app_name = 'omcen'
@@ -25,12 +33,21 @@ urlpatterns = [
     # サービスの有効無効切り替え
     path('admin/switching_enabled/<uuid:service_id>/<uuid:plan_id>/<str:flag>', switching_enabled, name='switching_enabled'),
 
-    path('service_list', ServiceList.as_view(), name='service_list'),
-    path('<str:service_name>/plan_selection', PlanSelection.as_view(), name='plan_selection'),
+    path('service_list', sync_or_async('service_list', ServiceList.as_view(), service_list_async), name='service_list'),
+    path('<str:service_name>/plan_selection',
+         sync_or_async('plan_selection', PlanSelection.as_view(), plan_selection_async), name='plan_selection'),
     path('<uuid:pk>/service_subscribe', ServiceSubscribe.as_view(), name='service_subscribe'),
     path('<uuid:pk>/service_unsubscribe', ServiceUnsubscribe.as_view(), name='service_unsubscribe'),
-    path('service_in_use_list', ServiceInUseList.as_view(), name='service_in_use_list'),
+    path('service_in_use_list',
+         sync_or_async('service_in_use_list', ServiceInUseList.as_view(), service_in_use_list_async),
+         name='service_in_use_list'),
     path('<uuid:pk>/omcen_user_deactivate', OmcenUserDeactivate.as_view(), name='omcen_user_deactivate'),
-    path('my_page', MyPage.as_view(), name='my_page'),
-    path('my_page/<uuid:pk>/change_profile', ChangeProfile.as_view(), name='change_profile')
+    path('my_page', sync_or_async('my_page', MyPage.as_view(), my_page_async), name='my_page'),
+    path('my_page/<uuid:pk>/change_profile', ChangeProfile.as_view(), name='change_profile'),
+
+    # メトリクス
+    path('metrics', prometheus_metrics, name='metrics'),
+
+    # サブサービス向け API
+    path('api/entitlements', api_entitlements, name='api_entitlements'),
 ]
@@ -1,23 +1,44 @@
+import hmac
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.views import redirect_to_login
 from django.db import transaction
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.urls import reverse_lazy, reverse
 from django.utils.translation import gettext_lazy as _
 
+from omcen import metrics
+from omcen.catalog import get_catalog
+from omcen.conditional import ConditionalCatalogMixin, catalog_validators, conditional_response, set_validators
+from omcen.counters import EMPTY_COUNTER, service_counters
 from omcen.forms import SearchService, CreateServiceForm, ServiceSubscribeForm, ServiceUnsubscribeForm, CreatePlanForm, \
-    UpdatePlanForm, DeletePlanForm, OmcenUserDeactivateForm, ChangeProfileForm
+    UpdatePlanForm, DeletePlanForm, OmcenUserDeactivateForm, ChangeProfileForm, ServiceLifecycleForm
 
 from django.views.generic import ListView, CreateView, UpdateView, TemplateView, DeleteView
 
+from omcen.lifecycle import set_services_active
 from omcen.models import Service, Plan, ServiceGroup, ServiceInUse, OmcenUser
+from omcen.pagination import KeysetPaginationMixin, paginate, pagination_context
+from omcen.queries import query_budget
+from omcen.retirement import enqueue_retirement
+from omcen.routers import read_replica
+from omcen.search import search_services
+from omcen.subscriptions import subscribe, unsubscribe, deactivate_user_subscriptions
 
 
 # サービスの有効・無効切り替え
 @login_required
+@query_budget(3)
 def switching_enabled(request, service_id, plan_id, flag):
-    service_group = get_object_or_404(ServiceGroup, service_id=service_id, plan_id=plan_id)
+    service_group = get_object_or_404(ServiceGroup.objects.select_related('plan'), service_id=service_id, plan_id=plan_id)
     if flag == 'enabled':
         service_group.is_active = True
         service_group.plan.is_active = True
@@ -30,18 +51,37 @@ def switching_enabled(request, service_id, plan_id, flag):
         messages.error(request, 'サービスの有効・無効切り替えに失敗しました。')
         return redirect(reverse_lazy('omcen:service_detail', args=[service_id]))
 
+    # 加入中サービスのキャッシュはカタログ経由で有効状態を判定するため、
+    # ここではカタログの更新(シグナル)だけで反映される
     with transaction.atomic():
         service_group.save()
-        service_group.plan.save()
+        # 価格は変えないため月間売上の集計は数え直さない
+        service_group.plan.save(update_fields=['is_active', 'updated_at'])
 
     return redirect(reverse_lazy('omcen:service_detail', args=[service_id]))
 
 
+# メトリクス (Prometheus テキスト形式)
+@query_budget(0)
+def prometheus_metrics(request):
+    token = getattr(settings, 'OMCEN_METRICS_TOKEN', None)
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        authorized = True
+    if not authorized:
+        raise PermissionDenied
+
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # サービス管理画面
-class ServiceControl(LoginRequiredMixin, ListView):
+class ServiceControl(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     template_name = 'omcen/admin_service_control.html'
+    query_budget = 1
+    use_replica = True
     model = Service
     paginate_by = 30
+    keyset_fields = ('service_name', 'uuid')
     ordering = 'is_active'
     form = None
 
@@ -52,45 +92,92 @@ class ServiceControl(LoginRequiredMixin, ListView):
         return super().dispatch(self.request, *args, **kwargs)
 
     def get_queryset(self):
-        form = SearchService(self.request.GET or None)
-        query_set = super().get_queryset()
+        self.form = SearchService(self.request.GET or None)
+        self.search_text = ''
+        # 加入者数・月間売上は集計テーブルを同じクエリで結合して読む
+        query_set = super().get_queryset().select_related('counter')
 
-        if form.is_bound:
-            if form.is_valid():
-                service_name = form.cleaned_data.get('service_name')
+        if self.form.is_bound and self.form.is_valid():
+            self.search_text = self.form.cleaned_data.get('service_name')
 
-                if service_name:
-                    query_set = query_set.filter(service_name__icontains=service_name)
-
-            if not query_set.exists():
-                messages.info(self.request, '該当するサービスがありませんでした。', extra_tags='info')
+        if self.search_text:
+            # 件数は同じクエリのウィンドウ関数で数える
+            return search_services(query_set, self.search_text)
 
         return query_set.order_by('service_name')
 
+    def get_keyset_fields(self):
+        if self.search_text:
+            return ('-rank', 'service_name', 'uuid')
+        return super().get_keyset_fields()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['form'] = SearchService()
 
+        if self.form.is_bound and not context['page_obj'].has_previous():
+            object_list = context['object_list']
+            if self.search_text:
+                context['search_total'] = object_list[0].search_total if object_list else 0
+            if not object_list:
+                messages.info(self.request, '該当するサービスがありませんでした。', extra_tags='info')
+
         return context
 
 
 # サービスの詳細画面
 class ServiceDetail(LoginRequiredMixin, TemplateView):
     template_name = 'omcen/admin_service_detail.html'
+    # サービス・プランはカタログから読む。加入者数・月間売上の集計は OMCEN_COUNTER_CACHE_TTL 秒だけ
+    # キャッシュするため、キャッシュが切れたリクエストでは集計テーブルを1回読む
+    query_budget = 1
+    use_replica = True
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        service = get_object_or_404(Service, pk=self.kwargs.get('service_id'))
+        catalog = get_catalog()
+        service = catalog.services.get(self.kwargs.get('service_id'))
+        if service is None:
+            raise Http404
 
-        context['plans'] = Plan.objects.filter(service=service)
+        context['plans'] = catalog.plans_for(service.pk)
         context['service'] = service
+        counters = service_counters(service.pk)
+        context['counter'] = counters.service
+        context['plan_rows'] = [(plan, counters.plans.get(plan.pk, EMPTY_COUNTER)) for plan in context['plans']]
+        context['lifecycle_form'] = ServiceLifecycleForm()
 
         return context
 
+    # サービスと全プラン・サービスグループの有効・無効をまとめて切り替える
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            raise PermissionDenied
+        service_id = self.kwargs.get('service_id')
+        if service_id not in get_catalog().services:
+            raise Http404
+
+        form = ServiceLifecycleForm(request.POST)
+        if not form.is_valid():
+            messages.error(request, 'サービスの有効・無効切り替えに失敗しました。')
+            return redirect(reverse_lazy('omcen:service_detail', args=[service_id]))
+
+        active = form.cleaned_data['active']
+        result = set_services_active([service_id], active, cascade=form.cleaned_data['cascade'])
+        messages.success(
+            request,
+            f'サービスを{"有効" if active else "無効"}にしました。'
+            f'(プラン {result.plans} 件、サービスグループ {result.service_groups} 件、'
+            f'登録解除した加入 {result.subscriptions} 件)'
+        )
+
+        return redirect(reverse_lazy('omcen:service_detail', args=[service_id]))
+
 
 # サービスの新規作成
 class CreateService(LoginRequiredMixin, CreateView):
     template_name = 'omcen/admin_create_service.html'
+    query_budget = 0
     model = ServiceGroup
     form_class = CreateServiceForm
     success_url = reverse_lazy('omcen:service_control')
@@ -130,6 +217,7 @@ class CreateService(LoginRequiredMixin, CreateView):
 # プランの新規作成
 class CreatePlan(LoginRequiredMixin, CreateView):
     template_name = 'omcen/admin_create_plan.html'
+    query_budget = 1
     model = Plan
     form_class = CreatePlanForm
 
@@ -152,7 +240,9 @@ class CreatePlan(LoginRequiredMixin, CreateView):
 # プランの編集
 class UpdatePlan(LoginRequiredMixin, UpdateView):
     template_name = 'omcen/admin_update_plan.html'
+    query_budget = 1
     model = Plan
+    queryset = Plan.objects.select_related('service')
     form_class = UpdatePlanForm
 
     def get_success_url(self):
@@ -163,19 +253,41 @@ class UpdatePlan(LoginRequiredMixin, UpdateView):
 # プランの削除
 class DeletePlan(LoginRequiredMixin, DeleteView):
     template_name = 'omcen/admin_delete_plan.html'
+    query_budget = 1
     model = Plan
+    queryset = Plan.objects.select_related('service')
     form_class = DeletePlanForm
 
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault('form', self.form_class(plan=self.object))
+        return super().get_context_data(**kwargs)
+
+    # CASCADE で加入をまとめて削除せず、加入者の移行とプランの削除はバックグラウンドの
+    # omcen_retire_plans に任せる (ここでは新規加入を止めて処理を登録するだけ)
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        form = self.form_class(request.POST, plan=self.object)
+        if not form.is_valid():
+            return self.render_to_response(self.get_context_data(form=form))
+
+        enqueue_retirement(self.object, form.cleaned_data['target_plan'], delete_plan=True)
+        messages.success(request, 'プランの削除を受け付けました。加入中のユーザーの移行が終わり次第削除されます。')
+
+        return HttpResponseRedirect(self.get_success_url())
+
     def get_success_url(self):
         self.success_url = reverse_lazy('omcen:service_detail', args=[self.kwargs.get('service_id')])
         return super().get_success_url()
 
 
 # サービス一覧
-class ServiceList(LoginRequiredMixin, ListView):
+class ServiceList(LoginRequiredMixin, ConditionalCatalogMixin, KeysetPaginationMixin, ListView):
     template_name = 'omcen/service_list.html'
+    query_budget = 0
+    use_replica = True
     model = Service
     paginate_by = 30
+    keyset_fields = ('service_name', 'uuid')
     ordering = 'service_name'
     form = None
 
@@ -188,30 +300,25 @@ class ServiceList(LoginRequiredMixin, ListView):
         return super().dispatch(self.request, *args, **kwargs)
 
     def get_queryset(self):
-        query_set = super().get_queryset()
-        query_set = query_set.filter(is_active=True)
-
-        return query_set.order_by('service_name')
+        return self.catalog.active_services()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        services = Service.objects.filter(is_active=True)
-
-        services_dict = {}
-        for service in services:
-            services_dict.update({
-                service.service_name: f'{service.service_name}:top'
-            })
-        context['service_dict'] = services_dict
+        top_urls = self.catalog.top_urls
+        context['service_dict'] = {service.service_name: top_urls[service.service_name] for service in context['object_list']}
 
         return context
 
 
 # プラン選択画面
-class PlanSelection(LoginRequiredMixin, ListView):
+class PlanSelection(LoginRequiredMixin, ConditionalCatalogMixin, KeysetPaginationMixin, ListView):
     template_name = 'omcen/plan_selection.html'
+    query_budget = 0
+    use_replica = True
+    conditional_entitlements = True
     model = ServiceGroup
     paginate_by = 30
+    keyset_fields = ('plan__plan_name', 'uuid')
     ordering = 'is_active'
     form = None
 
@@ -224,21 +331,11 @@ class PlanSelection(LoginRequiredMixin, ListView):
         return super().dispatch(self.request, *args, **kwargs)
 
     def get_queryset(self):
-        query_set = super().get_queryset()
-        query_set = query_set.filter(
-            service__service_name=self.request.resolver_match.kwargs['service_name'],
-            is_active=True
-        )
-
-        return query_set.order_by('plan__plan_name')
+        return self.catalog.service_groups_for(self.request.resolver_match.kwargs['service_name'])
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['service_in_use'] = ServiceInUse.objects.filter(
-            omcen_user__username=self.request.user,
-            omcen_service__service__service_name=self.request.resolver_match.kwargs['service_name'],
-            is_active=True
-        )
+        context['entitlement'] = self.request.entitlements.get(self.request.resolver_match.kwargs['service_name'])
 
         return context
 
@@ -246,6 +343,7 @@ class PlanSelection(LoginRequiredMixin, ListView):
 # サービスの登録
 class ServiceSubscribe(LoginRequiredMixin, CreateView):
     template_name = 'omcen/service_subscribe.html'
+    query_budget = 0
     model = ServiceInUse
     form_class = ServiceSubscribeForm
 
@@ -255,58 +353,31 @@ class ServiceSubscribe(LoginRequiredMixin, CreateView):
 
             return self.handle_no_permission()
 
-        if ServiceInUse.objects.filter(omcen_user__username=self.request.user,
-                                       omcen_service__uuid=self.request.resolver_match.kwargs['pk'],
-                                       is_active=True).exists():
-            service_in_use = get_object_or_404(
-                ServiceInUse,
-                omcen_user__username=self.request.user,
-                omcen_service__uuid=self.request.resolver_match.kwargs['pk'],
-                is_active=True
-            )
-            return redirect(to=reverse('omcen:service_unsubscribe', kwargs={'pk': service_in_use.uuid}))
+        # ServiceGroup はリクエスト中カタログから1度だけ取得する
+        self.service_group = get_catalog().service_groups.get(self.request.resolver_match.kwargs['pk'])
+        if self.service_group is None:
+            raise Http404
+
+        entitlement = self.request.entitlements.get(self.service_group.service.service_name)
+        if entitlement is not None and entitlement.service_group_id == self.service_group.pk:
+            return redirect(to=reverse('omcen:service_unsubscribe', kwargs={'pk': entitlement.service_in_use_id}))
 
         return super().dispatch(self.request, *args, **kwargs)
 
     def form_valid(self, form):
-        form.instance.omcen_user = self.request.user
-        form.instance.omcen_service = get_object_or_404(
-            ServiceGroup,
-            uuid=self.request.resolver_match.kwargs['pk']
-        )
-        if ServiceInUse.objects.filter(omcen_user__username=self.request.user,
-                                       omcen_service__service__service_name=form.instance.omcen_service.service.service_name,
-                                       is_active=True).exists():
-            before_service_in_use = ServiceInUse.objects.filter(
-                omcen_user__username=self.request.user,
-                omcen_service__service__service_name=form.instance.omcen_service.service.service_name,
-                is_active=True
-            ).first()
-            before_service_in_use.is_active = False
-            before_service_in_use.save()
+        self.object = subscribe(self.request.user, self.service_group)[0]
 
-        return super().form_valid(form)
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['service_group'] = get_object_or_404(
-            ServiceGroup,
-            uuid=self.request.resolver_match.kwargs['pk']
-        )
-        context['before_service_in_use'] = ServiceInUse.objects.filter(
-            omcen_user__username=self.request.user,
-            omcen_service__service__service_name=context['service_group'].service.service_name,
-            is_active=True
-        ).exists()
+        context['service_group'] = self.service_group
+        context['before_service_in_use'] = self.service_group.service.service_name in self.request.entitlements
 
         return context
 
     def get_success_url(self):
-        service_group = get_object_or_404(
-            ServiceGroup,
-            uuid=self.request.resolver_match.kwargs['pk']
-        )
-        self.success_url = reverse_lazy(f'{service_group.service.service_name}:top')
+        self.success_url = reverse_lazy(f'{self.service_group.service.service_name}:top')
         messages.success(self.request, _('登録が完了しました。'), extra_tags='success')
 
         return super().get_success_url()
@@ -315,6 +386,7 @@ class ServiceSubscribe(LoginRequiredMixin, CreateView):
 # サービスの登録解除
 class ServiceUnsubscribe(LoginRequiredMixin, UpdateView):
     template_name = 'omcen/service_unsubscribe.html'
+    query_budget = 1
     model = ServiceInUse
     form_class = ServiceUnsubscribeForm
     success_url = reverse_lazy('omcen:service_list')
@@ -325,22 +397,34 @@ class ServiceUnsubscribe(LoginRequiredMixin, UpdateView):
 
             return self.handle_no_permission()
 
-        if not ServiceInUse.objects.filter(uuid=self.request.resolver_match.kwargs['pk'], is_active=True).exists():
-            return redirect(to=reverse('omcen:service_list'))
+        # 存在確認・フォーム・画面表示で同じオブジェクトを使う。他のユーザーの加入は登録解除させない
+        self.service_in_use = (
+            ServiceInUse.objects.filter(omcen_user=self.request.user, uuid=self.request.resolver_match.kwargs['pk'])
+            .select_related('omcen_service__service', 'omcen_service__plan')
+            .first()
+        )
+        if self.service_in_use is None:
+            raise Http404
+
+        # 登録解除済みの自分の加入 (二重送信や戻るボタン) は一覧へ戻す
+        if not self.service_in_use.is_active:
+            messages.info(self.request, _('登録解除済みです。'), extra_tags='info')
+
+            return redirect(to=self.success_url)
 
         return super().dispatch(self.request, *args, **kwargs)
 
+    def get_object(self, queryset=None):
+        return self.service_in_use
+
     def form_valid(self, form):
-        form.instance.is_active = False
+        self.object = unsubscribe(form.instance)
 
-        return super().form_valid(form)
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        service_in_use = get_object_or_404(
-            ServiceInUse,
-            uuid=self.request.resolver_match.kwargs['pk']
-        )
+        service_in_use = self.service_in_use
         context['service_in_use'] = service_in_use
         context['cancel_url'] = f'{service_in_use.omcen_service.service.service_name}:top'
 
@@ -353,10 +437,13 @@ class ServiceUnsubscribe(LoginRequiredMixin, UpdateView):
 
 
 # 使用中のサービス一覧
-class ServiceInUseList(LoginRequiredMixin, ListView):
+class ServiceInUseList(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     template_name = 'omcen/service_in_use_list.html'
+    query_budget = 1
+    use_replica = True
     model = ServiceInUse
     paginate_by = 30
+    keyset_fields = ('service__service_name', 'uuid')
     ordering = 'is_active'
     form = None
 
@@ -370,17 +457,15 @@ class ServiceInUseList(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         query_set = super().get_queryset()
-        query_set = query_set.filter(
-            omcen_user__username=self.request.user,
-            is_active=True
-        )
+        query_set = query_set.active_for(self.request.user).select_related('omcen_service__service', 'omcen_service__plan')
 
-        return query_set.order_by('omcen_service__service__service_name')
+        return query_set.order_by('service__service_name')
 
 
 # omcenユーザーの停止
 class OmcenUserDeactivate(LoginRequiredMixin, UpdateView):
     template_name = 'omcen/omcen_user_deactivate.html'
+    query_budget = 0
     model = OmcenUser
     form_class = OmcenUserDeactivateForm
     success_url = reverse_lazy('account_signup')
@@ -393,12 +478,16 @@ class OmcenUserDeactivate(LoginRequiredMixin, UpdateView):
 
         return super().dispatch(self.request, *args, **kwargs)
 
+    def get_object(self, queryset=None):
+        # ログインユーザー自身の場合は再取得しない
+        if self.kwargs.get('pk') == self.request.user.pk:
+            return self.request.user
+
+        return super().get_object(queryset)
+
     def form_valid(self, form):
         form.instance.is_active = False
-        ServiceInUse.objects.values().filter(
-            omcen_user__username=self.request.user,
-            is_active=True
-        ).update(is_active=False)
+        deactivate_user_subscriptions(self.request.user)
 
         return super().form_valid(form)
 
@@ -411,6 +500,8 @@ class OmcenUserDeactivate(LoginRequiredMixin, UpdateView):
 # マイページ
 class MyPage(LoginRequiredMixin, TemplateView):
     template_name = 'omcen/my_page.html'
+    query_budget = 0
+    use_replica = True
 
     def dispatch(self, *args, **kwargs):
         if not self.request.user.is_authenticated:
@@ -422,11 +513,7 @@ class MyPage(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        omcen_user = get_object_or_404(
-            OmcenUser,
-            username=self.request.user,
-        )
-        context['omcen_user'] = omcen_user
+        context['omcen_user'] = self.request.user
 
         return context
 
@@ -434,6 +521,7 @@ class MyPage(LoginRequiredMixin, TemplateView):
 # プロフィールの変更
 class ChangeProfile(LoginRequiredMixin, UpdateView):
     template_name = 'omcen/change_profile.html'
+    query_budget = 0
     model = OmcenUser
     form_class = ChangeProfileForm
     success_url = reverse_lazy('omcen:my_page')
@@ -446,7 +534,125 @@ class ChangeProfile(LoginRequiredMixin, UpdateView):
 
         return super().dispatch(self.request, *args, **kwargs)
 
+    def get_object(self, queryset=None):
+        # ログインユーザー自身の場合は再取得しない
+        if self.kwargs.get('pk') == self.request.user.pk:
+            return self.request.user
+
+        return super().get_object(queryset)
+
     def get_success_url(self):
         messages.success(self.request, _('プロフィールの編集が完了しました'), extra_tags='success')
 
         return super().get_success_url()
+
+
+# ---- 非同期 (ASGI) 版の閲覧画面 ----
+# Django 3.2 の ORM は同期のみのため、DB・キャッシュへのアクセスは1リクエストにつき
+# 1回の sync_to_async にまとめ、ページング・テンプレート描画はイベントループ上で行う。
+# どのルートで使うかは settings.OMCEN_ASYNC_VIEWS で切り替える。
+
+def _login_redirect(request):
+    messages.warning(request, _('ログインしてください'))
+
+    return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
+
+
+def _load_request(request, entitlements=False):
+    """
+    Resolve the lazy user (and entitlements) and the catalog in the calling
+    thread so the async view can use them without touching the database.
+    """
+    if not request.user.is_authenticated:
+        return None
+    if entitlements:
+        len(request.entitlements)
+
+    return get_catalog()
+
+
+def _render(request, template_name, context):
+    started = time.perf_counter()
+    content = render_to_string(template_name, context, request)
+    stats = getattr(request, '_omcen_stats', None)
+    if stats is not None:
+        stats.template_time += time.perf_counter() - started
+
+    return HttpResponse(content)
+
+
+def _load_catalog_page(request, entitlements=False):
+    """_load_request() plus the page's validators; returns ``(catalog, etag, last_modified)`` or None."""
+    catalog = _load_request(request, entitlements)
+    if catalog is None:
+        return None
+
+    return (catalog, *catalog_validators(request, catalog, request.entitlements if entitlements else None))
+
+
+@query_budget(0)
+@read_replica
+async def service_list_async(request):
+    loaded = await sync_to_async(_load_catalog_page)(request)
+    if loaded is None:
+        return _login_redirect(request)
+    catalog, etag, last_modified = loaded
+
+    response = conditional_response(request, etag, last_modified)
+    if response is None:
+        paginator, page = paginate(request, catalog.active_services(), ServiceList.paginate_by, ServiceList.keyset_fields)
+        context = pagination_context(paginator, page)
+        context['service_dict'] = {service.service_name: catalog.top_urls[service.service_name] for service in page.object_list}
+        context['catalog_version'] = catalog.version
+        response = _render(request, ServiceList.template_name, context)
+
+    return set_validators(response, etag, last_modified)
+
+
+@query_budget(0)
+@read_replica
+async def plan_selection_async(request, service_name):
+    loaded = await sync_to_async(_load_catalog_page)(request, entitlements=True)
+    if loaded is None:
+        return _login_redirect(request)
+    catalog, etag, last_modified = loaded
+
+    response = conditional_response(request, etag, last_modified)
+    if response is None:
+        paginator, page = paginate(
+            request, catalog.service_groups_for(service_name), PlanSelection.paginate_by, PlanSelection.keyset_fields,
+        )
+        context = pagination_context(paginator, page)
+        context['entitlement'] = request.entitlements.get(service_name)
+        context['catalog_version'] = catalog.version
+        response = _render(request, PlanSelection.template_name, context)
+
+    return set_validators(response, etag, last_modified)
+
+
+@query_budget(1)
+@read_replica
+async def service_in_use_list_async(request):
+    def load():
+        if _load_request(request) is None:
+            return None
+        query_set = (
+            ServiceInUse.objects.active_for(request.user)
+            .select_related('omcen_service__service', 'omcen_service__plan')
+        )
+        return paginate(request, query_set, ServiceInUseList.paginate_by, ServiceInUseList.keyset_fields)
+
+    result = await sync_to_async(load)()
+    if result is None:
+        return _login_redirect(request)
+
+    return _render(request, ServiceInUseList.template_name, pagination_context(*result))
+
+
+@query_budget(0)
+@read_replica
+async def my_page_async(request):
+    if await sync_to_async(_load_request)(request) is None:
+        return _login_redirect(request)
+
+    return _render(request, MyPage.template_name, {'omcen_user': request.user})